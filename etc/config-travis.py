@@ -33,3 +33,6 @@ CACHE_CONFIG = dict(
 
 # Maximum LD window size
 LD_MAX_SIZE = int(4E6)
+
+# LD server (computes LD on request, results are cached in redis)
+LD_SERVER_URL = "http://portaldev.sph.umich.edu/api_ld/ld"
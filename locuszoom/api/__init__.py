@@ -1,7 +1,6 @@
 import os, datetime, logging
 from flask import Flask, g
 from flask_cors import CORS
-from flask_compress import Compress
 from locuszoom.api.jsonutil import CustomJSONEncoder
 
 def create_app():
@@ -27,9 +26,6 @@ def create_app():
   # Enable cross-domain headers on all routes
   CORS(app)
 
-  # Enable compression support
-  Compress(app)
-
   # Setup Postgres DB
   from . import db
   db.init_app(app)
@@ -38,6 +34,14 @@ def create_app():
   from . import redis_client
   redis_client.init_app(app)
 
+  # Setup cache for annotation rows
+  from . import region_cache
+  region_cache.init_app(app)
+
+  # Enable compression support
+  from . import compression
+  compression.init_app(app)
+
   # Setup helpers
   from . import helpers
   helpers.init_app(app)
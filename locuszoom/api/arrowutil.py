@@ -0,0 +1,137 @@
+from decimal import Decimal
+import json
+
+# pyarrow is optional, format=arrow is only available if it is installed
+try:
+  import pyarrow as pa
+except ImportError:
+  pa = None
+
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+def arrow_type(type_code):
+  """
+  Arrow type for a postgres type (by OID.) Types without a direct equivalent are sent as strings.
+  """
+
+  types = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    26: pa.int64(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1700: pa.float64(),
+    1082: pa.date32(),
+    1114: pa.timestamp("us"),
+    1184: pa.timestamp("us",tz="UTC")
+  }
+
+  return types.get(type_code,pa.string())
+
+def to_string(v):
+  if v is None or isinstance(v,str):
+    return v
+  elif isinstance(v,(dict,list)):
+    # json/jsonb columns
+    return json.dumps(v,separators=(",",":"),sort_keys=True)
+
+  return str(v)
+
+def to_float(v):
+  if isinstance(v,Decimal):
+    return float(v)
+
+  return v
+
+class ChunkSink(object):
+  """
+  Output stream for pyarrow that keeps what is written as a list of chunks, rather than one growing buffer.
+  """
+
+  def __init__(self):
+    self.chunks = []
+    self.pending = []
+    self.closed = False
+
+  def write(self,data):
+    self.pending.append(data)
+    return len(data)
+
+  def flush(self):
+    # pyarrow writes each message in several small pieces, join them into one chunk
+    if self.pending:
+      self.chunks.append(b"".join(self.pending))
+      self.pending = []
+
+  def close(self):
+    self.flush()
+    self.closed = True
+
+class ArrowStreamWriter(object):
+  """
+  Incrementally encodes database rows into an Arrow IPC stream: a schema, followed by one record batch per batch of
+  rows.
+
+  The encoded stream is held in memory (one chunk per record batch) until close(), so that the record limit can be
+  enforced before the response starts. Python row objects are only held for one batch at a time.
+
+  Column types come from the postgres types of the query's columns, so every batch has the same schema regardless
+  of the values it contains. real and double precision columns become float32 and float64; infinities and NaN
+  are encoded natively.
+  """
+
+  def __init__(self,type_codes,fields,cols_to_field,metadata=None):
+    """
+    Args:
+      type_codes: mapping of database column --> postgres type OID
+      fields: database columns to write, in order
+      cols_to_field: mapping of database column --> field name in the response
+      metadata: dictionary stored (JSON encoded) in the schema's metadata
+    """
+
+    self.fields = fields
+    self.types = [arrow_type(type_codes.get(col)) for col in fields]
+    self.schema = pa.schema(
+      [pa.field(cols_to_field.get(col,col),t) for col, t in zip(fields,self.types)],
+      metadata = {k: json.dumps(v) for k, v in metadata.items()} if metadata else None
+    )
+
+    self.sink = ChunkSink()
+    self.writer = pa.ipc.new_stream(self.sink,self.schema)
+    self.nrows = 0
+
+  def write(self,rows):
+    """
+    Write a batch of rows. Each row must support lookup by column name.
+    """
+
+    if len(rows) == 0:
+      return
+
+    arrays = []
+    for col, t in zip(self.fields,self.types):
+      values = [row[col] for row in rows]
+      if pa.types.is_string(t):
+        values = [to_string(v) for v in values]
+      elif pa.types.is_floating(t):
+        values = [to_float(v) for v in values]
+
+      arrays.append(pa.array(values,type=t))
+
+    self.writer.write_batch(pa.RecordBatch.from_arrays(arrays,schema=self.schema))
+    self.sink.flush()
+    self.nrows += len(rows)
+
+  def close(self):
+    """
+    Finish the stream.
+
+    Returns:
+      list: the encoded stream, as chunks of bytes
+    """
+
+    self.writer.close()
+    self.sink.close()
+    return self.sink.chunks
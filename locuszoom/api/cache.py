@@ -1,9 +1,15 @@
 from abc import ABCMeta, abstractmethod
 import msgpack
 from six import iteritems
-from six.moves.cPickle import dumps, loads
-from collections import OrderedDict
-from intervaltree import IntervalTree, Interval
+from collections import OrderedDict, Counter
+from array import array
+from bisect import bisect_left, bisect_right
+from redis import WatchError
+import numpy as np
+import struct
+import sys
+import threading
+import time
 
 class IntervalCache(metaclass=ABCMeta):
   def __init__(self):
@@ -67,6 +73,42 @@ class IntervalCache(metaclass=ABCMeta):
 
     pass
 
+  @abstractmethod
+  def retrieve_partial(self,key,start,end):
+    """
+    Returns whatever data the cache has within an interval, along with the sub-intervals that have not been
+    stored yet (and therefore need to be computed.)
+
+    Intervals are inclusive of both start and end.
+
+    Args:
+      key: str
+      start: int
+      end: int
+
+    Returns:
+      dict: data stored within the interval (possibly empty)
+      list: (start,end) tuples for each gap in the interval that is not covered by the cache, in order. This
+        is empty if the entire interval was previously stored.
+    """
+
+    pass
+
+  def admit(self,key,start,end):
+    """
+    Decide whether data computed for an interval is worth storing. By default, everything is stored.
+
+    Args:
+      key: str
+      start: int
+      end: int
+
+    Returns:
+      bool
+    """
+
+    return True
+
   @abstractmethod
   def delete(self,key):
     """
@@ -84,95 +126,731 @@ class IntervalCache(metaclass=ABCMeta):
 
     pass
 
-def interval_contained(tree,interval):
-  if not isinstance(interval,Interval):
-    interval = Interval(*interval)
-
-  return any([i.contains_interval(interval) for i in tree.search(interval)])
-
-# def find_disjoint(tree,query):
-#   """
-#   Will use this in later iteration if we want to tell LD API exactly what interval
-#   it needs to calculate beyond what is already cached
-#   """
-#
-#   overlaps = tree.search(query)
-#   qtree = IntervalTree([query])
-#
-#   for o in overlaps:
-#     qtree.chop(o.begin,o.end)
-#
-#   return qtree
-
-class RedisIntervalCache(IntervalCache):
-  def __init__(self,redis_client=None):
+def pack_ranges(ranges):
+  """
+  Encode a list of (start,end) tuples as a little-endian array of int64 pairs.
+  """
+
+  packed = array("q",[x for r in ranges for x in r])
+  if sys.byteorder == "big":
+    packed.byteswap()
+
+  return packed.tobytes()
+
+def unpack_ranges(data):
+  """
+  Decode ranges encoded by pack_ranges() into a list of (start,end) tuples.
+  """
+
+  packed = array("q")
+  if data is not None:
+    packed.frombytes(data)
+    if sys.byteorder == "big":
+      packed.byteswap()
+
+  return list(zip(packed[0::2],packed[1::2]))
+
+def merge_range(ranges,start,end):
+  """
+  Add [start,end] into a sorted list of disjoint ranges. Ranges are inclusive of both start and end, and ranges
+  that overlap or are adjacent to the new one are merged with it.
+
+  Returns:
+    list of (start,end) tuples, sorted
+  """
+
+  merged = []
+  i = 0
+  while i < len(ranges) and ranges[i][1] < start - 1:
+    merged.append(ranges[i])
+    i += 1
+
+  while i < len(ranges) and ranges[i][0] <= end + 1:
+    start = min(start,ranges[i][0])
+    end = max(end,ranges[i][1])
+    i += 1
+
+  merged.append((start,end))
+  merged.extend(ranges[i:])
+  return merged
+
+def find_disjoint(ranges,start,end):
+  """
+  Find the parts of [start,end] that are not covered by a sorted list of disjoint ranges. Ranges are inclusive
+  of both start and end.
+
+  Returns:
+    list of (start,end) tuples, in order
+  """
+
+  gaps = []
+  pos = start
+  for r_start, r_end in ranges:
+    if r_end < pos:
+      continue
+    elif r_start > end:
+      break
+
+    if r_start > pos:
+      gaps.append((pos,r_start - 1))
+
+    pos = r_end + 1
+
+  if pos <= end:
+    gaps.append((pos,end))
+
+  return gaps
+
+# Keys used for bookkeeping, shared by all redis caches
+STATS_KEY = "ldcache__stats"
+INDEX_KEY = "ldcache__index__{}"
+SIZES_KEY = "ldcache__sizes__{}"
+BYTES_KEY = "ldcache__bytes__{}"
+SEEN_KEY = "ldcache__seen__{}"
+
+# Evict the least recently used keys for a reference panel until it is within its byte budget.
+#   KEYS: index (zset of key -> last access time), sizes (hash of key -> bytes), bytes (total for the panel),
+#     stats (hash of counters)
+#   ARGV: budget in bytes, suffix of a second key to delete along with each key ("" if none)
+EVICT_SCRIPT = """
+local total = tonumber(redis.call("GET", KEYS[3]) or "0")
+local budget = tonumber(ARGV[1])
+local evicted = 0
+while total > budget do
+  local victim = redis.call("ZRANGE", KEYS[1], 0, 0)[1]
+  if not victim then
+    break
+  end
+
+  local size = tonumber(redis.call("HGET", KEYS[2], victim) or "0")
+  redis.call("DEL", victim)
+  if ARGV[2] ~= "" then
+    redis.call("DEL", victim .. ARGV[2])
+  end
+  redis.call("HDEL", KEYS[2], victim)
+  redis.call("ZREM", KEYS[1], victim)
+  total = redis.call("DECRBY", KEYS[3], size)
+  evicted = evicted + 1
+end
+
+if evicted > 0 then
+  redis.call("HINCRBY", KEYS[4], "evictions", evicted)
+end
+
+return evicted
+"""
+
+# Counters not yet written to redis. These are sent along with the next request this process makes to redis,
+# rather than costing a round trip of their own.
+_pending_stats = Counter()
+_pending_lock = threading.Lock()
+
+def count(name,n=1):
+  with _pending_lock:
+    _pending_stats[name] += n
+
+def cache_stats(redis_client):
+  """
+  Cache counters, summed over all processes.
+
+  Returns:
+    dict: counter -> value
+  """
+
+  with redis_client.pipeline(transaction=False) as pipe:
+    RedisCacheBase.flush_stats(pipe)
+    pipe.hgetall(STATS_KEY)
+    stats = pipe.execute()[-1]
+
+  return {k.decode("utf-8") if isinstance(k,bytes) else k: int(v) for k, v in iteritems(stats)}
+
+class RedisCacheBase(IntervalCache):
+  """
+  Expiration, size accounting and admission shared by the redis caches.
+
+  Keys are expected to be of the form "<reference panel>__<variant>". Each panel has a byte budget; when
+  it is exceeded, the least recently used keys for that panel are evicted. Keys also expire if they haven't
+  been used for a while.
+
+  Subclasses call touch() in every retrieval pipeline, account() in every store transaction, and then
+  evict() after storing.
+  """
+
+  # Suffix of a second redis key holding data for each key (deleted along with it on eviction)
+  DATA_SUFFIX = ""
+
+  def __init__(self,redis_client=None,ttl=None,panel_bytes=None,admit_size=None,doorkeeper_ttl=3600):
+    """
+    Args:
+      redis_client: connected redis client
+      ttl: seconds until a key expires, refreshed every time it is used. None to never expire.
+      panel_bytes: byte budget per reference panel. None for no limit.
+      admit_size: intervals larger than this are only stored if the same key was requested (with an
+        interval of this size) in the last doorkeeper_ttl seconds. None to store everything.
+      doorkeeper_ttl: seconds to remember an interval that was not admitted
+    """
+
     if redis_client is None:
       raise ValueError("Must supply connected redis client when creating cache")
 
     self.red = redis_client
-
-  def store(self,key,start,end,data):
-    # Which intervals have we already stored?
-    redis_itree = self.red.hget(key,"itree")
-    if redis_itree is None:
-      itree = IntervalTree()
+    self.ttl = ttl
+    self.panel_bytes = panel_bytes
+    self.admit_size = admit_size
+    self.doorkeeper_ttl = doorkeeper_ttl
+
+  @staticmethod
+  def panel(key):
+    return key.split("__",1)[0]
+
+  @staticmethod
+  def flush_stats(pipe):
+    with _pending_lock:
+      pending = list(_pending_stats.items())
+      _pending_stats.clear()
+
+    for name, n in pending:
+      pipe.hincrby(STATS_KEY,name,n)
+
+  def record_lookup(self,start,end,gaps):
+    if len(gaps) == 0:
+      count("hits")
+    elif len(gaps) == 1 and gaps[0] == (start,end):
+      count("misses")
     else:
-      itree = loads(redis_itree)
+      count("partial_hits")
+
+  def touch(self,pipe,key,redis_key,flush=True):
+    """
+    Refresh the expiration and LRU position of a key. Pending counters are sent along too, unless flush is False
+    (in a transaction that may be retried, where they would be discarded along with the transaction.)
+    """
 
-    # Add our new interval into the tree
-    interval = Interval(start,end)
-    itree = itree | IntervalTree([interval])
-    itree.merge_overlaps()
+    if self.ttl is not None:
+      pipe.expire(redis_key,self.ttl)
+      if self.DATA_SUFFIX:
+        pipe.expire(redis_key + self.DATA_SUFFIX,self.ttl)
 
-    zset = key + "__zset" # name of the redis sorted set
-    self.red.hmset(key,{
-      "itree": dumps(itree),
-      "zset": zset
-    })
+    if self.panel_bytes is not None:
+      pipe.zadd(INDEX_KEY.format(self.panel(key)),time.time(),redis_key)
+
+    if flush:
+      self.flush_stats(pipe)
+
+  def account(self,pipe,key,redis_key,nbytes):
+    """
+    Record bytes added to a key. Counters stay pending until the next retrieval.
+    """
+
+    panel = self.panel(key)
+    pipe.hincrby(SIZES_KEY.format(panel),redis_key,nbytes)
+    pipe.incrby(BYTES_KEY.format(panel),nbytes)
+    self.touch(pipe,key,redis_key,flush=False)
+
+  def evict(self,key):
+    if self.panel_bytes is None:
+      return 0
+
+    panel = self.panel(key)
+    keys = [INDEX_KEY.format(panel),SIZES_KEY.format(panel),BYTES_KEY.format(panel),STATS_KEY]
+    return self.red.eval(EVICT_SCRIPT,len(keys),*(keys + [self.panel_bytes,self.DATA_SUFFIX]))
+
+  def admit(self,key,start,end):
+    if self.admit_size is None or end - start <= self.admit_size:
+      return True
+
+    # Large windows are often one-off requests. Only store them the second time they're seen.
+    first_time = self.red.set(SEEN_KEY.format(key),1,ex=self.doorkeeper_ttl,nx=True)
+    if first_time:
+      count("rejected")
+      return False
+
+    return True
+
+  def _forget(self,key,redis_key):
+    """
+    Remove a key's size from the panel's accounting (the key itself should be deleted separately.)
+    """
+
+    panel = self.panel(key)
+    sizes = SIZES_KEY.format(panel)
+    size = int(self.red.hget(sizes,redis_key) or 0)
 
-    # Start a redis pipeline. All of these actions are committed to the server in batch and within a single
-    # transaction, rather than executing each one separately over the network.
     pipe = self.red.pipeline()
+    pipe.hdel(sizes,redis_key)
+    pipe.zrem(INDEX_KEY.format(panel),redis_key)
+    pipe.incrby(BYTES_KEY.format(panel),-size)
+    pipe.execute()
+
+class RedisIntervalCache(RedisCacheBase):
+  """
+  Each key is stored as:
+
+    key: hash with fields
+      "ranges": intervals that have been stored, packed as (start,end) int64 pairs (see pack_ranges)
+      "zset": name of the sorted set holding the data
+    key__zset: sorted set of msgpack'd values, scored by position
+
+  See RedisCacheBase for expiration and eviction.
+  """
+
+  DATA_SUFFIX = "__zset"
+
+  def store(self,key,start,end,data):
+    zset = key + "__zset" # name of the redis sorted set
 
-    # Store the data. Each key in the data should be a position, and value can be arbitrary data.
+    # Serialize the data. Each key in the data should be a position, and value can be arbitrary data.
+    members = []
     for k, v in iteritems(data):
       v_serial = v
       if not isinstance(v,str):
         v_serial = msgpack.packb(v,use_bin_type=True)
 
-      pipe.zadd(zset,k,v_serial)
+      members.append((k,v_serial))
+
+    # The ranges and data are written in one transaction. If another request stores data for the same key
+    # between reading the ranges and writing them back, the transaction is aborted and retried, so neither
+    # request's ranges are lost.
+    with self.red.pipeline() as pipe:
+      while True:
+        try:
+          pipe.watch(key)
+          ranges = merge_range(unpack_ranges(pipe.hget(key,"ranges")),start,end)
+
+          pipe.multi()
+          pipe.hmset(key,{
+            "ranges": pack_ranges(ranges),
+            "zset": zset
+          })
+          pipe.hdel(key,"itree")
+          for k, v_serial in members:
+            pipe.zadd(zset,k,v_serial)
+
+          # Approximate size of the new data (re-stored members are counted again)
+          self.account(pipe,key,key,sum(len(v) + 16 for _, v in members))
+          pipe.execute()
+          break
+        except WatchError:
+          continue
+
+    self.evict(key)
+
+  def _fetch(self,key,start,end):
+    """
+    Retrieve the stored ranges for a key, along with all data within [start,end], in one round trip.
 
-    pipe.execute()
+    Returns:
+      list of stored ranges (None if the key has no valid data), data within [start,end]
+    """
 
-  def retrieve(self,key,start,end,force_subinterval=False):
-    # Check if we've tried to store this region before
-    if not self.red.exists(key):
-      return None
+    zset = key + "__zset"
+    pipe = self.red.pipeline()
+    pipe.hmget(key,"ranges","zset")
+    pipe.exists(zset)
+    pipe.zrangebyscore(zset,start,end,withscores=True)
+    self.touch(pipe,key,key)
+    (ranges, zset_field), zset_exists, records = pipe.execute()[:3]
 
-    itree = loads(self.red.hget(key,"itree"))
-    zset = self.red.hget(key,"zset")
+    if ranges is None or zset_field is None:
+      # Never stored, or stored by an older version of this class
+      return None, None
 
-    if not self.red.exists(zset):
+    if not zset_exists:
       # The sorted set was evicted by the LRU mechanism
       # but the master/interval key was not
       self.red.delete(key)
+      self._forget(key,key)
+      return None, None
+
+    data = OrderedDict()
+    for record in records:
+      pos = int(record[1])
+      value = msgpack.unpackb(record[0],raw=False)
+      data[pos] = value
+
+    return unpack_ranges(ranges), data
+
+  def retrieve(self,key,start,end,force_subinterval=False):
+    # Check if we've tried to store this region before
+    ranges, data = self._fetch(key,start,end)
+    if ranges is None:
       return None
 
-    interval = Interval(start,end)
-    if not interval_contained(itree,interval) and not force_subinterval:
+    if len(find_disjoint(ranges,start,end)) > 0 and not force_subinterval:
       # If the region previously calculated is too small, and we're not forcing
       # the return of subintervals, return None to signify a computation is needed.
       return None
 
+    return data
+
+  def retrieve_partial(self,key,start,end):
+    ranges, data = self._fetch(key,start,end)
+    if ranges is None:
+      data, gaps = OrderedDict(), [(start,end)]
+    else:
+      gaps = find_disjoint(ranges,start,end)
+
+    self.record_lookup(start,end,gaps)
+    return data, gaps
+
+  def delete(self,key):
+    self.red.delete(key,key + "__zset")
+    self._forget(key,key)
+
+class RedisBlockCache(RedisCacheBase):
+  """
+  Stores LD results as binary blocks rather than one sorted set member per variant.
+
+  Positions are bucketed into blocks of BLOCK_SIZE bp. Each block holds the variants within it, sorted by
+  position, as:
+
+    uint32           n (number of variants)
+    int32[n]         positions
+    float32[n]       r2
+    uint32[n + 1]    offsets of each variant name within the name table
+    bytes            name table (utf-8 names, each followed by a newline)
+
+  All blocks for a key are fields of a single hash, along with the stored ranges:
+
+    blk__key: hash with fields
+      "ranges": intervals that have been stored, packed as (start,end) int64 pairs (see pack_ranges)
+      "b<n>": block n, covering positions [n * BLOCK_SIZE, (n + 1) * BLOCK_SIZE)
+
+  A retrieval is then a single HMGET of a few blocks, sliced with NumPy.
+
+  Values must be dictionaries with "name2" and "rsquare" (LD pairs), r2 is stored with single precision.
+
+  See RedisCacheBase for expiration and eviction.
+  """
+
+  BLOCK_SIZE = 100000
+  PREFIX = "blk__"
+
+  @staticmethod
+  def encode_block(positions,rsquare,names):
+    encoded = [(x + "\n").encode("utf-8") for x in names]
+    offsets = np.zeros(len(encoded) + 1,dtype="<u4")
+    offsets[1:] = np.cumsum([len(x) for x in encoded])
+
+    return b"".join([
+      struct.pack("<I",len(positions)),
+      np.asarray(positions,dtype="<i4").tobytes(),
+      np.asarray(rsquare,dtype="<f4").tobytes(),
+      offsets.tobytes(),
+      b"".join(encoded)
+    ])
+
+  @staticmethod
+  def decode_block(data):
+    """
+    Returns:
+      positions (int32 array), rsquare (float32 array), offsets (uint32 array), name table (bytes)
+    """
+
+    n = struct.unpack_from("<I",data)[0]
+    offset = 4
+    positions = np.frombuffer(data,dtype="<i4",count=n,offset=offset)
+    offset += 4 * n
+    rsquare = np.frombuffer(data,dtype="<f4",count=n,offset=offset)
+    offset += 4 * n
+    offsets = np.frombuffer(data,dtype="<u4",count=n + 1,offset=offset)
+    offset += 4 * (n + 1)
+    return positions, rsquare, offsets, data[offset:]
+
+  def _fields(self,start,end):
+    return ["b{}".format(b) for b in range(start // self.BLOCK_SIZE,end // self.BLOCK_SIZE + 1)]
+
+  def _merge_block(self,block,new):
+    """
+    Add new data to a block. As with RedisIntervalCache, stored data is never removed, but new data replaces
+    existing data at the same position.
+
+    Args:
+      block: encoded block (or None)
+      new: list of (position,name,rsquare) tuples within this block
+    """
+
+    positions, rsquare, names = [], [], []
+    if block is not None:
+      old_pos, old_r2, offsets, table = self.decode_block(block)
+      old_names = table.decode("utf-8").split("\n")
+      keep = np.flatnonzero(~np.isin(old_pos,[x[0] for x in new]))
+      positions = old_pos[keep].tolist()
+      rsquare = old_r2[keep].tolist()
+      names = [old_names[i] for i in keep]
+
+    for pos, name, r2 in new:
+      positions.append(pos)
+      names.append(name)
+      rsquare.append(r2)
+
+    order = np.argsort(positions,kind="mergesort")
+    return self.encode_block(
+      np.asarray(positions,dtype="<i4")[order],
+      np.asarray(rsquare,dtype="<f4")[order],
+      [names[i] for i in order]
+    )
+
+  def store(self,key,start,end,data):
+    redis_key = self.PREFIX + key
+
+    # Split new data by block
+    by_block = {}
+    for pos, value in iteritems(data):
+      field = "b{}".format(pos // self.BLOCK_SIZE)
+      by_block.setdefault(field,[]).append((pos,value["name2"],value["rsquare"]))
+
+    # Only blocks receiving new data need to be rewritten
+    fields = sorted(by_block)
+    with self.red.pipeline() as pipe:
+      while True:
+        try:
+          pipe.watch(redis_key)
+          current = pipe.hmget(redis_key,["ranges"] + fields)
+          ranges = merge_range(unpack_ranges(current[0]),start,end)
+
+          updates = {"ranges": pack_ranges(ranges)}
+          for field, block in zip(fields,current[1:]):
+            updates[field] = self._merge_block(block,by_block[field])
+
+          nbytes = sum(len(v) for v in updates.values()) - sum(len(v) for v in current if v is not None)
+
+          pipe.multi()
+          pipe.hmset(redis_key,updates)
+          self.account(pipe,key,redis_key,nbytes)
+          pipe.execute()
+          break
+        except WatchError:
+          continue
+
+    self.evict(key)
+
+  def _retrieve(self,key,start,end):
+    """
+    Returns:
+      list of stored ranges (None if nothing is stored), data within [start,end]
+    """
+
+    fields = self._fields(start,end)
+    pipe = self.red.pipeline()
+    pipe.hmget(self.PREFIX + key,["ranges"] + fields)
+    self.touch(pipe,key,self.PREFIX + key)
+    result = pipe.execute()[0]
+    if result[0] is None:
+      return None, None
+
     data = OrderedDict()
-    for record in self.red.zrangebyscore(zset,start,end,withscores=True):
-      pos = int(record[1])
-      value = msgpack.unpackb(record[0],raw=False)
-      data[pos] = value
+    for block in result[1:]:
+      if block is None:
+        continue
+
+      positions, rsquare, offsets, table = self.decode_block(block)
+      lo = np.searchsorted(positions,start,side="left")
+      hi = np.searchsorted(positions,end,side="right")
+      if hi <= lo:
+        continue
+
+      names = table[offsets[lo]:offsets[hi] - 1].decode("utf-8").split("\n")
+      for pos, name, r2 in zip(positions[lo:hi].tolist(),names,rsquare[lo:hi].tolist()):
+        data[pos] = {"name2": name, "rsquare": r2}
+
+    return unpack_ranges(result[0]), data
+
+  def retrieve(self,key,start,end,force_subinterval=False):
+    ranges, data = self._retrieve(key,start,end)
+    if ranges is None:
+      return None
+
+    if len(find_disjoint(ranges,start,end)) > 0 and not force_subinterval:
+      return None
 
     return data
 
+  def retrieve_partial(self,key,start,end):
+    ranges, data = self._retrieve(key,start,end)
+    if ranges is None:
+      data, gaps = OrderedDict(), [(start,end)]
+    else:
+      gaps = find_disjoint(ranges,start,end)
+
+    self.record_lookup(start,end,gaps)
+    return data, gaps
+
+  def delete(self,key):
+    self.red.delete(self.PREFIX + key)
+    self._forget(key,self.PREFIX + key)
+
+class MemoryIntervalCache(IntervalCache):
+  """
+  In-process LRU cache, for reference variants that are requested over and over by the same worker.
+
+  Entries expire ttl seconds after they were stored, and the least recently used keys are dropped when
+  the (approximate) size of all entries exceeds max_bytes. The cache can be shared between threads.
+
+  Retrieved data is shared with the cache and should not be modified.
+  """
+
+  # Rough memory cost of one cached value, in addition to the length of its strings
+  VALUE_OVERHEAD = 200
+
+  class Entry(object):
+    __slots__ = ("ranges","positions","values","nbytes","expires")
+
+    def __init__(self,expires):
+      self.ranges = []
+      self.positions = []
+      self.values = []
+      self.nbytes = 0
+      self.expires = expires
+
+  def __init__(self,max_bytes=64 * 1024**2,ttl=60):
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.nbytes = 0
+    self.lock = threading.Lock()
+
+  def _size(self,value):
+    if isinstance(value,dict):
+      return self.VALUE_OVERHEAD + sum(len(v) for v in value.values() if isinstance(v,str))
+
+    return self.VALUE_OVERHEAD
+
+  def _get(self,key):
+    """
+    Live entry for a key (or None), marked as most recently used. Must be called with the lock held.
+    """
+
+    entry = self.entries.get(key)
+    if entry is None:
+      return None
+
+    if entry.expires < time.time():
+      self._remove(key)
+      return None
+
+    self.entries.move_to_end(key)
+    return entry
+
+  def _remove(self,key):
+    entry = self.entries.pop(key,None)
+    if entry is not None:
+      self.nbytes -= entry.nbytes
+
+  def store(self,key,start,end,data):
+    with self.lock:
+      entry = self._get(key)
+      if entry is None:
+        entry = self.entries[key] = MemoryIntervalCache.Entry(time.time() + self.ttl)
+
+      merged = dict(zip(entry.positions,entry.values))
+      merged.update(data)
+      entry.positions = sorted(merged)
+      entry.values = [merged[p] for p in entry.positions]
+      entry.ranges = merge_range(entry.ranges,start,end)
+
+      nbytes = sum(self._size(v) for v in entry.values)
+      self.nbytes += nbytes - entry.nbytes
+      entry.nbytes = nbytes
+
+      # Drop least recently used keys until within the memory limit
+      while self.nbytes > self.max_bytes and len(self.entries) > 0:
+        self._remove(next(iter(self.entries)))
+
+  def _slice(self,entry,start,end):
+    lo = bisect_left(entry.positions,start)
+    hi = bisect_right(entry.positions,end)
+
+    # Plain dicts keep insertion order, and are much quicker to build than OrderedDict
+    return dict(zip(entry.positions[lo:hi],entry.values[lo:hi]))
+
+  def retrieve(self,key,start,end,force_subinterval=False):
+    with self.lock:
+      entry = self._get(key)
+      if entry is None:
+        return None
+
+      if len(find_disjoint(entry.ranges,start,end)) > 0 and not force_subinterval:
+        return None
+
+      return self._slice(entry,start,end)
+
+  def retrieve_partial(self,key,start,end):
+    with self.lock:
+      entry = self._get(key)
+      if entry is None:
+        return OrderedDict(), [(start,end)]
+
+      return self._slice(entry,start,end), find_disjoint(entry.ranges,start,end)
+
+  def delete(self,key):
+    with self.lock:
+      self._remove(key)
+
+class TwoTierCache(IntervalCache):
+  """
+  Combines a small, fast cache (e.g. MemoryIntervalCache) with a larger shared one (e.g. RedisIntervalCache.)
+
+  Lookups that are entirely covered by the first tier don't touch the second. Otherwise the second tier is
+  asked for the whole interval, and whatever it had is copied into the first tier. Stores go to both.
+  """
+
+  def __init__(self,l1,l2):
+    self.l1 = l1
+    self.l2 = l2
+
+  def store(self,key,start,end,data):
+    self.l2.store(key,start,end,data)
+    self.l1.store(key,start,end,data)
+
+  def retrieve(self,key,start,end,force_subinterval=False):
+    data, gaps = self.retrieve_partial(key,start,end)
+    if len(gaps) > 0 and not force_subinterval:
+      return None
+
+    return data
+
+  def retrieve_partial(self,key,start,end):
+    data, gaps = self.l1.retrieve_partial(key,start,end)
+    if len(gaps) == 0:
+      count("l1_hits")
+      return data, gaps
+
+    data, gaps = self.l2.retrieve_partial(key,start,end)
+
+    # Copy the parts the second tier had into the first
+    covered = find_disjoint(gaps,start,end)
+    for c_start, c_end in covered:
+      self.l1.store(key,c_start,c_end,OrderedDict((p,v) for p, v in iteritems(data) if c_start <= p <= c_end))
+
+    return data, gaps
+
+  def admit(self,key,start,end):
+    return self.l2.admit(key,start,end)
+
   def delete(self,key):
-    zset = self.red.hget(key,"zset")
-    self.red.delete(key)
-    self.red.delete(zset)
+    self.l2.delete(key)
+    self.l1.delete(key)
+
+# In-process cache, shared by all threads of a worker
+_memory_cache = None
+_memory_cache_lock = threading.Lock()
+
+def shared_memory_cache(max_bytes,ttl):
+  """
+  Returns:
+    MemoryIntervalCache for this process (created on first use)
+  """
+
+  global _memory_cache
+  with _memory_cache_lock:
+    if _memory_cache is None:
+      _memory_cache = MemoryIntervalCache(max_bytes,ttl)
+
+  return _memory_cache
+
+# Cache implementations that can be selected with the LD_CACHE_BACKEND setting
+LD_CACHE_BACKENDS = {
+  "zset": RedisIntervalCache,
+  "blocks": RedisBlockCache
+}
@@ -0,0 +1,211 @@
+from flask import current_app, request
+from locuszoom.api.region_cache import cache
+import zlib
+
+# Optional codecs, only offered if the module is installed
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+class GzipStream(object):
+  def __init__(self,level):
+    # wbits = 16 + 15 writes a gzip header and trailer
+    self.obj = zlib.compressobj(level,zlib.DEFLATED,31)
+
+  def compress(self,data):
+    return self.obj.compress(data)
+
+  def finish(self):
+    return self.obj.flush()
+
+class BrotliStream(object):
+  def __init__(self,level):
+    self.obj = brotli.Compressor(quality=level)
+
+  def compress(self,data):
+    return self.obj.process(data)
+
+  def finish(self):
+    return self.obj.finish()
+
+class ZstdStream(object):
+  def __init__(self,level):
+    self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+  def compress(self,data):
+    return self.obj.compress(data)
+
+  def finish(self):
+    return self.obj.flush()
+
+# Content-Encoding --> compressor, for each codec that is available
+CODECS = {"gzip": GzipStream}
+if brotli is not None:
+  CODECS["br"] = BrotliStream
+if zstandard is not None:
+  CODECS["zstd"] = ZstdStream
+
+DEFAULT_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+
+def compressor(encoding):
+  level = current_app.config.get("COMPRESS_LEVELS",{}).get(encoding,DEFAULT_LEVELS[encoding])
+  return CODECS[encoding](level)
+
+def compress(data,encoding):
+  stream = compressor(encoding)
+  return stream.compress(data) + stream.finish()
+
+def negotiate():
+  """
+  Choose a content encoding for the current request from its Accept-Encoding header. Among the encodings the
+  client accepts equally, the first one in COMPRESS_ALGORITHMS wins.
+
+  Returns:
+    string: content encoding, or None if the response should not be compressed
+  """
+
+  offered = [x for x in current_app.config.get("COMPRESS_ALGORITHMS",["zstd","br","gzip"]) if x in CODECS]
+  return request.accept_encodings.best_match(offered)
+
+def encoded_etag(etag,encoding):
+  """
+  Entity tag for a response compressed with an encoding. Each encoding is a different representation, so a strong
+  ETag must differ between them (RFC 7232 section 2.3.3.) conditional.is_fresh() accepts this form.
+  """
+
+  return "{}-{}".format(etag,encoding)
+
+def cache_key(etag,encoding):
+  return "compressed__{}__{}".format(etag,encoding)
+
+def cached_response(etag):
+  """
+  Response previously compressed for this entity tag and the encoding accepted by the client, if one is in the
+  cache. Serving it skips both the queries and compression.
+  """
+
+  if etag is None:
+    return None
+
+  encoding = negotiate()
+  if encoding is None:
+    return None
+
+  cached = cache.get(cache_key(etag,encoding))
+  if cached is None:
+    return None
+
+  mimetype, data = cached
+  resp = current_app.response_class(data,mimetype=mimetype)
+  resp.headers["Content-Encoding"] = encoding
+  resp.vary.add("Accept-Encoding")
+  return resp
+
+def should_compress(resp):
+  if resp.status_code < 200 or resp.status_code >= 300 or resp.status_code == 204:
+    return False
+
+  if "Content-Encoding" in resp.headers or resp.direct_passthrough:
+    return False
+
+  if resp.mimetype not in current_app.config.get("COMPRESS_MIMETYPES",["application/json","application/vnd.apache.arrow.stream"]):
+    return False
+
+  # Streamed responses may not know their length, in which case they are always compressed
+  length = resp.content_length
+  if length is not None and length < current_app.config.get("COMPRESS_MIN_SIZE",500):
+    return False
+
+  return True
+
+def compress_stream(chunks,encoding,mimetype,etag=None):
+  """
+  Compress a response body as it is generated. If etag is given, the compressed body is added to the cache
+  once complete (unless it is larger than COMPRESS_CACHE_MAX_SIZE.)
+
+  The body is generated after the request has finished, so everything needed from the app is looked up now.
+  """
+
+  stream = compressor(encoding)
+  max_size = current_app.config.get("COMPRESS_CACHE_MAX_SIZE",8 * 1024**2)
+  store = cache.cache if etag is not None else None
+
+  def generate():
+    keep = [] if store is not None else None
+    size = 0
+
+    for chunk in chunks:
+      if isinstance(chunk,str):
+        chunk = chunk.encode("utf-8")
+
+      out = stream.compress(chunk)
+      if out:
+        size += len(out)
+        if keep is not None:
+          keep = keep if size <= max_size else None
+        if keep is not None:
+          keep.append(out)
+
+        yield out
+
+    out = stream.finish()
+    if keep is not None and size + len(out) <= max_size:
+      keep.append(out)
+      store.set(cache_key(etag,encoding),(mimetype,b"".join(keep)))
+
+    yield out
+
+  return generate()
+
+def compress_body(resp,encoding):
+  """
+  Replace the body of a response with its compressed form. Immutable responses are also stored in the cache.
+  """
+
+  etag, weak = resp.get_etag()
+  if etag is None or weak or not resp.cache_control.public:
+    etag = None
+
+  length = resp.content_length
+  if resp.is_streamed and (length is None or length > current_app.config.get("COMPRESS_STREAM_SIZE",1024**2)):
+    # Compress chunk by chunk as the body is generated, the final length isn't known in advance
+    resp.response = compress_stream(resp.response,encoding,resp.mimetype,etag)
+    resp.headers.pop("Content-Length",None)
+  else:
+    data = compress(resp.get_data(),encoding)
+    resp.set_data(data)
+    if etag is not None and len(data) <= current_app.config.get("COMPRESS_CACHE_MAX_SIZE",8 * 1024**2):
+      cache.set(cache_key(etag,encoding),(resp.mimetype,data))
+
+  resp.headers["Content-Encoding"] = encoding
+
+def compress_response(resp):
+  """
+  Compress a response with the encoding negotiated with the client.
+
+  Responses for immutable data (public, with an ETag) are also stored compressed in the cache, see
+  cached_response(). Compressed responses get the content encoding appended to their ETag.
+  """
+
+  resp.vary.add("Accept-Encoding")
+  if should_compress(resp):
+    encoding = negotiate()
+    if encoding is not None:
+      compress_body(resp,encoding)
+
+  # Also covers responses that were already compressed (see cached_response)
+  encoding = resp.headers.get("Content-Encoding")
+  etag, weak = resp.get_etag()
+  if encoding is not None and etag is not None and not weak:
+    resp.set_etag(encoded_etag(etag,encoding))
+
+  return resp
+
+def init_app(app):
+  app.after_request(compress_response)
@@ -0,0 +1,189 @@
+from flask import current_app, g, request
+from hashlib import sha1
+from locuszoom.api.db import execute_prepared
+from locuszoom.api.uriparsing import parse_filter
+import threading
+import time
+
+# Cache-Control header by endpoint family, when CACHE_CONTROL is not configured
+DEFAULT_CACHE_CONTROL = {
+  "annotation": "public, max-age=86400",
+  "statistic": "public, max-age=3600"
+}
+
+class DatasetVersions(object):
+  """
+  Version of each dataset described by a master table (rest.assoc_master, rest.gene_master, ...)
+
+  Datasets are loaded once and never modified afterward, so the version is simply a hash of the dataset's row in
+  the master table. It changes if a dataset is reloaded under the same id with different metadata (version,
+  date inserted, etc.) Versions are remembered by each worker process for DATASET_VERSION_TTL seconds.
+  """
+
+  def __init__(self,master_table):
+    self.master_table = master_table
+    self.lock = threading.Lock()
+    self.versions = {}
+
+  def get(self,ids):
+    """
+    Args:
+      ids: list of dataset ids
+
+    Returns:
+      dict: dataset id --> version (None if the dataset does not exist)
+    """
+
+    ttl = current_app.config.get("DATASET_VERSION_TTL",60)
+    now = time.time()
+    versions = {}
+    missing = []
+
+    with self.lock:
+      for dbid in ids:
+        entry = self.versions.get(dbid)
+        if entry is not None and entry[1] > now:
+          versions[dbid] = entry[0]
+        else:
+          missing.append(dbid)
+
+    if missing:
+      sql = "SELECT id, md5(m::text) FROM {} m WHERE id = ANY (:p1)".format(self.master_table)
+      found = dict(execute_prepared(g.db,sql,{"p1": missing}).fetchall())
+
+      with self.lock:
+        for dbid in missing:
+          versions[dbid] = found.get(dbid)
+          self.versions[dbid] = (versions[dbid],now + ttl)
+
+    return versions
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+def dataset_versions(master_table):
+  """
+  Shared DatasetVersions for a master table.
+  """
+
+  with _versions_lock:
+    versions = _versions.get(master_table)
+    if versions is None:
+      versions = _versions[master_table] = DatasetVersions(master_table)
+
+  return versions
+
+def normalize_filter(filter_str):
+  """
+  Canonical form of a filter string, so that equivalent filters ("a eq 1 and b eq 2", "b = 2  AND a eq 1")
+  produce the same ETag.
+  """
+
+  if filter_str is None:
+    return ""
+
+  terms = parse_filter(filter_str)
+  statements = ["{} {} {!r}".format(t.lhs,"eq" if t.comp == "=" else t.comp,t.rhs) for t in terms if not isinstance(t,str)]
+  if all(t == "and" for t in terms if isinstance(t,str)):
+    # Order doesn't matter when all terms are joined by "and"
+    return " and ".join(sorted(statements))
+
+  return " ".join(t if isinstance(t,str) else statements.pop(0) for t in terms)
+
+def dataset_etag(master_table,ids,filter_str=None):
+  """
+  Entity tag for the current request to an endpoint that returns data from immutable datasets.
+
+  The tag is computed before running any queries, from the route, the filter (normalized), all other query
+  parameters (fields, format, ...), and the version of each dataset.
+
+  Args:
+    master_table: table describing the datasets (see DatasetVersions)
+    ids: dataset id or list of dataset ids being read
+    filter_str: filter actually applied, if different from the one given in the request (e.g. after adding a
+      recommended dataset id)
+
+  Returns:
+    string: entity tag, or None if the datasets could not be determined
+  """
+
+  if ids is None:
+    return None
+
+  if not isinstance(ids,(list,tuple)):
+    ids = [ids]
+
+  if len(ids) == 0 or not all(isinstance(v,int) and not isinstance(v,bool) for v in ids):
+    return None
+
+  if filter_str is None:
+    filter_str = request.args.get("filter")
+
+  versions = dataset_versions(master_table).get(ids)
+
+  h = sha1()
+  h.update(current_app.config.get("ETAG_SALT","").encode("utf-8"))
+  h.update(b"\0" + request.path.encode("utf-8"))
+  h.update(b"\0" + normalize_filter(filter_str).encode("utf-8"))
+  for k, v in sorted(request.args.items(multi=True)):
+    if k == "filter":
+      continue
+    if k in ("fields","sort"):
+      v = ",".join(x.strip() for x in v.split(","))
+
+    h.update("\0{}={}".format(k,v).encode("utf-8"))
+  for dbid in sorted(versions):
+    h.update("\0{}:{}".format(dbid,versions[dbid]).encode("utf-8"))
+
+  return h.hexdigest()
+
+def matching_etag(etag):
+  """
+  Entity tag in If-None-Match for the response with this entity tag, in any content encoding. Compressed responses
+  carry the tag with the encoding appended (see compression.encoded_etag.)
+
+  Returns:
+    string: the tag given by the client, or None if there is no match
+  """
+
+  if etag is None:
+    return None
+
+  if_none_match = request.if_none_match
+  if if_none_match.star_tag:
+    return etag
+
+  for tag in if_none_match.as_set(include_weak=True):
+    if tag == etag or tag.rpartition("-")[0] == etag:
+      return tag
+
+  return None
+
+def is_fresh(etag):
+  """
+  Does the client already have the response with this entity tag? (If-None-Match)
+  """
+
+  return matching_etag(etag) is not None
+
+def add_headers(resp,etag,family):
+  """
+  Set ETag and Cache-Control (from CACHE_CONTROL for the endpoint family) on a response.
+  """
+
+  if etag is not None:
+    resp.set_etag(etag)
+
+    cache_control = current_app.config.get("CACHE_CONTROL",DEFAULT_CACHE_CONTROL).get(family)
+    if cache_control is not None:
+      resp.headers["Cache-Control"] = cache_control
+
+  return resp
+
+def not_modified(etag,family):
+  """
+  304 response telling the client to use the copy it has.
+  """
+
+  # Repeat the tag the client has, which names the encoding it was sent with
+  return add_headers(current_app.response_class(status=304),matching_etag(etag) or etag,family)
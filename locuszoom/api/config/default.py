@@ -16,20 +16,119 @@ REDIS_HOST = "localhost"
 REDIS_PORT = "6379"
 REDIS_DB = 1
 
+# Maximum number of redis connections per worker process. Requests wait up to REDIS_POOL_TIMEOUT seconds for a
+# connection when all are in use.
+REDIS_POOL_SIZE = 10
+REDIS_POOL_TIMEOUT = 5
+
+# Seconds before giving up on connecting to or reading from redis
+REDIS_SOCKET_TIMEOUT = 5
+
 # Name passed along to Postgres for application_name
 DB_APP_NAME = "locuszoom-api-dev-server"
 
-# Cache settings
+# Cache settings (Flask-Caching) for rows from the annotation endpoints (recombination rates, genes, intervals,
+# GWAS catalog.) Rows are cached in chunks of the genome, each chunk is one cache entry. Set to None to disable.
 CACHE_CONFIG = dict(
   CACHE_TYPE = "filesystem",
   CACHE_DIR = "/path/to/your/cache",
-  CACHE_THRESHOLD = 1000,
+  CACHE_THRESHOLD = 20000,
   CACHE_DEFAULT_TIMEOUT = 2592000 # 30 days
 )
 
+# Size (in bp) of the chunks of annotation rows that are cached. Requests spanning more than REGION_CACHE_MAX_CHUNKS
+# chunks go straight to the database.
+REGION_CACHE_CHUNK_SIZE = 250000
+REGION_CACHE_MAX_CHUNKS = 40
+
+# Seconds that each worker process remembers the version of a dataset. Cached rows and ETags include the version,
+# so reloading a dataset under the same id takes effect after this long.
+DATASET_VERSION_TTL = 60
+
+# Serve recombination rate windows from maps held in memory by each worker process (loaded per chromosome on first
+# use, about 25 bytes per point.) Memory used is reported by /status.
+RECOMB_MAPS = True
+
+# Answer gene requests for a region from an index of genes (already encoded as JSON) held in memory by each worker
+# process. Chromosomes are loaded on first use and kept up to GENE_INDEX_MAX_BYTES, least recently used first out.
+GENE_INDEX = True
+GENE_INDEX_MAX_BYTES = 256 * 1024**2
+
+# Cache-Control header for responses from dataset endpoints, by endpoint family. These responses also carry an ETag,
+# so clients (and the CDN) can cheaply revalidate once max-age has passed.
+CACHE_CONTROL = {
+  "annotation": "public, max-age=86400",
+  "statistic": "public, max-age=3600"
+}
+
+# Change this to invalidate every ETag, e.g. when the format of responses changes.
+ETAG_SALT = "1"
+
+# Response compression. The first of COMPRESS_ALGORITHMS accepted by the client is used (brotli and zstd only if
+# the modules are installed.) Responses smaller than COMPRESS_MIN_SIZE bytes are sent uncompressed.
+COMPRESS_ALGORITHMS = ["zstd", "br", "gzip"]
+COMPRESS_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+COMPRESS_MIN_SIZE = 500
+COMPRESS_MIMETYPES = ["application/json", "application/vnd.apache.arrow.stream", "text/html", "text/plain", "text/csv"]
+
+# Streamed responses larger than this (or of unknown size) are compressed as they are sent, without a Content-Length.
+# Smaller ones are compressed all at once.
+COMPRESS_STREAM_SIZE = 1024**2
+
+# Responses for immutable datasets (those with an ETag) are kept in the cache (CACHE_CONFIG) after compression, and
+# served from there to later requests. Compressed responses larger than this are not kept.
+COMPRESS_CACHE_MAX_SIZE = 8 * 1024**2
+
+# LD server (computes LD on request, results are cached in redis)
+LD_SERVER_URL = "http://portaldev.sph.umich.edu/api_ld/ld"
+
+# Seconds to wait when (connecting, reading a response) from the LD server
+LD_SERVER_TIMEOUT = (5, 60)
+
+# Maximum number of keep-alive connections to the LD server per worker process
+LD_SERVER_POOL_SIZE = 10
+
+# How LD results are stored in redis:
+#   "zset": one sorted set member per variant
+#   "blocks": binary blocks of variants, bucketed by position (more compact, faster to retrieve)
+LD_CACHE_BACKEND = "zset"
+
+# Seconds until LD results expire from the cache if they are not used again
+LD_CACHE_TTL = 14 * 24 * 3600
+
+# Maximum bytes of LD results cached per reference panel. The least recently used variants are evicted
+# first. None for no limit (rely on redis' maxmemory policy.)
+LD_CACHE_PANEL_BYTES = 2 * 1024**3
+
+# LD windows larger than this (in bp) are only cached if the same reference variant was requested with a
+# large window within the last LD_CACHE_DOORKEEPER_TTL seconds. This keeps one-off requests for very large
+# windows from pushing out commonly used data. None to cache everything.
+LD_CACHE_ADMIT_SIZE = int(1.5E6)
+LD_CACHE_DOORKEEPER_TTL = 3600
+
+# Size (in bytes) of an in-process cache of LD results, checked before redis. Each worker process has its own.
+# Entries are kept for at most LD_MEMORY_CACHE_TTL seconds. Set to 0 to disable.
+LD_MEMORY_CACHE_BYTES = 64 * 1024**2
+LD_MEMORY_CACHE_TTL = 60
+
+# When only parts of an LD region are cached, the missing parts are requested separately from the LD server.
+# If there are more gaps than this, everything from the first to last gap is requested at once.
+LD_MAX_GAPS = 4
+
 # Maximum distance from a reference variant that we will allow
 # for LD calculations
 LD_MAX_FLANK = int(3E6)
 
 # Maximum number of records that can be retrieved at once.
 MAX_RECORDS = 100000
+
+# Number of rows fetched from the database at a time when reading large result sets
+# (server-side cursors are used for association, interval and SNP results.)
+FETCH_BATCH_SIZE = 5000
+
+# Run queries as prepared statements, cached per database connection. Disable this if connecting through a
+# pooler in transaction mode (e.g. pgbouncer), where statements can't outlive a transaction.
+PREPARED_STATEMENTS = True
+
+# Maximum number of prepared statements kept per database connection
+PREPARED_STATEMENTS_MAX = 200
@@ -1,6 +1,12 @@
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from collections import OrderedDict
+from hashlib import sha1
+from sqlalchemy import create_engine, text
 from sqlalchemy.engine.url import URL
 from flask import current_app, g
+import re
+import threading
+import time
 #import psycopg2
 #import math
 
@@ -21,11 +27,72 @@ from flask import current_app, g
 # Store SQLAlchemy engine at global scope
 engine = None
 
+class PoolStats(object):
+  """
+  Counters for connections checked out of the engine's pool by this worker process.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.checkouts = 0
+    self.wait_time = 0.0
+    self.max_wait_time = 0.0
+
+  def record_checkout(self,wait):
+    with self.lock:
+      self.checkouts += 1
+      self.wait_time += wait
+      self.max_wait_time = max(self.max_wait_time,wait)
+
+  def to_dict(self):
+    with self.lock:
+      return {
+        "size": engine.pool.size(),
+        "checked_out": engine.pool.checkedout(),
+        "checkouts": self.checkouts,
+        "wait_time_total": round(self.wait_time,6),
+        "wait_time_mean": round(self.wait_time / self.checkouts,6) if self.checkouts > 0 else 0.0,
+        "wait_time_max": round(self.max_wait_time,6)
+      }
+
+pool_stats = PoolStats()
+
+class LazyConnection(object):
+  """
+  Stands in for a SQLAlchemy connection, but only checks a connection out of the pool the first time it is
+  used. Requests that never query the database (status, cache hits, etc.) then don't hold up the
+  requests that do.
+  """
+
+  def __init__(self,engine):
+    self._engine = engine
+    self._con = None
+
+  @property
+  def checked_out(self):
+    return self._con is not None
+
+  def _connect(self):
+    if self._con is None:
+      start = time.perf_counter()
+      self._con = self._engine.connect()
+      pool_stats.record_checkout(time.perf_counter() - start)
+
+    return self._con
+
+  def __getattr__(self,name):
+    return getattr(self._connect(),name)
+
+  def close(self):
+    if self._con is not None:
+      self._con.close()
+      self._con = None
+
 def before_request():
   db = getattr(g,"db",None)
   if db is None:
-    # Create database connection
-    db = engine.connect()
+    # Database connection, checked out of the pool when first used
+    db = LazyConnection(engine)
 
   # Assign to app context
   g.db = db
@@ -37,6 +104,148 @@ def before_request():
         "grch38": {"db_snp": 17, "genes": 1}}
     g.build_id = build_id
 
+@contextmanager
+def server_side_cursor(con, batch_size=None):
+  """
+  Execute queries using a server-side (named) cursor.
+
+  Rows are then transferred from postgres as they are fetched, rather than the entire result set being loaded into
+  client memory when the query is executed. Named cursors only exist within a transaction, so the connection
+  is switched out of autocommit mode for the duration of the block.
+
+  Example:
+
+    with server_side_cursor(g.db, 5000) as con:
+      cur = con.execute(text(sql), params)
+      for rows in iter_batches(cur, 5000):
+        ...
+
+  Args:
+    con: SQLAlchemy connection
+    batch_size: maximum number of rows to buffer from the server at a time
+
+  Returns:
+    connection (context manager) on which to execute queries
+  """
+
+  if batch_size is None:
+    batch_size = current_app.config.get("FETCH_BATCH_SIZE", 5000)
+
+  stream = con.execution_options(
+    isolation_level = "READ COMMITTED",
+    stream_results = True,
+    max_row_buffer = batch_size
+  )
+
+  try:
+    with stream.begin():
+      yield stream
+  finally:
+    con.execution_options(isolation_level="AUTOCOMMIT")
+
+def _array_literal(values):
+  """
+  Format a list of strings as a postgres array literal, e.g. {"a","b"}. Unlike ARRAY['a','b'] (which is
+  always text[]), the literal takes on the type of the column it is compared against, as the individual values
+  would have in col IN ('a','b').
+  """
+
+  quoted = ('"{}"'.format(v.replace("\\", "\\\\").replace('"', '\\"')) for v in values)
+  return "{" + ",".join(quoted) + "}"
+
+def _bind_param(value):
+  """
+  Work out how to pass a bind value to a prepared statement.
+
+  Parameter types are inferred from the column when the statement is prepared, which is what we want for
+  integers and strings. Floats are cast to numeric so that e.g. "position le 1.5" is not rounded to a bigint.
+
+  Returns:
+    (cast, value) tuple, or None if the value can't be passed to a prepared statement (mixed type lists)
+  """
+
+  if isinstance(value, float):
+    return "::numeric", value
+  elif isinstance(value, (int, str)):
+    return "", value
+  elif isinstance(value, (list, tuple)):
+    kinds = set(type(v) for v in value)
+    if kinds <= {int}:
+      return "", list(value)
+    elif kinds <= {int, float}:
+      return "::numeric[]", list(value)
+    elif kinds <= {str}:
+      return "", _array_literal(value)
+
+  return None
+
+def execute_prepared(con, sql, params):
+  """
+  Execute a query as a prepared statement.
+
+  Each distinct SQL string is prepared once per database connection (connections are pooled, so they outlive
+  the request), and executed by name afterward. This skips parsing and planning the query on every request.
+  The SQL should be generated with SQLCompiler.to_sql(..., canonical=True) so that the text does not depend on
+  the values being queried.
+
+  If PREPARED_STATEMENTS is disabled, or the parameters can't be bound to a prepared statement, the query
+  is executed normally.
+
+  Args:
+    con: SQLAlchemy connection
+    sql: SQL statement with named parameters :p1, :p2, ... :pN
+    params: dictionary of parameter values
+
+  Returns:
+    SQLAlchemy result proxy
+  """
+
+  binds = {}
+  for name, value in params.items():
+    bind = _bind_param(value)
+    if bind is None or re.match(r"p\d+$", name) is None:
+      return con.execute(text(sql), params)
+
+    binds[name] = bind
+
+  if not current_app.config.get("PREPARED_STATEMENTS", True):
+    return con.execute(text(sql), {k: v for k, (_, v) in binds.items()})
+
+  # Positional parameters ($1, $2, ...) in the order of their names
+  order = sorted(binds, key=lambda x: int(x[1:]))
+  position = {name: i + 1 for i, name in enumerate(order)}
+  pg_sql = re.sub(
+    r":(p\d+)\b",
+    lambda m: "${}{}".format(position[m.group(1)], binds[m.group(1)][0]),
+    sql
+  )
+
+  stmt = "lzapi_" + sha1(pg_sql.encode("utf-8")).hexdigest()[:24]
+  prepared = con.info.setdefault("prepared_statements", OrderedDict())
+  if stmt in prepared:
+    prepared.move_to_end(stmt)
+  else:
+    cur = con.connection.cursor()
+    try:
+      # Limit the number of statements kept by the server for this connection
+      max_prepared = current_app.config.get("PREPARED_STATEMENTS_MAX", 200)
+      while len(prepared) >= max_prepared:
+        old, _ = prepared.popitem(last=False)
+        cur.execute("DEALLOCATE {}".format(old))
+
+      cur.execute("PREPARE {} AS {}".format(stmt, pg_sql))
+    finally:
+      cur.close()
+
+    prepared[stmt] = True
+
+  if len(order) > 0:
+    execute_sql = "EXECUTE {}({})".format(stmt, ",".join(":" + x for x in order))
+  else:
+    execute_sql = "EXECUTE {}".format(stmt)
+
+  return con.execute(text(execute_sql), {k: v for k, (_, v) in binds.items()})
+
 def close_db(*args):
   db = g.pop("db",None)
   if db is not None:
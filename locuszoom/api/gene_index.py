@@ -0,0 +1,293 @@
+from flask import current_app, g
+from flask.json import dumps
+from locuszoom.api.db import execute_prepared
+from locuszoom.api.models.gene import Gene, Transcript, Exon
+from collections import OrderedDict
+import numpy as np
+import threading
+
+def encode(obj):
+  # Same encoding as jsonify() (when not pretty printing)
+  return dumps(obj,separators=(",",":")).encode("utf-8")
+
+class ChromosomeGenes(object):
+  """
+  Genes on one chromosome of a gene source, sorted by start position. Each gene is stored already encoded as JSON,
+  both with and without its transcripts and exons.
+  """
+
+  __slots__ = ("starts","ends","max_ends","full","short","nbytes")
+
+  def __init__(self,genes):
+    genes = sorted(genes,key=lambda gene: (gene.start,gene.gene_id))
+
+    self.starts = np.array([gene.start for gene in genes],dtype=np.int64)
+    self.ends = np.array([gene.end for gene in genes],dtype=np.int64)
+
+    # Running maximum of end positions. It never decreases, so the first gene that may end at or after a position
+    # can be found by binary search.
+    self.max_ends = np.maximum.accumulate(self.ends) if len(genes) > 0 else self.ends
+
+    self.full = [gene.to_json().encode("utf-8") for gene in genes]
+    self.short = [gene.to_json(transcripts=False).encode("utf-8") for gene in genes]
+
+    self.nbytes = (
+      self.starts.nbytes + self.ends.nbytes + self.max_ends.nbytes +
+      sum(len(x) for x in self.full) + sum(len(x) for x in self.short)
+    )
+
+  def __len__(self):
+    return len(self.starts)
+
+  def overlapping(self,lower,upper,checks):
+    """
+    Indices of the genes overlapping [lower, upper] that pass every check.
+
+    Args:
+      lower, upper: range of positions
+      checks: list of ("start" or "end", operator function, value)
+
+    Returns:
+      numpy array of indices, in order of start position
+    """
+
+    first = int(np.searchsorted(self.max_ends,lower,side="left"))
+    last = int(np.searchsorted(self.starts,upper,side="right"))
+    if last <= first:
+      return np.arange(0)
+
+    arrays = {"start": self.starts[first:last], "end": self.ends[first:last]}
+    keep = np.ones(last - first,dtype=bool)
+    for col, func, value in checks:
+      keep &= func(arrays[col],value)
+
+    return np.flatnonzero(keep) + first
+
+def features_sql(where,transcripts=True):
+  """
+  Query for genes in rest.gene_data, each immediately followed by its transcripts and exons.
+
+  Rows are ordered by gene (source, start position, gene id). Within a gene the gene row comes first, then each
+  transcript (in order of start position) followed by its exons (in order of start position.) Transcripts and
+  exons are found by joining on the genes, rather than by passing the list of gene ids back to the database.
+
+  Args:
+    where: condition on rest.gene_data selecting the genes (SQL, not from user input)
+    transcripts: also return transcripts and exons
+
+  Returns:
+    string: SQL statement, see assemble_genes() for reading the rows
+  """
+
+  features = "('gene','transcript','exon')" if transcripts else "('gene')"
+  return (
+    'SELECT d.feature_type, d.gene_id, d.gene_name, d.chrom, d.start, d."end", d.strand, d.transcript_id, d.exon_id, '
+    "d.annotation ->> 'gene_type' AS gene_type "
+    "FROM (SELECT id, gene_id, start FROM rest.gene_data WHERE ({}) AND feature_type = 'gene') g "
+    "JOIN rest.gene_data d ON d.id = g.id AND d.gene_id = g.gene_id "
+    "WHERE d.feature_type IN {} "
+    "ORDER BY g.id, g.start, g.gene_id, "
+    "min(CASE WHEN d.feature_type = 'transcript' THEN d.start END) OVER (PARTITION BY d.id, d.gene_id, d.transcript_id) NULLS FIRST, "
+    "d.transcript_id NULLS FIRST, "
+    "CASE d.feature_type WHEN 'gene' THEN 0 WHEN 'transcript' THEN 1 ELSE 2 END, d.start"
+  ).format(where,features)
+
+def assemble_genes(rows):
+  """
+  Build gene models from the rows of a features_sql() query, in one pass. Each row belongs to the gene (and for
+  exons, the transcript) read most recently.
+
+  Args:
+    rows: rows with columns feature_type, gene_id, gene_name, chrom, start, end, strand, transcript_id, exon_id,
+      gene_type
+
+  Returns:
+    list of Gene, in the order they were read
+  """
+
+  genes = []
+  gene = None
+  transcript = None
+  for row in rows:
+    feature_type = row["feature_type"]
+    if feature_type == "gene":
+      gene = Gene(
+        gene_id = row["gene_id"],
+        gene_name = row["gene_name"],
+        chrom = row["chrom"],
+        start = row["start"],
+        end = row["end"],
+        strand = row["strand"],
+        gene_type = row["gene_type"]
+      )
+      genes.append(gene)
+      transcript = None
+
+    elif gene is None or row["gene_id"] != gene.gene_id:
+      # Feature without a gene
+      continue
+
+    elif feature_type == "transcript":
+      transcript = Transcript(
+        transcript_id = row["transcript_id"],
+        chrom = row["chrom"],
+        start = row["start"],
+        end = row["end"],
+        strand = row["strand"]
+      )
+      gene.add_transcript(transcript)
+
+    else:
+      exon = Exon(
+        exon_id = row["exon_id"],
+        chrom = row["chrom"],
+        start = row["start"],
+        end = row["end"],
+        strand = row["strand"]
+      )
+      gene.add_exon(exon)
+
+      if transcript is not None and transcript.transcript_id == row["transcript_id"]:
+        transcript.add_exon(exon)
+
+  return genes
+
+def load_genes(dbid,chrom):
+  """
+  Query every gene on a chromosome of a gene source, along with its transcripts and exons.
+
+  Returns:
+    list of Gene
+  """
+
+  sql = features_sql("id = :p1 AND chrom = :p2")
+  return assemble_genes(execute_prepared(g.db,sql,{"p1": dbid,"p2": chrom}))
+
+class GeneIndex(object):
+  """
+  Index of the genes in each gene source, held in memory by each worker process. Gene annotations never change once
+  loaded, so a chromosome is read from the database the first time it is requested. Afterward, a request for a
+  region is answered by binary search, and the response is built by joining the pre-encoded genes.
+
+  Chromosomes are kept up to GENE_INDEX_MAX_BYTES per worker, least recently used first out.
+  """
+
+  def __init__(self,region):
+    """
+    Args:
+      region: RegionTable describing the genes table (used to parse filters)
+    """
+
+    self.region = region
+    self.columns = {region.start_index: "start", region.end_index: "end"}
+    self.lock = threading.Lock()
+    self.load_lock = threading.Lock()
+
+    # (dataset id, version, chromosome) --> ChromosomeGenes
+    self.chroms = OrderedDict()
+    self.nbytes = 0
+
+  def _get_cached(self,key):
+    with self.lock:
+      chrom_genes = self.chroms.get(key)
+      if chrom_genes is not None:
+        self.chroms.move_to_end(key)
+
+      return chrom_genes
+
+  def load(self,dbid,chrom):
+    return load_genes(dbid,chrom)
+
+  def get(self,dbid,version,chrom):
+    """
+    Genes for a chromosome of a gene source, loading them if needed.
+    """
+
+    key = (dbid,version,chrom)
+    chrom_genes = self._get_cached(key)
+    if chrom_genes is not None:
+      return chrom_genes
+
+    # Load one chromosome at a time, so that concurrent requests for the same chromosome load it only once
+    with self.load_lock:
+      chrom_genes = self._get_cached(key)
+      if chrom_genes is not None:
+        return chrom_genes
+
+      chrom_genes = ChromosomeGenes(self.load(dbid,chrom))
+
+    max_bytes = current_app.config.get("GENE_INDEX_MAX_BYTES",256 * 1024**2)
+    with self.lock:
+      if key not in self.chroms and chrom_genes.nbytes <= max_bytes:
+        self.chroms[key] = chrom_genes
+        self.nbytes += chrom_genes.nbytes
+
+        while self.nbytes > max_bytes:
+          _, old = self.chroms.popitem(last=False)
+          self.nbytes -= old.nbytes
+
+    return chrom_genes
+
+  def genes(self,terms,field_to_col=None,transcripts=True):
+    """
+    Encoded genes matching a filter.
+
+    Args:
+      terms: parsed filter string
+      field_to_col: mapping of field name in the filter --> database column
+      transcripts: include transcripts and exons of each gene
+
+    Returns:
+      list: JSON for each gene (bytes), ordered by source (in the order given by the filter) and then by start
+        position. None if the filter can't be answered from the index.
+    """
+
+    if not current_app.config.get("GENE_INDEX",True):
+      return None
+
+    region = self.region.parse_region(terms,field_to_col)
+    if region is None:
+      return None
+
+    ids, chrom, lower, upper, checks = region
+    checks = [(self.columns[i],func,value) for i, func, value in checks]
+    versions = self.region.versions(ids)
+
+    found = []
+    for dbid in ids:
+      if versions.get(dbid) is None:
+        # Gene source doesn't exist
+        continue
+
+      chrom_genes = self.get(dbid,versions[dbid],chrom)
+      encoded = chrom_genes.full if transcripts else chrom_genes.short
+      found.extend(encoded[i] for i in chrom_genes.overlapping(lower,upper,checks))
+
+    return found
+
+  def stats(self):
+    """
+    Memory used by the index in this worker process.
+    """
+
+    with self.lock:
+      return {
+        "chromosomes": len(self.chroms),
+        "genes": sum(len(x) for x in self.chroms.values()),
+        "bytes": self.nbytes
+      }
+
+def json_response(genes,meta):
+  """
+  Response with the same body as jsonify({"data": [...], "meta": meta, "lastPage": None}), given the encoded genes.
+  """
+
+  body = b"".join([
+    b'{"data":[',
+    b",".join(genes),
+    b'],"lastPage":null,"meta":',
+    encode(meta),
+    b"}\n"
+  ])
+
+  return current_app.response_class(body,mimetype=current_app.config["JSONIFY_MIMETYPE"])
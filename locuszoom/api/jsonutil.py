@@ -1,5 +1,7 @@
-from flask.json import JSONEncoder
+from flask.json import JSONEncoder, dumps
+import numpy as np
 import datetime
+import math
 
 # Modified JSON encoder to handle datetimes
 class CustomJSONEncoder(JSONEncoder):
@@ -12,3 +14,171 @@ class CustomJSONEncoder(JSONEncoder):
 class JSONFloat(float):
   def __repr__(self):
     return "%0.2g" % self
+
+def stringify_float(f):
+  """
+  JSON has no representation for infinity or NaN, send them as strings instead.
+  """
+
+  if f is None:
+    return f
+
+  if math.isinf(f):
+    if f < 0:
+      return "-Infinity"
+    else:
+      return "Infinity"
+
+  if math.isnan(f):
+    return "NaN"
+
+  return f
+
+def nonfinite_floats(values):
+  """
+  Find the infinite and NaN values in a list of floats (which may also contain None.) The whole list is checked in
+  one vectorized pass; only the values found are converted individually.
+
+  Returns:
+    list: (index, replacement) for each value that needs to be replaced (see stringify_float)
+  """
+
+  if len(values) == 0:
+    return []
+
+  # None becomes NaN here, so candidates are checked again individually
+  arr = np.array(values,dtype=np.float64)
+  bad = np.flatnonzero(~np.isfinite(arr))
+
+  return [(i, stringify_float(values[i])) for i in bad.tolist() if values[i] is not None]
+
+def sanitize_floats(values):
+  """
+  Replace infinite and NaN values in a list of floats with strings, in place.
+
+  Returns:
+    list: values
+  """
+
+  for i, v in nonfinite_floats(values):
+    values[i] = v
+
+  return values
+
+class ColumnarJSONWriter(object):
+  """
+  Incrementally encodes database rows into the "table" response format:
+
+    {"data": {"field1": [...], "field2": [...]}, "lastPage": null}
+
+  Rows are consumed in batches. Each batch of a column is encoded to JSON immediately, so only the compact encoded
+  bytes are held in memory rather than one Python object per cell. Once all rows have been written, the document
+  can be emitted as a series of chunks, suitable for a streaming response.
+
+  The output is byte-for-byte identical to calling jsonify() on the equivalent dictionary of lists (compact
+  separators, sorted keys).
+  """
+
+  def __init__(self,columns,fields,cols_to_field,float_cols):
+    """
+    Args:
+      columns: all columns returned by the query (used to name empty arrays when no rows are found)
+      fields: database columns to write, in order
+      cols_to_field: mapping of database column --> field name in the response
+      float_cols: database columns containing floating point data. Infinity and NaN in these columns are written
+        as strings (see stringify_float.)
+    """
+
+    self.columns = columns
+    self.cols_to_field = cols_to_field
+    self.nrows = 0
+
+    # (column, field name, is float) for each column to write
+    float_cols = set(float_cols)
+    self.fields = [(col,cols_to_field.get(col,col),col in float_cols) for col in fields]
+
+    # field --> list of encoded fragments (each fragment is a comma separated run of values, no brackets)
+    self.data = {}
+
+  def _append(self,field,values,pad=0):
+    frags = self.data.get(field)
+    if frags is None:
+      frags = self.data[field] = []
+      if pad > 0:
+        frags.append(b",".join([b"null"] * pad))
+
+    if len(values) > 0:
+      frags.append(dumps(values,separators=(",",":"))[1:-1].encode("utf-8"))
+
+  def write(self,rows):
+    """
+    Write a batch of rows. Each row must support lookup by column name.
+    """
+
+    if len(rows) == 0:
+      return
+
+    for col, field, is_float in self.fields:
+      values = [row[col] for row in rows]
+
+      if is_float:
+        sanitize_floats(values)
+      elif any(isinstance(v,dict) for v in values):
+        # Dictionary values (e.g. JSONB columns) are expanded into one array per key.
+        self._write_dicts(field,values)
+        continue
+
+      self._append(field,values)
+
+    self.nrows += len(rows)
+
+  def _write_dicts(self,field,values):
+    for j, val in enumerate(values):
+      i = self.nrows + j
+      if isinstance(val,dict):
+        for k, v in val.items():
+          self._append(k,[v],pad=i)
+      else:
+        self._append(field,[val])
+
+  def _pieces(self):
+    if not self.data:
+      # No data was found so fill with empty arrays
+      for col in self.columns:
+        self.data[self.cols_to_field.get(col,col)] = []
+
+    yield b'{"data":{'
+    for n, field in enumerate(sorted(self.data)):
+      yield (b"," if n > 0 else b"") + dumps(field).encode("utf-8") + b":["
+      first = True
+      for frag in self.data[field]:
+        if len(frag) == 0:
+          continue
+
+        if not first:
+          yield b","
+
+        yield frag
+        first = False
+
+      yield b"]"
+
+    yield b'},"lastPage":null}\n'
+
+  def content_length(self):
+    return sum(len(x) for x in self._pieces())
+
+  def chunks(self):
+    """
+    Generator over the encoded document, one chunk per column.
+    """
+
+    buf = []
+    for piece in self._pieces():
+      buf.append(piece)
+      if piece == b"]":
+        yield b"".join(buf)
+        buf = []
+
+    if buf:
+      yield b"".join(buf)
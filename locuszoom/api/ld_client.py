@@ -0,0 +1,125 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app
+from locuszoom.api.errors import FlaskException
+
+class SingleFlight(object):
+  """
+  Coalesces concurrent calls for the same key. The first caller runs the function; callers arriving while it
+  is still running wait for it to finish and receive the same result (or exception.)
+
+  Results are shared between callers, so they should be treated as read-only.
+  """
+
+  class Call(object):
+    def __init__(self):
+      self.done = threading.Event()
+      self.result = None
+      self.error = None
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calls = {}
+    self.coalesced = 0
+
+  def do(self,key,func):
+    with self.lock:
+      call = self.calls.get(key)
+      if call is None:
+        call = self.calls[key] = SingleFlight.Call()
+        leader = True
+      else:
+        self.coalesced += 1
+        leader = False
+
+    if leader:
+      try:
+        call.result = func()
+      except Exception as e:
+        call.error = e
+      finally:
+        with self.lock:
+          del self.calls[key]
+
+        call.done.set()
+    else:
+      call.done.wait()
+
+    if call.error is not None:
+      raise call.error
+
+    return call.result
+
+# LD server used when LD_SERVER_URL is not configured
+DEFAULT_LD_SERVER_URL = "http://portaldev.sph.umich.edu/api_ld/ld"
+
+# Shared by all threads in a worker process
+_session = None
+_session_lock = threading.Lock()
+_flights = SingleFlight()
+
+def get_session():
+  """
+  HTTP session for talking to the LD server. Connections are kept alive and reused between requests.
+  """
+
+  global _session
+  with _session_lock:
+    if _session is None:
+      pool_size = current_app.config.get("LD_SERVER_POOL_SIZE",10)
+      adapter = HTTPAdapter(pool_connections=1,pool_maxsize=pool_size)
+      session = requests.Session()
+      session.mount("http://",adapter)
+      session.mount("https://",adapter)
+      _session = session
+
+  return _session
+
+def fetch_ld(params):
+  """
+  Request LD from the LD server.
+
+  Args:
+    params: dict of query parameters (see LDAPITranslator.to_refsnp_params)
+
+  Returns:
+    dict: JSON returned by the LD server
+  """
+
+  url = current_app.config.get("LD_SERVER_URL",DEFAULT_LD_SERVER_URL)
+  timeout = current_app.config.get("LD_SERVER_TIMEOUT",(5,60))
+
+  try:
+    resp = get_session().get(url,params=params,timeout=timeout)
+  except requests.Timeout:
+    raise FlaskException("Timed out retrieving data from LD server",504)
+  except Exception as e:
+    raise FlaskException("Failed retrieving data from LD server, error was {}".format(e),500)
+
+  # Did it come back OK?
+  if not resp.ok:
+    raise FlaskException("Failed retrieving data from LD server, error was {}".format(resp.reason),500)
+
+  return resp.json()
+
+def fetch_ld_coalesced(key,params):
+  """
+  Request LD from the LD server, sharing the request with any identical request already in flight in this
+  worker process.
+
+  Args:
+    key: identifies the request, e.g. (cache key, chromosome, start, end)
+    params: dict of query parameters (see LDAPITranslator.to_refsnp_params)
+
+  Returns:
+    dict: JSON returned by the LD server. This may be shared with other requests, do not modify it.
+  """
+
+  return _flights.do(key,lambda: fetch_ld(params))
+
+def stats():
+  return {
+    "coalesced": _flights.coalesced,
+    "in_flight": len(_flights.calls)
+  }
@@ -1,16 +1,40 @@
 #!/usr/bin/env python
-import json
-from copy import deepcopy
-from sortedcontainers import SortedSet
+from json.encoder import encode_basestring_ascii
+from operator import attrgetter
+
+# Children are kept in order of start position. Python's sort is stable, so features starting at the same
+# position stay in the order they were added.
+by_start = attrgetter("start")
+
+def json_str(v):
+  return "null" if v is None else encode_basestring_ascii(v)
+
+def json_int(v):
+  return "null" if v is None else int.__repr__(v)
 
 class Exon(object):
   cargs = "exon_id chrom start end strand".split()
-  def __init__(self,**kwargs):
-    for arg in Exon.cargs:
-      self.__dict__[arg] = kwargs.get(arg)
+  __slots__ = tuple(cargs) + ("json",)
+
+  def __init__(self,exon_id=None,chrom=None,start=None,end=None,strand=None,**kwargs):
+    self.exon_id = exon_id
+    self.chrom = chrom
+    self.start = start
+    self.end = end
+    self.strand = strand
+    self.json = None
 
   def to_dict(self):
-    return deepcopy(self.__dict__)
+    return {k: getattr(self,k) for k in Exon.cargs}
+
+  def to_json(self):
+    # The same exon is usually written for the gene and for each of its transcripts, so it is only encoded once
+    if self.json is None:
+      self.json = '{"chrom":%s,"end":%s,"exon_id":%s,"start":%s,"strand":%s}' % (
+        json_str(self.chrom),json_int(self.end),json_str(self.exon_id),json_int(self.start),json_str(self.strand)
+      )
+
+    return self.json
 
   def __hash__(self):
     return hash(self.exon_id)
@@ -18,71 +42,93 @@ class Exon(object):
   def __eq__(self,other):
     return self.exon_id == other.exon_id
 
-  def __lt__(self,other):
-    if self.chrom == other.chrom:
-      if self.start < other.start:
-        return True
-      else:
-        return False
-    else:
-      raise ValueError("Comparing exons on separate chromosomes")
-
 class Transcript(object):
   cargs = "transcript_id chrom start end strand".split()
+  __slots__ = tuple(cargs) + ("exons","exon_ids","is_sorted")
 
-  def __init__(self,**kwargs):
-    for arg in Transcript.cargs:
-      self.__dict__[arg] = kwargs.get(arg)
+  def __init__(self,transcript_id=None,chrom=None,start=None,end=None,strand=None,**kwargs):
+    self.transcript_id = transcript_id
+    self.chrom = chrom
+    self.start = start
+    self.end = end
+    self.strand = strand
 
-    self.exons = SortedSet()
+    self.exons = []
+    self.exon_ids = set()
+    self.is_sorted = True
 
   def add_exon(self,exon):
-    self.exons.add(exon)
+    if exon.exon_id not in self.exon_ids:
+      self.exon_ids.add(exon.exon_id)
+      self.exons.append(exon)
+      self.is_sorted = False
 
-  def to_dict(self):
-    dd = {}
-    for k in Transcript.cargs:
-      v = self.__dict__[k]
-      if isinstance(v,(set,SortedSet)):
-        v = list(v)
-
-      dd[k] = v
+  def sort(self):
+    if not self.is_sorted:
+      self.exons.sort(key=by_start)
+      self.is_sorted = True
 
-    for e in self.exons:
-      dd.setdefault("exons",[]).append(e.to_dict())
+  def to_dict(self):
+    self.sort()
+    dd = {k: getattr(self,k) for k in Transcript.cargs}
+    if self.exons:
+      dd["exons"] = [e.to_dict() for e in self.exons]
 
     return dd
 
+  def to_json(self):
+    self.sort()
+    exons = ',"exons":[' + ",".join([e.to_json() for e in self.exons]) + "]" if self.exons else ""
+    return '{"chrom":%s,"end":%s%s,"start":%s,"strand":%s,"transcript_id":%s}' % (
+      json_str(self.chrom),json_int(self.end),exons,json_int(self.start),json_str(self.strand),json_str(self.transcript_id)
+    )
+
   def __hash__(self):
     return hash(self.transcript_id)
 
   def __eq__(self,other):
     return self.transcript_id == other.transcript_id
 
-  def __lt__(self,other):
-    if self.chrom == other.chrom:
-      if self.start < other.start:
-        return True
-      else:
-        return False
-    else:
-      raise ValueError("Comparing transcripts on separate chromosomes")
-
 class Gene(object):
   cargs = "gene_id gene_name chrom start end strand gene_type".split()
-
-  def __init__(self,**kwargs):
-    for arg in Gene.cargs:
-      self.__dict__[arg] = kwargs.get(arg)
-
-    self.transcripts = SortedSet()
-    self.exons = SortedSet()
+  __slots__ = tuple(cargs) + ("transcripts","transcript_ids","exons","exon_ids","is_sorted")
+
+  def __init__(self,gene_id=None,gene_name=None,chrom=None,start=None,end=None,strand=None,gene_type=None,**kwargs):
+    self.gene_id = gene_id
+    self.gene_name = gene_name
+    self.chrom = chrom
+    self.start = start
+    self.end = end
+    self.strand = strand
+    self.gene_type = gene_type
+
+    self.transcripts = []
+    self.transcript_ids = set()
+    self.exons = []
+    self.exon_ids = set()
+    self.is_sorted = True
 
   def add_transcript(self,transcript):
-    self.transcripts.add(transcript)
+    if transcript.transcript_id not in self.transcript_ids:
+      self.transcript_ids.add(transcript.transcript_id)
+      self.transcripts.append(transcript)
+      self.is_sorted = False
 
   def add_exon(self,exon):
-    self.exons.add(exon)
+    if exon.exon_id not in self.exon_ids:
+      self.exon_ids.add(exon.exon_id)
+      self.exons.append(exon)
+      self.is_sorted = False
+
+  def sort(self):
+    """
+    Put transcripts and exons in order of start position. Done once, when the gene is first serialized.
+    """
+
+    if not self.is_sorted:
+      self.transcripts.sort(key=by_start)
+      self.exons.sort(key=by_start)
+      self.is_sorted = True
 
   def to_dict(self):
     """
@@ -92,21 +138,41 @@ class Gene(object):
       dict
     """
 
-    dd = {}
-    for k in Gene.cargs:
-      v = self.__dict__[k]
-      if isinstance(v,(set,SortedSet)):
-        v = list(v)
+    self.sort()
+    dd = {k: getattr(self,k) for k in Gene.cargs}
+    if self.transcripts:
+      dd["transcripts"] = [t.to_dict() for t in self.transcripts]
 
-      dd[k] = v
+    if self.exons:
+      dd["exons"] = [e.to_dict() for e in self.exons]
 
-    for t in self.transcripts:
-      dd.setdefault("transcripts",[]).append(t.to_dict())
+    return dd
 
-    for e in self.exons:
-      dd.setdefault("exons",[]).append(e.to_dict())
+  def to_json(self,transcripts=True):
+    """
+    Encode this gene directly as JSON, without building dictionaries first. The result is the same as
+    jsonify() would give for to_dict() (keys sorted, no whitespace.)
 
-    return dd
+    Args:
+      transcripts: include transcripts and exons
+
+    Returns:
+      str
+    """
+
+    exons = ""
+    tx = ""
+    if transcripts:
+      self.sort()
+      if self.exons:
+        exons = ',"exons":[' + ",".join([e.to_json() for e in self.exons]) + "]"
+      if self.transcripts:
+        tx = ',"transcripts":[' + ",".join([t.to_json() for t in self.transcripts]) + "]"
+
+    return '{"chrom":%s,"end":%s%s,"gene_id":%s,"gene_name":%s,"gene_type":%s,"start":%s,"strand":%s%s}' % (
+      json_str(self.chrom),json_int(self.end),exons,json_str(self.gene_id),json_str(self.gene_name),
+      json_str(self.gene_type),json_int(self.start),json_str(self.strand),tx
+    )
 
 def test():
   g = Gene(gene_id="ENSG1",gene_name="ABC",chrom="1",start=42,end=800,strand="+")
@@ -144,6 +210,5 @@ def test():
   pprint(g.to_dict())
 
   print("Trying to convert to JSON")
-  js = json.dumps(g.to_dict())
+  js = g.to_json()
   pprint(js)
-
@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from locuszoom.api.uriparsing import SQLCompiler
+import threading
+
+class QuerySpec(object):
+  """
+  What std_response needs to know about a route's table: the columns that may be queried, how field names in the
+  request translate to columns and back, and which columns hold floating point data.
+
+  Specs are created once, when the route is defined. Anything derived from request parameters (the columns for a
+  "fields" string, the ORDER BY for a "sort" string, the SELECT clause) is memoized, so repeated requests skip the
+  work.
+  """
+
+  # Number of distinct fields/sort strings remembered per route
+  MEMO_SIZE = 256
+
+  def __init__(self,table,columns,field_to_cols=None,region=None):
+    """
+    Args:
+      table: database table to query against (not from user input)
+      columns: possible database columns (used to sanitize user input)
+      field_to_cols: if any fields in the filter string need to be translated to database columns
+      region: RegionTable describing the table, if rows for a region can be served from the cache
+    """
+
+    self.table = table
+    self.columns = list(columns)
+    self.column_set = frozenset(columns)
+    self.field_to_cols = field_to_cols
+    self.region = region
+
+    # Translate database columns --> field names
+    if field_to_cols is not None:
+      self.cols_to_field = {v: k for k, v in field_to_cols.items()}
+    else:
+      self.cols_to_field = {}
+
+    self.compiler = SQLCompiler()
+    self.type_codes = {}
+    self._memo = OrderedDict()
+    self._lock = threading.Lock()
+
+  def _memoize(self,key,func):
+    with self._lock:
+      value = self._memo.get(key)
+      if value is not None:
+        self._memo.move_to_end(key)
+        return value
+
+    value = func()
+    with self._lock:
+      self._memo[key] = value
+      while len(self._memo) > self.MEMO_SIZE:
+        self._memo.popitem(last=False)
+
+    return value
+
+  def _resolve(self,names_str):
+    names = [x.strip() for x in names_str.split(",")]
+
+    # Translate to database columns
+    if self.field_to_cols is not None:
+      names = [self.field_to_cols.get(x,x) for x in names]
+
+    # To avoid injection, only accept fields that we know about
+    return tuple(x for x in names if x in self.column_set)
+
+  def fields(self,fields_str):
+    """
+    Database columns requested by a "fields" parameter (all columns if None.)
+    """
+
+    if fields_str is None:
+      return self.columns
+
+    return list(self._memoize(("fields",fields_str),lambda: self._resolve(fields_str)))
+
+  def sort(self,sort_str):
+    """
+    Database columns requested by a "sort" parameter (None if not given.)
+    """
+
+    if sort_str is None:
+      return None
+
+    return list(self._memoize(("sort",sort_str),lambda: self._resolve(sort_str)))
+
+  def _select(self,fields,sort_fields):
+    sql = "SELECT {} FROM {}".format(",".join(map(self.compiler.quote_keywords,fields)),self.table)
+    order = None
+    if sort_fields is not None:
+      order = "ORDER BY {}".format(",".join(map(self.compiler.quote_keywords,sort_fields)))
+
+    return sql, order
+
+  def to_sql(self,terms,fields,sort_fields=None,limit=None,canonical=False):
+    """
+    Equivalent to SQLCompiler.to_sql_parsed() for this table, with the SELECT and ORDER BY clauses memoized.
+
+    Args:
+      terms: parsed filter string
+      fields: database columns to return
+      sort_fields: database columns to sort by
+      limit: maximum number of rows to return
+      canonical: see SQLCompiler.to_sql_parsed()
+
+    Returns:
+      string: SQL statement
+      dict: named parameters for SQL statement
+    """
+
+    key = ("select",tuple(fields),tuple(sort_fields) if sort_fields is not None else None)
+    select, order = self._memoize(key,lambda: self._select(fields,sort_fields))
+
+    sql = [select]
+    where, params = self.compiler._to_where(terms,self.column_set,self.field_to_cols,canonical)
+    sql.extend(where)
+
+    if order is not None:
+      sql.append(order)
+
+    if limit is not None and canonical:
+      mparam = "p{}".format(len(params) + 1)
+      params[mparam] = int(limit)
+      sql.append("LIMIT :{}".format(mparam))
+    elif limit is not None:
+      sql.append("LIMIT {}".format(limit))
+
+    return " ".join(sql), params
+
+  def float_columns(self,cur):
+    """
+    Columns of a query result containing floating point data.
+
+    Column types are learned from the cursor description the first time a column is selected, and remembered
+    afterward. The description is only guaranteed to be available once rows have been fetched.
+    """
+
+    if hasattr(cur,"float_columns"):
+      # Rows from the region cache
+      return cur.float_columns
+
+    keys = list(cur.keys())
+    if any(k not in self.type_codes for k in keys):
+      description = cur.cursor.description or []
+      self.type_codes.update((x.name,x.type_code) for x in description)
+
+    # 700 and 701 are the OIDs for real and double precision from postgres
+    return [k for k in keys if self.type_codes.get(k) in (700, 701)]
@@ -0,0 +1,236 @@
+from flask import current_app, g
+from locuszoom.api.conditional import dataset_versions
+from locuszoom.api.db import execute_prepared
+from locuszoom.api.jsonutil import sanitize_floats
+from collections import defaultdict
+import numpy as np
+import threading
+
+class RecombMap(object):
+  """
+  Recombination rate points for one chromosome of one dataset, as arrays sorted by position. Missing genetic
+  positions (pos_cm) are stored as NaN and flagged in cm_null, to tell them apart from NaN values in the database.
+  """
+
+  __slots__ = ("positions","rates","pos_cm","cm_null")
+
+  def __init__(self,positions,rates,pos_cm,cm_null):
+    self.positions = positions
+    self.rates = rates
+    self.pos_cm = pos_cm
+    self.cm_null = cm_null
+
+  @classmethod
+  def from_rows(cls,rows):
+    """
+    Args:
+      rows: (position, recomb_rate, pos_cm) tuples, sorted by position
+    """
+
+    return cls(
+      np.array([r[0] for r in rows],dtype=np.int64),
+      np.array([r[1] for r in rows],dtype=np.float64),
+      np.array([np.nan if r[2] is None else r[2] for r in rows],dtype=np.float64),
+      np.array([r[2] is None for r in rows],dtype=bool)
+    )
+
+  def __len__(self):
+    return len(self.positions)
+
+  @property
+  def nbytes(self):
+    return self.positions.nbytes + self.rates.nbytes + self.pos_cm.nbytes + self.cm_null.nbytes
+
+  def genetic_positions(self,points):
+    """
+    Genetic positions (pos_cm) of a slice of points, with None where missing.
+    """
+
+    values = self.pos_cm[points].tolist()
+    for i in np.flatnonzero(self.cm_null[points]).tolist():
+      values[i] = None
+
+    return values
+
+  def window(self,start,end):
+    """
+    Indices of the points for a window: the nearest point at or before start, and the points in [start, end).
+
+    Returns:
+      int: index of the flanking point, or -1 if there is no point at or before start
+      slice: points within the window
+    """
+
+    left = int(np.searchsorted(self.positions,start,side="right")) - 1
+    lo, hi = np.searchsorted(self.positions,[start,end],side="left")
+    return left, slice(int(lo),max(int(lo),int(hi)))
+
+class RecombMaps(object):
+  """
+  Recombination rate maps held in memory by each worker process, so that windows can be served without querying
+  the database. Maps are small and never modified once loaded, so each chromosome of a dataset is loaded the first
+  time it is requested and kept.
+
+  If the dataset's row in the master table changes (see conditional.DatasetVersions), its maps are dropped and
+  reloaded on next use.
+  """
+
+  def __init__(self,table="rest.recomb_results",master_table="rest.recomb"):
+    """
+    Args:
+      table: table of recombination rate points
+      master_table: table describing each recombination rate dataset
+    """
+
+    self.table = table
+    self.master_table = master_table
+    self.lock = threading.Lock()
+
+    # dataset id --> (version, build, {chromosome: RecombMap})
+    self.datasets = {}
+
+  @staticmethod
+  def parse_window(lrm):
+    """
+    Dataset, chromosome and range from FilterParser.left_middle_right(), if the filter is one that can be answered
+    from a map: a single dataset id, a chromosome and a position range, and nothing else.
+
+    Returns:
+      tuple: (dataset id, chromosome, start, end), or None
+    """
+
+    dbid = None
+    for term in lrm["base"]:
+      if isinstance(term,str):
+        if term != "and":
+          return None
+      elif term.lhs == "id" and term.comp in ("eq","=","in") and len(term.rhs) == 1:
+        dbid = term.rhs[0]
+      elif term.lhs != "chromosome":
+        return None
+
+    if not isinstance(dbid,int) or isinstance(dbid,bool):
+      return None
+
+    start, end = lrm["range"]["left"], lrm["range"]["right"]
+    if not all(isinstance(v,int) and not isinstance(v,bool) for v in (start,end)):
+      return None
+
+    return dbid, lrm["range"]["chrom"], start, end
+
+  def _dataset(self,dbid):
+    version = dataset_versions(self.master_table).get([dbid]).get(dbid)
+    if version is None:
+      return None
+
+    with self.lock:
+      dataset = self.datasets.get(dbid)
+      if dataset is not None and dataset[0] == version:
+        return dataset
+
+    sql = "SELECT build FROM {} WHERE id = :p1".format(self.master_table)
+    build = execute_prepared(g.db,sql,{"p1": dbid}).scalar()
+
+    with self.lock:
+      dataset = self.datasets.get(dbid)
+      if dataset is None or dataset[0] != version:
+        # New dataset, or it has been reloaded since the maps were read
+        dataset = self.datasets[dbid] = (version,build,{})
+
+    return dataset
+
+  def get(self,dbid,chrom):
+    """
+    Map for a chromosome of a dataset, loading it if needed.
+
+    Returns:
+      RecombMap, or None if the dataset does not exist
+    """
+
+    dataset = self._dataset(dbid)
+    if dataset is None:
+      return None
+
+    chroms = dataset[2]
+    rmap = chroms.get(chrom)
+    if rmap is None:
+      sql = "SELECT position, recomb_rate, pos_cm FROM {} WHERE id = :p1 AND chromosome = :p2 ORDER BY position".format(self.table)
+      rows = execute_prepared(g.db,sql,{"p1": dbid,"p2": chrom}).fetchall()
+
+      # Another thread may have loaded it first, either copy is fine
+      rmap = chroms.setdefault(chrom,RecombMap.from_rows(rows))
+
+    return rmap
+
+  def window(self,lrm):
+    """
+    Recombination rates for a window, in the same form as the database path of the /annotation/recomb/results/
+    endpoint: the points within the window, preceded and followed by points at the window edges. The edges take
+    the rate of the nearest point at or before them.
+
+    Args:
+      lrm: filters from FilterParser.left_middle_right()
+
+    Returns:
+      dict: field --> list of values (as from reshape_data), or None if the request can't be answered from the
+        maps and must go to the database
+    """
+
+    if not current_app.config.get("RECOMB_MAPS",True):
+      return None
+
+    parsed = self.parse_window(lrm)
+    if parsed is None:
+      return None
+
+    dbid, chrom, start, end = parsed
+    rmap = self.get(dbid,chrom)
+    if rmap is None:
+      return None
+
+    left, middle = rmap.window(start,end)
+    n = middle.stop - middle.start
+
+    # Edges: the flanking point (or a placeholder with rate 0 if there is none) at the start, and the last point
+    # before the end. The placeholder values are integers, as in the database path.
+    if left >= 0:
+      first_id, first_rate, first_cm = dbid, rmap.rates[left].item(), rmap.genetic_positions(slice(left,left + 1))[0]
+    else:
+      first_id, first_rate, first_cm = "chrleft", 0, 0
+
+    rates = rmap.rates[middle].tolist()
+    pos_cm = rmap.genetic_positions(middle)
+    if n > 0:
+      last_id, last_rate, last_cm = dbid, rates[-1], pos_cm[-1]
+    else:
+      last_id, last_rate, last_cm = first_id, first_rate, first_cm
+
+    rates = [first_rate] + rates + [last_rate]
+    pos_cm = [first_cm] + pos_cm + [last_cm]
+
+    return {
+      "id": [first_id] + [dbid] * n + [last_id],
+      "chromosome": [chrom] * (n + 2),
+      "position": [start] + rmap.positions[middle].tolist() + [end],
+      "recomb_rate": sanitize_floats(rates),
+      "pos_cm": sanitize_floats(pos_cm)
+    }
+
+  def stats(self):
+    """
+    Memory used by the maps loaded in this worker process, by genome build.
+    """
+
+    with self.lock:
+      datasets = list(self.datasets.values())
+
+    stats = defaultdict(lambda: {"datasets": 0, "chromosomes": 0, "points": 0, "bytes": 0})
+    for version, build, chroms in datasets:
+      entry = stats[build]
+      entry["datasets"] += 1
+      for rmap in list(chroms.values()):
+        entry["chromosomes"] += 1
+        entry["points"] += len(rmap)
+        entry["bytes"] += rmap.nbytes
+
+    return dict(stats)
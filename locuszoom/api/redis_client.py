@@ -1,13 +1,85 @@
 import redis
-from flask import current_app, g
-
-def before_request():
-  # Setup redis
-  g.redis_client = redis.StrictRedis(
-    host = current_app.config["REDIS_HOST"],
-    port = current_app.config["REDIS_PORT"],
-    db = current_app.config["REDIS_DB"]
-  )
+import threading
+from flask import g
+
+class CountingConnectionPool(redis.BlockingConnectionPool):
+  """
+  Connection pool shared by all threads in a worker process. When every connection is in use, callers wait
+  (up to the pool timeout) for one to be released rather than opening more connections.
+
+  Counters are kept so that pool saturation can be monitored (see stats().)
+  """
+
+  def __init__(self,*args,**kwargs):
+    super(CountingConnectionPool,self).__init__(*args,**kwargs)
+    self._stats_lock = threading.Lock()
+    self.checkouts = 0
+    self.waits = 0
+    self.timeouts = 0
+    self.in_use = 0
+    self.max_in_use = 0
+
+  def get_connection(self,*args,**kwargs):
+    with self._stats_lock:
+      self.checkouts += 1
+      if self.pool.empty():
+        # All connections are checked out, this request will have to wait
+        self.waits += 1
+
+    try:
+      connection = super(CountingConnectionPool,self).get_connection(*args,**kwargs)
+    except redis.ConnectionError:
+      with self._stats_lock:
+        self.timeouts += 1
+      raise
+
+    with self._stats_lock:
+      self.in_use += 1
+      self.max_in_use = max(self.max_in_use,self.in_use)
+
+    return connection
+
+  def release(self,connection):
+    with self._stats_lock:
+      self.in_use -= 1
+
+    super(CountingConnectionPool,self).release(connection)
+
+  def stats(self):
+    with self._stats_lock:
+      return {
+        "size": self.max_connections,
+        "in_use": self.in_use,
+        "max_in_use": self.max_in_use,
+        "checkouts": self.checkouts,
+        "waits": self.waits,
+        "timeouts": self.timeouts
+      }
+
+# Store connection pool at global scope (one per worker process)
+pool = None
+
+def get_client():
+  """
+  Redis client for the current request. The client itself holds no connection, one is borrowed from the
+  pool for each command (or pipeline) and returned immediately after.
+  """
+
+  client = getattr(g,"redis_client",None)
+  if client is None:
+    client = g.redis_client = redis.StrictRedis(connection_pool=pool)
+
+  return client
 
 def init_app(app):
-  app.before_request(before_request)
+  global pool
+
+  pool = CountingConnectionPool(
+    host = app.config["REDIS_HOST"],
+    port = app.config["REDIS_PORT"],
+    db = app.config["REDIS_DB"],
+    max_connections = app.config.get("REDIS_POOL_SIZE",10),
+    timeout = app.config.get("REDIS_POOL_TIMEOUT",5),
+    socket_timeout = app.config.get("REDIS_SOCKET_TIMEOUT",5),
+    socket_connect_timeout = app.config.get("REDIS_SOCKET_TIMEOUT",5)
+  )
@@ -0,0 +1,314 @@
+from flask import current_app, g
+from flask_caching import Cache
+from locuszoom.api.conditional import dataset_versions
+from locuszoom.api.db import execute_prepared
+import operator
+
+# Rows from annotation tables, stored in chunks (see RegionTable.rows()). Configured by CACHE_CONFIG.
+cache = Cache()
+
+# Filter operators that can be evaluated against cached rows
+COMPARISONS = {
+  "eq": operator.eq,
+  "=": operator.eq,
+  "gt": operator.gt,
+  ">": operator.gt,
+  "ge": operator.ge,
+  "lt": operator.lt,
+  "<": operator.lt,
+  "le": operator.le
+}
+
+LOWER_BOUNDS = ("eq","=","gt",">","ge")
+UPPER_BOUNDS = ("eq","=","lt","<","le")
+
+class Row(tuple):
+  """
+  Row from the cache. Like a sqlalchemy RowProxy, values can be looked up by position or by column name.
+  """
+
+  __slots__ = ()
+  _columns = ()
+  _index = {}
+
+  def __getitem__(self,key):
+    if isinstance(key,str):
+      key = self._index[key]
+
+    return tuple.__getitem__(self,key)
+
+  def keys(self):
+    return list(self._columns)
+
+def row_class(columns):
+  return type("Row",(Row,),{
+    "__slots__": (),
+    "_columns": tuple(columns),
+    "_index": {c: i for i, c in enumerate(columns)}
+  })
+
+class RegionRows(object):
+  """
+  Rows retrieved from the cache. Supports the subset of the sqlalchemy result proxy interface used to format
+  responses (iteration, fetchmany(), fetchall(), keys().)
+  """
+
+  def __init__(self,columns,rows,float_columns):
+    self.columns = columns
+    self.float_columns = float_columns
+    self.rows = rows
+    self.pos = 0
+
+  def keys(self):
+    return list(self.columns)
+
+  def fetchmany(self,size):
+    rows = self.rows[self.pos:self.pos + size]
+    self.pos += len(rows)
+    return rows
+
+  def fetchall(self):
+    return self.fetchmany(len(self.rows))
+
+  def __iter__(self):
+    return iter(self.fetchall())
+
+  def __len__(self):
+    return len(self.rows)
+
+class RegionTable(object):
+  """
+  A table of features with positions on a chromosome, belonging to datasets that never change once loaded.
+
+  Rows are cached in chunks of REGION_CACHE_CHUNK_SIZE bp, per (dataset id, dataset version, chromosome.) A
+  chunk holds every feature overlapping it, so a feature spanning a chunk boundary is stored in each chunk it
+  touches. Requests load the chunks covering the requested region, and then filter them down to exactly the
+  rows the filter asks for.
+  """
+
+  def __init__(self,table,columns,master_table,chrom_col="chrom",start_col="pos",end_col=None,where=None):
+    """
+    Args:
+      table: database table containing the features
+      columns: columns to cache (and return)
+      master_table: table with one row per dataset id, used to find the dataset version (see DatasetVersions)
+      chrom_col: chromosome column
+      start_col: start position column (or position, for features that are a single base)
+      end_col: end position column, leave as None for features that are a single base
+      where: additional condition that all rows must satisfy (SQL, not from user input)
+    """
+
+    self.table = table
+    self.columns = columns
+    self.master_table = master_table
+    self.chrom_col = chrom_col
+    self.start_col = start_col
+    self.end_col = end_col or start_col
+    self.where = where
+
+    self.row_class = row_class(columns)
+    self.start_index = columns.index(self.start_col)
+    self.end_index = columns.index(self.end_col)
+
+  def parse_region(self,terms,field_to_col=None):
+    """
+    Find the dataset ids, chromosome and range of positions requested by a parsed filter.
+
+    Only filters consisting of id, chromosome and position terms joined by "and" can be served from the cache.
+    Positions must be bounded on both sides.
+
+    Args:
+      terms: parsed filter string
+      field_to_col: mapping of field name in the filter --> database column
+
+    Returns:
+      tuple: (ids, chromosome, lower, upper, checks), or None if the filter can't be served from the cache.
+        Every row that matches the filter overlaps [lower, upper], and checks is a list of
+        (column index, operator function, value) that matching rows must satisfy.
+    """
+
+    ids = None
+    chrom = None
+    lower = None
+    upper = None
+    checks = []
+
+    for term in terms:
+      if isinstance(term,str):
+        if term != "and":
+          return None
+        continue
+
+      col = field_to_col.get(term.lhs,term.lhs) if field_to_col is not None else term.lhs
+      values = list(term.rhs)
+      if term.comp not in ("in","eq","=") and len(values) != 1:
+        return None
+
+      if col == "id" and ids is None:
+        if term.comp not in ("in","eq","="):
+          return None
+        if not all(isinstance(v,int) and not isinstance(v,bool) for v in values):
+          return None
+
+        ids = list(dict.fromkeys(values))
+
+      elif col == self.chrom_col and chrom is None:
+        # Unquoted chromosomes are parsed as numbers, which would be a type error in SQL
+        if term.comp not in ("in","eq","=") or len(values) != 1 or not isinstance(values[0],str):
+          return None
+
+        chrom = values[0]
+
+      elif col in (self.start_col,self.end_col):
+        func = COMPARISONS.get(term.comp)
+        value = values[0]
+        if func is None or isinstance(value,bool) or not isinstance(value,(int,float)):
+          return None
+
+        # Features end after they start, so a bound on either the start or the end means the feature
+        # overlaps [lower, upper]
+        if term.comp in LOWER_BOUNDS:
+          lower = value if lower is None else max(lower,value)
+        if term.comp in UPPER_BOUNDS:
+          upper = value if upper is None else min(upper,value)
+
+        checks.append((self.columns.index(col),func,value))
+
+      else:
+        return None
+
+    if ids is None or chrom is None or lower is None or upper is None:
+      return None
+
+    return ids, chrom, lower, upper, checks
+
+  def versions(self,ids):
+    return dataset_versions(self.master_table).get(ids)
+
+  def chunk_key(self,dbid,version,chrom,size,chunk):
+    return "region__{}__{}__{}__{}__{}__{}".format(self.table,dbid,version,chrom,size,chunk)
+
+  def fetch(self,dbid,chrom,start,end):
+    """
+    Query the database for rows overlapping [start, end].
+
+    Returns:
+      list: rows as tuples, in order of start position
+      list: columns containing floating point data
+    """
+
+    sql = [
+      "SELECT {} FROM {}".format(",".join('"{}"'.format(c) for c in self.columns),self.table),
+      'WHERE id = :p1 AND "{}" = :p2 AND "{}" <= :p3 AND "{}" >= :p4'.format(
+        self.chrom_col,self.start_col,self.end_col
+      )
+    ]
+    if self.where is not None:
+      sql.append("AND {}".format(self.where))
+    sql.append('ORDER BY "{}"'.format(self.start_col))
+
+    cur = execute_prepared(g.db," ".join(sql),{"p1": dbid,"p2": chrom,"p3": end,"p4": start})
+
+    # 700 and 701 are the OIDs for real and double precision from postgres
+    float_cols = [x.name for x in cur.cursor.description if x.type_code in (700, 701)]
+    rows = [tuple(row) for row in cur]
+    return rows, float_cols
+
+  def chunks(self,dbid,version,chrom,first,last):
+    """
+    Load chunks first..last (inclusive) for a dataset, querying the database for any that aren't cached.
+
+    Returns:
+      list: for each chunk, a tuple of (rows, float columns)
+    """
+
+    size = current_app.config.get("REGION_CACHE_CHUNK_SIZE",250000)
+    keys = [self.chunk_key(dbid,version,chrom,size,k) for k in range(first,last + 1)]
+    chunks = cache.get_many(*keys)
+
+    # Query each run of consecutive missing chunks at once
+    new = {}
+    k = first
+    while k <= last:
+      if chunks[k - first] is not None:
+        k += 1
+        continue
+
+      run_first = k
+      while k <= last and chunks[k - first] is None:
+        k += 1
+      run_last = k - 1
+
+      rows, float_cols = self.fetch(dbid,chrom,run_first * size,(run_last + 1) * size - 1)
+      run = [[] for _ in range(run_first,run_last + 1)]
+      for row in rows:
+        for j in range(max(run_first,row[self.start_index] // size),min(run_last,row[self.end_index] // size) + 1):
+          run[j - run_first].append(row)
+
+      for j, chunk_rows in enumerate(run):
+        chunks[run_first - first + j] = new[keys[run_first - first + j]] = (chunk_rows,float_cols)
+
+    if new:
+      cache.set_many(new)
+
+    return chunks
+
+  def rows(self,terms,field_to_col=None,columns=None):
+    """
+    Retrieve the rows matching a filter from the cache.
+
+    Args:
+      terms: parsed filter string
+      field_to_col: mapping of field name in the filter --> database column
+      columns: columns selected by the request, as reported by keys() on the result (all columns by default.)
+        Rows always contain every column.
+
+    Returns:
+      RegionRows: rows matching the filter, ordered by dataset id (in the order given by the filter) and then
+        by start position. None if the filter can't be served from the cache; the caller should query the
+        database directly instead.
+    """
+
+    region = self.parse_region(terms,field_to_col)
+    if region is None:
+      return None
+
+    ids, chrom, lower, upper, checks = region
+    size = current_app.config.get("REGION_CACHE_CHUNK_SIZE",250000)
+    first = max(int(lower // size),0)
+    last = int(upper // size)
+    if columns is None:
+      columns = self.columns
+
+    if last < first:
+      return RegionRows(columns,[],[])
+    if last - first + 1 > current_app.config.get("REGION_CACHE_MAX_CHUNKS",40):
+      return None
+
+    versions = self.versions(ids)
+    rows = []
+    float_cols = []
+    for dbid in ids:
+      for k, (chunk_rows, chunk_float_cols) in enumerate(self.chunks(dbid,versions[dbid],chrom,first,last),first):
+        float_cols = chunk_float_cols
+        for row in chunk_rows:
+          # Features spanning several chunks are in each of them, only take them from the first one
+          if k > first and row[self.start_index] // size < k:
+            continue
+
+          # NULL never matches a comparison in SQL
+          if all(row[i] is not None and func(row[i],value) for i, func, value in checks):
+            rows.append(self.row_class(row))
+
+    return RegionRows(columns,rows,[c for c in float_cols if c in columns])
+
+def init_app(app):
+  config = dict(app.config.get("CACHE_CONFIG") or {"CACHE_TYPE": "null"})
+  config.setdefault("CACHE_NO_NULL_WARNING",True)
+
+  try:
+    cache.init_app(app,config=config)
+  except OSError as e:
+    # e.g. the cache directory can't be created
+    app.logger.warning("Could not create response cache, annotation rows will not be cached: " + str(e))
+    cache.init_app(app,config={"CACHE_TYPE": "null","CACHE_NO_NULL_WARNING": True})
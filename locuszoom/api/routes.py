@@ -4,12 +4,18 @@ from collections import OrderedDict
 from sqlalchemy import text
 from flask import g, jsonify, request, Blueprint, current_app
 from locuszoom.api import sentry
-from locuszoom.api.jsonutil import JSONFloat
-from locuszoom.api.uriparsing import SQLCompiler, LDAPITranslator, FilterParser
-from locuszoom.api.models.gene import Gene, Transcript, Exon
-from locuszoom.api.cache import RedisIntervalCache
+from locuszoom.api.jsonutil import JSONFloat, ColumnarJSONWriter, stringify_float, nonfinite_floats, sanitize_floats
+from locuszoom.api import arrowutil
+from locuszoom.api.uriparsing import SQLCompiler, LDAPITranslator, FilterParser, parse_filter
+from locuszoom.api.cache import LD_CACHE_BACKENDS, TwoTierCache, cache_stats, shared_memory_cache
 from locuszoom.api.search_tokenizer import SearchTokenizer
 from locuszoom.api.errors import FlaskException
+from locuszoom.api.db import server_side_cursor, execute_prepared, pool_stats
+from locuszoom.api.region_cache import RegionTable
+from locuszoom.api.queryspec import QuerySpec
+from locuszoom.api.recomb_maps import RecombMaps
+from locuszoom.api.gene_index import GeneIndex
+from locuszoom.api import redis_client, ld_client, conditional, compression, gene_index
 from six import iteritems
 from subprocess import check_output
 from copy import deepcopy
@@ -17,7 +23,6 @@ import psycopg2
 import psycopg2.sql
 import psycopg2.extras
 import redis
-import requests
 import traceback
 import gzip
 import time
@@ -39,7 +44,7 @@ def invalid_request_check():
       if w in filter_str:
         raise FlaskException(f"Invalid string {w} found in filter string", 400)
 
-def std_response(db_table, db_cols, field_to_cols=None, return_json=True, return_format=None, limit=None, filter_str=None):
+def std_response(spec, return_json=True, return_format=None, limit=None, filter_str=None, server_side=False):
   """
   Standard API response for simple cases of executing a filter against a single
   database table.
@@ -56,18 +61,18 @@ def std_response(db_table, db_cols, field_to_cols=None, return_json=True, return
   This should be executed during a request, as it retrieves parameters directly from the request.
 
   Args:
-    db_table: database table to query against
-    db_cols: possible database columns (used to sanitize user input)
-    field_to_cols: if any fields in the filter string need to be translated
-      to database columns
+    spec: QuerySpec for the table to query against (database columns, field name translations, etc.)
     return_json: should we return the jsonified response (True), or just the dictionary (False)
     return_format: specify return format, can be:
       "objects" - returns an array of dictionaries, each one representing an "object"
       "table" - returns a dictionary of arrays, where key is column name
+      "arrow" - returns an Arrow IPC stream (only if return_json is True)
 
       This parameter overrides the "format" query parameter, if specified. Leave as None to use the
       format parameter in the request.
     filter_str: Pass in a filter string if the one received with the request should be overridden
+    server_side: Execute the query on a server-side cursor, fetching rows in batches of FETCH_BATCH_SIZE.
+      Use for tables where a single request can return a large number of rows.
 
   Returns:
     Flask response w/ JSON payload containing the results of the query
@@ -79,57 +84,88 @@ def std_response(db_table, db_cols, field_to_cols=None, return_json=True, return
       * array of dictionaries
   """
 
-  # Object that converts filter strings into safe SQL statements
-  sql_compiler = SQLCompiler()
-
   # GET request parameters
   if filter_str is None:
     filter_str = request.args.get("filter")
 
-  fields_str = request.args.get("fields")
-  sort_str = request.args.get("sort")
   format_str = request.args.get("format")
 
-  if fields_str is not None:
-    # User's requested fields
-    fields = [x.strip() for x in fields_str.split(",")]
-
-    # Translate to database columns
-    if field_to_cols is not None:
-      fields = [field_to_cols.get(x,x) for x in fields]
+  # User's requested fields and sort order, translated to database columns. Only fields that we know about are
+  # accepted, to avoid injection.
+  fields = spec.fields(request.args.get("fields"))
+  sort_fields = spec.sort(request.args.get("sort"))
 
-    # To avoid injection, only accept fields that we know about
-    fields = [x for x in fields if x in db_cols]
+  if return_format == "table" or (return_format is None and (format_str is None or format_str == "")):
+    style = "table"
+  elif return_format == "objects" or format_str == "objects":
+    style = "objects"
+  elif return_json and (return_format == "arrow" or format_str == "arrow"):
+    style = "arrow"
   else:
-    fields = db_cols
-
-  if sort_str is not None:
-    # User's requested fields
-    sort_fields = [x.strip() for x in sort_str.split(",")]
+    raise FlaskException(f"Invalid format requested, should be 'table', 'objects' or 'arrow'")
 
-    # Translate to database columns
-    if field_to_cols is not None:
-      sort_fields = [field_to_cols.get(x,x) for x in sort_fields]
+  terms = parse_filter(filter_str) if filter_str is not None else []
 
-    # To avoid injection, only accept fields that we know about
-    sort_fields = [x for x in sort_fields if x in db_cols]
-  else:
-    sort_fields = None
+  # Cached rows don't carry the database types needed for the arrow schema
+  if spec.region is not None and filter_str is not None and sort_fields is None and limit is None and style != "arrow":
+    cur = spec.region.rows(terms,spec.field_to_cols,fields)
+    if cur is not None:
+      return format_response(cur,fields,spec.field_to_cols,style,return_json,spec)
 
-  sql, params = sql_compiler.to_sql(filter_str, db_table, db_cols, fields, sort_fields, field_to_cols, limit)
+  # Streamed queries run in a cursor declared on the server, which can't execute a prepared statement
+  sql, params = spec.to_sql(terms,fields,sort_fields,limit,canonical=not server_side)
 
   # text() is sqlalchemy helper object when specifying SQL as plain text string
   # allows for bind parameters to be used
-  cur = g.db.execute(text(sql),params)
-
-  if return_format == "table" or (return_format is None and (format_str is None or format_str == "")):
-    style = "table"
-  elif return_format == "objects" or format_str == "objects":
-    style = "objects"
+  if server_side:
+    # Rows are fetched from the database in batches, so client memory is bounded by the batch size
+    # rather than the size of the region. The rows must be consumed before leaving this block.
+    with server_side_cursor(g.db) as con:
+      cur = con.execute(text(sql),params)
+      return format_response(cur,fields,spec.field_to_cols,style,return_json,spec)
   else:
-    raise FlaskException(f"Invalid format requested, should be 'table' or 'objects'")
+    cur = execute_prepared(g.db,sql,params)
+    return format_response(cur,fields,spec.field_to_cols,style,return_json,spec)
+
+def cached_response(etag,family):
+  """
+  Response for a request to a dataset endpoint that can be given without running any queries: 304 Not Modified if
+  the client already has it, or the compressed response from the cache.
+
+  Args:
+    etag: entity tag for the request (see conditional.dataset_etag)
+    family: endpoint family, for the Cache-Control header
+
+  Returns:
+    Flask response, or None if the queries need to be run
+  """
+
+  if conditional.is_fresh(etag):
+    return conditional.not_modified(etag,family)
+
+  resp = compression.cached_response(etag)
+  if resp is not None:
+    return conditional.add_headers(resp,etag,family)
+
+  return None
+
+def format_response(cur,fields,field_to_cols=None,style="table",return_json=True,spec=None):
+  """
+  Consume all rows from a cursor and format them as an API response (or data, if return_json is False).
+
+  If the query was built from a QuerySpec, pass it along so that column names and types it has already
+  resolved are reused.
+  """
+
+  if style == "arrow":
+    return stream_arrow(cur,fields,field_to_cols)
 
-  data = reshape_data(cur,fields,field_to_cols,style)
+  pretty = current_app.config.get("JSONIFY_PRETTYPRINT_REGULAR") or current_app.debug
+  if return_json and style == "table" and not pretty:
+    # Encode column by column as rows arrive from the cursor, and stream the result
+    return stream_table(cur,fields,field_to_cols,spec)
+
+  data = reshape_data(cur,fields,field_to_cols,style,spec)
 
   if return_json:
     return jsonify({
@@ -139,36 +175,147 @@ def std_response(db_table, db_cols, field_to_cols=None, return_json=True, return
   else:
     return data
 
-def reshape_data(rows,fields,field_to_cols=None,style="table"):
+def reshape_data(rows,fields,field_to_cols=None,style="table",spec=None):
   # We may need to translate db columns --> field names.
-  if field_to_cols is not None:
+  if spec is not None:
+    cols_to_field = spec.cols_to_field
+    float_cols = spec.float_columns(rows)
+  elif field_to_cols is not None:
     cols_to_field = {v: k for k, v in field_to_cols.items()}
+    float_cols = None
   else:
     cols_to_field = {v: v for v in fields}
+    float_cols = None
 
   if style == "objects":
-    data = rows_to_objects(rows,fields,cols_to_field)
+    data = rows_to_objects(rows,fields,cols_to_field,float_cols)
   else: #assume style = "table"
-    data = rows_to_arrays(rows,fields,cols_to_field)
+    data = rows_to_arrays(rows,fields,cols_to_field,float_cols)
 
   return data
 
-def stringify_float(f):
-  if f is None:
-    return f
+def iter_batches(cur,size):
+  """
+  Iterate over rows from a cursor in batches (lists of rows) of at most size rows.
+  """
 
-  if math.isinf(f):
-    if f < 0:
-      return "-Infinity"
-    else:
-      return "Infinity"
+  while True:
+    rows = cur.fetchmany(size)
+    if not rows:
+      break
+
+    yield rows
+
+def stream_table(cur,fields,field_to_cols=None,spec=None):
+  """
+  Streaming equivalent of jsonify({"data": rows_to_arrays(...), "lastPage": None}).
+
+  Rows are read from the cursor in batches and encoded column by column, so the response never holds more than
+  one batch of Python row objects at a time. The record limit is checked while reading, before the first byte of
+  the response is sent.
+
+  Args:
+    cur: cursor (result proxy) from executing the query
+    fields: database columns to return
+    field_to_cols: if any fields need to be translated from database columns
+    spec: QuerySpec the query was built from, if any
+
+  Returns:
+    Flask streaming response
+  """
 
-  return f
+  if spec is not None:
+    cols_to_field = spec.cols_to_field
+    float_columns = spec.float_columns
+  elif field_to_cols is not None:
+    cols_to_field = {v: k for k, v in field_to_cols.items()}
+    float_columns = get_float_columns
+  else:
+    cols_to_field = {v: v for v in fields}
+    float_columns = get_float_columns
+
+  max_rec = current_app.config.get("MAX_RECORDS", 100000)
+  batch_size = current_app.config.get("FETCH_BATCH_SIZE", 5000)
+
+  writer = None
+  for rows in iter_batches(cur,batch_size):
+    if writer is None:
+      # Description is only guaranteed to be available once rows have been fetched
+      writer = ColumnarJSONWriter(list(cur.keys()),fields,cols_to_field,float_columns(cur))
+
+    writer.write(rows)
+    if writer.nrows > max_rec + 1:
+      raise FlaskException(f"API request attempted to retrieve more than {max_rec} records; please reduce the range of your query");
+
+  if writer is None:
+    writer = ColumnarJSONWriter(list(cur.keys()),fields,cols_to_field,[])
+
+  resp = current_app.response_class(writer.chunks(),mimetype=current_app.config["JSONIFY_MIMETYPE"])
+  resp.content_length = writer.content_length()
+  return resp
+
+def stream_arrow(cur,fields,field_to_cols=None,metadata=None):
+  """
+  Arrow IPC equivalent of stream_table(). Each batch of rows read from the cursor is encoded as a record batch. As
+  with stream_table(), the encoded batches are held until every row has been read, so that the record limit is
+  enforced before the first byte of the response is sent.
+
+  Args:
+    cur: cursor (result proxy) from executing the query
+    fields: database columns to return
+    field_to_cols: if any fields need to be translated from database columns
+    metadata: dictionary to include in the schema metadata (e.g. the "meta" section of a JSON response)
+
+  Returns:
+    Flask response
+  """
+
+  if arrowutil.pa is None:
+    raise FlaskException("Arrow format is not available on this server, use format 'table' or 'objects'",400)
+
+  if field_to_cols is not None:
+    cols_to_field = {v: k for k, v in field_to_cols.items()}
+  else:
+    cols_to_field = {v: v for v in fields}
+
+  max_rec = current_app.config.get("MAX_RECORDS", 100000)
+  batch_size = current_app.config.get("FETCH_BATCH_SIZE", 5000)
+
+  writer = None
+  for rows in iter_batches(cur,batch_size):
+    if writer is None:
+      writer = arrowutil.ArrowStreamWriter(get_type_codes(cur),fields,cols_to_field,metadata)
+
+    writer.write(rows)
+    if writer.nrows > max_rec + 1:
+      raise FlaskException(f"API request attempted to retrieve more than {max_rec} records; please reduce the range of your query");
+
+  if writer is None:
+    writer = arrowutil.ArrowStreamWriter(get_type_codes(cur),fields,cols_to_field,metadata)
+
+  chunks = writer.close()
+  resp = current_app.response_class(chunks,mimetype=arrowutil.ARROW_MIMETYPE)
+  resp.content_length = sum(len(x) for x in chunks)
+  return resp
+
+def get_type_codes(proxy):
+  """
+  Mapping of column name --> postgres type OID for the columns of a query.
+  """
+
+  if hasattr(proxy, "cursor"):
+    description = proxy.cursor.description
+  else:
+    description = proxy.description
+
+  return {x.name: x.type_code for x in description or []}
 
 def get_float_columns(proxy):
   # 700 and 701 are the OIDs for real and double precision from postgres
   if hasattr(proxy, "cursor"):
     return [x.name for x in proxy.cursor.description if x.type_code in (700, 701)]
+  elif hasattr(proxy, "float_columns"):
+    return proxy.float_columns
   elif hasattr(proxy, "description"):
     return [x.name for x in proxy.description if x.type_code in (700, 701)]
   elif isinstance(proxy, list):
@@ -181,37 +328,40 @@ def get_float_columns(proxy):
   else:
     raise ValueError("Unexpected data type for container of database rows")
 
-def rows_to_arrays(cur,fields,cols_to_field):
+def rows_to_arrays(cur,fields,cols_to_field,float_cols=None):
   data = OrderedDict()
   max_rec = current_app.config.get("MAX_RECORDS", 100000)
 
   # Figure out which columns contain floating point data
-  float_cols = get_float_columns(cur)
+  if float_cols is None:
+    float_cols = get_float_columns(cur)
+
+  # Some of the database column names don't match field names.
+  columns = [(col,cols_to_field.get(col,col),col in float_cols) for col in fields]
 
   for i, row in enumerate(cur):
-    for col in fields:
-      # Some of the database column names don't match field names.
-      field = cols_to_field.get(col,col)
+    for col, field, is_float in columns:
       val = row[col]
       if isinstance(val,dict):
         for k, v in val.items():
           if k not in data:
             data[k] = [None] * i
 
-          if col in float_cols:
+          if is_float:
             data[k].append(stringify_float(v))
           else:
             data[k].append(v)
       else:
-        v = row[col]
-        if col in float_cols:
-          v = stringify_float(v)
-
-        data.setdefault(field,[]).append(v)
+        data.setdefault(field,[]).append(val)
 
     if i > max_rec:
       raise FlaskException(f"API request attempted to retrieve more than {max_rec} records; please reduce the range of your query");
 
+  # Floats need special care to fix bad JSON encoding for infinity and other values
+  for col, field, is_float in columns:
+    if is_float and field in data:
+      sanitize_floats(data[field])
+
   if not data:
     # No data was found so fill with empty arrays
     db_cols = list(cur.keys())
@@ -220,33 +370,29 @@ def rows_to_arrays(cur,fields,cols_to_field):
 
   return data
 
-def rows_to_objects(cur,fields,cols_to_field):
+def rows_to_objects(cur,fields,cols_to_field,float_cols=None):
   data = []
   max_rec = current_app.config.get("MAX_RECORDS", 100000)
 
   # Figure out which columns contain floating point data
-  float_cols = get_float_columns(cur)
-
-  for i, row in enumerate(cur):
-    rowdict = dict(row)
-    finaldict = dict()
+  if float_cols is None:
+    float_cols = get_float_columns(cur)
 
-    # User may have requested only certain fields
-    for col in fields:
-      # Translate from database column to field name
-      field = cols_to_field.get(col,col)
-      finaldict[field] = rowdict[col]
+  # User may have requested only certain fields, translate from database column to field name
+  columns = [(col,cols_to_field.get(col,col)) for col in fields]
+  float_fields = [field for col, field in columns if col in float_cols]
 
-    # Floats need special care to fix bad JSON encoding for infinity and other values
-    for col in float_cols:
-      if finaldict.get(col) is not None:
-        finaldict[col] = stringify_float(finaldict[col])
-
-    data.append(finaldict)
+  for i, row in enumerate(cur):
+    data.append({field: row[col] for col, field in columns})
 
     if i > max_rec:
       raise FlaskException(f"API request attempted to retrieve more than {max_rec} records; please reduce the range of your query");
 
+  # Floats need special care to fix bad JSON encoding for infinity and other values
+  for field in float_fields:
+    for i, v in nonfinite_floats([d[field] for d in data]):
+      data[i][field] = v
+
   return data
 
 @bp.route("/status",methods = ["GET"])
@@ -266,18 +412,97 @@ def status():
   days, hours, minutes, seconds = list(map(int,(days,hours,minutes,round(seconds))))
   info["uptime"] = "{}d:{}h:{}m:{}s".format(days,hours,minutes,seconds)
 
+  # Connection pool usage (for this worker process)
+  info["redis_pool"] = redis_client.pool.stats()
+  info["db_pool"] = pool_stats.to_dict()
+  info["ld_requests"] = ld_client.stats()
+  info["recomb_maps"] = RECOMB_MAPS.stats()
+  info["gene_index"] = GENE_INDEX.stats()
+
   return jsonify(info)
 
+RECOMB_SPEC = QuerySpec("rest.recomb",["id","name","build","version"])
+
 @bp.route(
   "/annotation/recomb/",
   methods = ["GET"]
 )
 def recomb():
-  # Database columns and table
-  db_table = "rest.recomb"
-  db_cols = ["id","name","build","version"]
+  return std_response(RECOMB_SPEC)
+
+RECOMB_MAPS = RecombMaps("rest.recomb_results","rest.recomb")
 
-  return std_response(db_table,db_cols)
+RECOMB_REGION = RegionTable(
+  "rest.recomb_results",
+  ["id","chromosome","position","recomb_rate","pos_cm"],
+  "rest.recomb",
+  chrom_col = "chromosome",
+  start_col = "position"
+)
+
+def recomb_window(lrm,table,columns,with_middle=True):
+  """
+  Fetch the points for a recombination rate window in one query: the nearest point at or before the start of the
+  window (found by walking the (id, chromosome, position) index backward from the start), followed by every point
+  within the window, in order of position.
+
+  Args:
+    lrm: filters from FilterParser.left_middle_right()
+    table: recombination rate results table
+    columns: database columns to return
+    with_middle: if False, only the flanking point is fetched (e.g. when the middle is cached)
+
+  Returns:
+    list: flanking point (empty if there is no point before the window)
+    list: points within the window
+  """
+
+  where, params = SQLCompiler()._to_where(lrm["base"],columns,canonical=True)
+
+  left = "p{}".format(len(params) + 1)
+  params[left] = lrm["range"]["left"]
+
+  select = "SELECT {{}} AS part, {} FROM {} {}".format(",".join(columns),table," ".join(where))
+  queries = ["({} AND position <= :{} ORDER BY position DESC LIMIT 1)".format(select.format(0),left)]
+
+  if with_middle:
+    right = "p{}".format(len(params) + 1)
+    params[right] = lrm["range"]["right"]
+    queries.append("({} AND position >= :{} AND position < :{})".format(select.format(1),left,right))
+
+  # Each part has its own ORDER BY, so the union is wrapped before ordering all of it
+  sql = "SELECT * FROM ({}) w ORDER BY part, position".format(" UNION ALL ".join(queries))
+  rows = execute_prepared(g.db,sql,params).fetchall()
+
+  return [r for r in rows if r["part"] == 0], [r for r in rows if r["part"] == 1]
+
+def recomb_window_data(lrm,table,columns):
+  """
+  Recombination rates for a window from the database (see RecombMaps.window() for the format.)
+  """
+
+  # The middle of the window may already be cached, otherwise it is fetched along with the flanking point
+  middle = RECOMB_REGION.rows(lrm["middle"])
+  if middle is not None:
+    left, _ = recomb_window(lrm,table,columns,False)
+    middle = middle.fetchall()
+  else:
+    left, middle = recomb_window(lrm,table,columns,True)
+
+  if len(left) < 1:
+    left = [{"id": "chrleft", "position": lrm["range"]["left"],
+        "chromosome": lrm["range"]["chrom"], "recomb_rate": 0, "pos_cm": 0}]
+
+  # The recombination rate given for a point applies until the next point, so the window edges take the
+  # rate of the nearest point at or before them.
+  left_end = dict(left[0])
+  left_end["position"] = lrm["range"]["left"]
+
+  right_end = dict(middle[-1] if len(middle) > 0 else left[0])
+  right_end["position"] = lrm["range"]["right"]
+
+  # Rates and genetic positions are always treated as floats, even when the first row is the integer placeholder
+  return rows_to_arrays([left_end] + middle + [right_end],columns,{},["recomb_rate","pos_cm"])
 
 @bp.route(
   "/annotation/recomb/results/",
@@ -317,50 +542,22 @@ def recomb_results():
         if allowed_build != build:
           raise FlaskException(f"Invalid build {build} given for recombination rate dataset ID {dbid}")
 
+  etag = conditional.dataset_etag("rest.recomb",dataset_id,filter_str)
+  resp = cached_response(etag,"annotation")
+  if resp is not None:
+    return resp
+
   matches = fp.parse(filter_str)
   lrm = fp.left_middle_right(matches)
 
-  sql_compiler = SQLCompiler()
-  def fetch(terms,limit=None):
-    sql, params = sql_compiler.to_sql_parsed(terms,db_table,db_cols,limit=limit)
-    rows = g.db.execute(text(sql),params).fetchall()
-    return rows
-
-  def interp(at,left,right):
-    if left is None or right is None:
-        return None
-    left_at = left["position"]
-    right_at = right["position"]
-    left_r = left["recomb_rate"]
-    right_r = right["recomb_rate"]
-    result = dict(left)
-    result["recom_rate"] = left_r + (at-left_at)/(right_at-left_at) * (right_r-left_r)
-    result["position"] = at
-    return result
-
-  left = fetch(lrm["left"], 1)
-  right =  fetch(lrm["right"], 1)
-  middle = fetch(lrm["middle"])
-
-  if len(left) < 1:
-    left = [{"id": "chrleft", "position": lrm["range"]["left"],
-        "chromosome": lrm["range"]["chrom"], "recomb_rate": 0, "pos_cm": 0}]
-  if len(right) < 1:
-    right = [{"id": "chrright", "position": lrm["range"]["right"],
-        "chromosome": lrm["range"]["chrom"], "recomb_rate": 0, "pos_cm": 0}]
-
-  if len(middle) > 0:
-    left_end = interp(lrm["range"]["left"],left[0],middle[0])
-    right_end = interp(lrm["range"]["right"],middle[-1],right[0])
-  else:
-    left_end = interp(lrm["range"]["left"],left[0],right[0])
-    right_end = interp(lrm["range"]["right"],left[0],right[0])
-
-  data = reshape_data([left_end] + middle + [right_end],db_cols)
+  # Windows for a single dataset are served from the in-memory maps
+  data = RECOMB_MAPS.window(lrm)
+  if data is None:
+    data = recomb_window_data(lrm,db_table,db_cols)
 
   metadata = get_metadata(dataset_id, "recomb", "rest", {"build": "genome_build"})
 
-  return jsonify({
+  resp = jsonify({
     "data": data,
     "meta": {
       "datasets": metadata
@@ -368,72 +565,93 @@ def recomb_results():
     "lastPage": None
   })
 
+  return conditional.add_headers(resp,etag,"annotation")
+
+INTERVAL_SPEC = QuerySpec(
+  "rest.interval",
+  "id study build version type assay tissue protein histone cell_line pmid description url".split()
+)
+
 @bp.route(
   "/annotation/intervals/",
   methods = ["GET"]
 )
 def intervals():
-  db_table = "rest.interval"
-  db_cols = "id study build version type assay tissue protein histone cell_line pmid description url".split()
+  return std_response(INTERVAL_SPEC)
+
+INTERVAL_REGION = RegionTable(
+  "rest.interval_results",
+  "id public_id chrom start end strand annotation".split(),
+  "rest.interval",
+  start_col = "start",
+  end_col = "end"
+)
 
-  return std_response(db_table,db_cols)
+INTERVAL_RESULTS_SPEC = QuerySpec(
+  "rest.interval_results",
+  "id public_id chrom start end strand annotation".split(),
+  dict(chromosome = "chrom"),
+  region = INTERVAL_REGION
+)
 
 @bp.route(
   "/annotation/intervals/results/",
   methods = ["GET"]
 )
 def interval_results():
-  db_table = "rest.interval_results"
-  db_cols = "id public_id chrom start end strand annotation".split()
+  filter_stmts = FilterParser().statements(request.args.get("filter")) or {}
+  etag = conditional.dataset_etag("rest.interval",filter_stmts["id"].value if "id" in filter_stmts else None)
+  resp = cached_response(etag,"annotation")
+  if resp is not None:
+    return resp
 
-  field_to_col = dict(
-    chromosome = "chrom"
-  )
+  resp = std_response(INTERVAL_RESULTS_SPEC,server_side=True)
+  return conditional.add_headers(resp,etag,"annotation")
 
-  return std_response(db_table,db_cols,field_to_col)
+SNPS_SPEC = QuerySpec("rest.dbsnp_master","id genome_build dbsnp_build taxid organism".split())
 
 @bp.route(
   "/annotation/snps/",
   methods = ["GET"]
 )
 def snps():
-  db_table = "rest.dbsnp_master"
-  db_cols = "id genome_build dbsnp_build taxid organism".split()
+  return std_response(SNPS_SPEC)
 
-  return std_response(db_table,db_cols)
+SNPS_RESULTS_SPEC = QuerySpec(
+  "rest.dbsnp_snps",
+  "id rsid chrom pos ref alt".split(),
+  dict(chromosome = "chrom")
+)
 
 @bp.route(
   "/annotation/snps/results/",
   methods = ["GET"]
 )
 def snps_results():
-  db_table = "rest.dbsnp_snps"
-  db_cols = "id rsid chrom pos ref alt".split()
-
-  field_to_col = dict(
-    chromosome = "chrom"
-  )
+  return std_response(SNPS_RESULTS_SPEC,server_side=True)
 
-  return std_response(db_table,db_cols,field_to_col)
+GWASCAT_SPEC = QuerySpec("rest.gwascat_master","id name genome_build date_inserted catalog_version".split())
 
 @bp.route(
   "/annotation/gwascatalog/",
   methods = ["GET"]
 )
 def gwascat():
-  db_table = "rest.gwascat_master"
-  db_cols = "id name genome_build date_inserted catalog_version".split()
+  return std_response(GWASCAT_SPEC)
 
-  return std_response(db_table,db_cols)
+GWASCAT_REGION = RegionTable(
+  "rest.gwascat_data",
+  "id variant rsid chrom pos ref alt trait trait_group risk_allele risk_frq log_pvalue or_beta genes pmid pubdate first_author study".split(),
+  "rest.gwascat_master"
+)
+
+GWASCAT_RESULTS_SPEC = QuerySpec(GWASCAT_REGION.table,GWASCAT_REGION.columns,region=GWASCAT_REGION)
 
 @bp.route(
   "/annotation/gwascatalog/results/",
   methods = ["GET"]
 )
 def gwascat_results():
-  db_table = "rest.gwascat_data"
-  db_cols = "id variant rsid chrom pos ref alt trait trait_group risk_allele risk_frq log_pvalue or_beta genes pmid pubdate first_author study".split()
-
   filter_str = request.args.get("filter")
   if filter_str is None:
     raise FlaskException("No filter string specified",400)
@@ -463,7 +681,12 @@ def gwascat_results():
         if allowed_build != build:
           raise FlaskException(f"Invalid build {build} given for GWAS catalog ID {dbid}")
 
-  json = std_response(db_table,db_cols,return_json=False,filter_str=filter_str)
+  etag = conditional.dataset_etag("rest.gwascat_master",dataset_id,filter_str)
+  resp = cached_response(etag,"annotation")
+  if resp is not None:
+    return resp
+
+  json = std_response(GWASCAT_RESULTS_SPEC,return_json=False,filter_str=filter_str)
 
   if 'decompose' in request.args:
     if isinstance(json, list):
@@ -524,7 +747,7 @@ def gwascat_results():
 
   metadata = get_metadata(dataset_id, "gwascat_master", "rest", {"catalog_version": "version"})
 
-  return jsonify({
+  resp = jsonify({
     "data": json,
     "meta": {
       "datasets": metadata
@@ -532,6 +755,15 @@ def gwascat_results():
     "lastPage": None
   })
 
+  return conditional.add_headers(resp,etag,"annotation")
+
+# For some reason, this database table has columns that don't match the field names in the filter string.
+SINGLE_SPEC = QuerySpec(
+  "rest.assoc_master",
+  "id study trait tech build imputed analysis pmid pubdate first_author last_author".split(),
+  dict(date = "pubdate")
+)
+
 @bp.route(
   "/statistic/single/",
   methods = ["GET"]
@@ -542,15 +774,20 @@ def gwascat_results():
   methods = ["GET"]
 )
 def single():
-  db_table = "rest.assoc_master"
-  db_cols = "id study trait tech build imputed analysis pmid pubdate first_author last_author".split()
+  return std_response(SINGLE_SPEC)
 
-  # For some reason, this database table has columns that don't match the field names in the filter string.
-  field_to_col = dict(
-    date = "pubdate"
+SINGLE_RESULTS_SPEC = QuerySpec(
+  "rest.assoc_results",
+  "id variant_name chrom pos ref_allele ref_freq log_pvalue beta se score_stat".split(),
+  dict(
+    analysis = "id",
+    variant = "variant_name",
+    chromosome = "chrom",
+    position = "pos",
+    score_test_stat = "score_stat",
+    ref_allele_freq = "ref_freq"
   )
-
-  return std_response(db_table,db_cols,field_to_col)
+)
 
 @bp.route(
   "/statistic/single/results/",
@@ -562,18 +799,6 @@ def single():
   methods = ["GET"]
 )
 def single_results():
-  db_table = "rest.assoc_results"
-  db_cols = "id variant_name chrom pos ref_allele ref_freq log_pvalue beta se score_stat".split()
-
-  field_to_col = dict(
-    analysis = "id",
-    variant = "variant_name",
-    chromosome = "chrom",
-    position = "pos",
-    score_test_stat = "score_stat",
-    ref_allele_freq = "ref_freq"
-  )
-
   limit = request.args.get("limit")
   try:
     if limit is not None:
@@ -585,7 +810,15 @@ def single_results():
   if qfilter is None:
     raise FlaskException("Must provide filter with this query",400)
 
-  return std_response(db_table,db_cols,field_to_col,limit=limit)
+  filter_stmts = FilterParser().statements(qfilter)
+  analysis = filter_stmts.get("analysis",filter_stmts.get("id"))
+  etag = conditional.dataset_etag("rest.assoc_master",analysis.value if analysis is not None else None)
+  resp = cached_response(etag,"statistic")
+  if resp is not None:
+    return resp
+
+  resp = std_response(SINGLE_RESULTS_SPEC,limit=limit,server_side=True)
+  return conditional.add_headers(resp,etag,"statistic")
 
 @bp.route(
   "/statistic/phewas/",
@@ -629,11 +862,14 @@ def phewas():
   if return_fmt is None or return_fmt == "":
     return_fmt = "table"
 
-  if return_fmt not in ("table","objects"):
-    raise FlaskException(400,"format must be either 'table' or 'objects'")
+  if return_fmt not in ("table","objects","arrow"):
+    raise FlaskException(400,"format must be either 'table', 'objects' or 'arrow'")
 
   cur = g.db.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
   cur.callproc("rest.phewas_query",[variant,builds])
+  if return_fmt == "arrow":
+    return stream_arrow(cur,db_cols,metadata={"build": builds})
+
   data = reshape_data(cur,db_cols,None,return_fmt)
   return jsonify({
     "meta": {
@@ -662,15 +898,25 @@ def ld_results():
   if filter_str is None:
     raise FlaskException("No filter string specified",400)
 
-  # Figure out the LD API URL to send the request through
-  #base_url = "http://localhost:8888/api_ld/ld?"
-  base_url = "http://portaldev.sph.umich.edu/api_ld/ld?"
+  # Translate to the LD server's query parameters
   trans = LDAPITranslator()
-  param_str, param_dict = trans.to_refsnp_url(filter_str)
-  final_url = base_url + param_str
+  ld_params, param_dict = trans.to_refsnp_params(filter_str)
 
   # Cache
-  ld_cache = RedisIntervalCache(g.redis_client)
+  ld_cache_class = LD_CACHE_BACKENDS[current_app.config.get("LD_CACHE_BACKEND","zset")]
+  ld_cache = ld_cache_class(
+    redis_client.get_client(),
+    ttl = current_app.config.get("LD_CACHE_TTL",14 * 24 * 3600),
+    panel_bytes = current_app.config.get("LD_CACHE_PANEL_BYTES",2 * 1024**3),
+    admit_size = current_app.config.get("LD_CACHE_ADMIT_SIZE",int(1.5E6)),
+    doorkeeper_ttl = current_app.config.get("LD_CACHE_DOORKEEPER_TTL",3600)
+  )
+
+  # Optionally keep recently used variants in this process, in front of redis
+  l1_bytes = current_app.config.get("LD_MEMORY_CACHE_BYTES",64 * 1024**2)
+  if l1_bytes:
+    l1 = shared_memory_cache(l1_bytes,current_app.config.get("LD_MEMORY_CACHE_TTL",60))
+    ld_cache = TwoTierCache(l1,ld_cache)
 
   # Cache key for this particular request.
   # Note that in Daniel's API, for now, "reference" is implicitly
@@ -720,92 +966,123 @@ def ld_results():
 
   outer["data"] = data
 
-  # Do we need to compute, or is the cache sufficient?
-  cache_data = None
+  # Which parts of the region (if any) do we need to compute?
+  cache_data = {}
+  gaps = [(start,end)]
   try:
-    cache_data = ld_cache.retrieve(cache_key,start,end)
+    cache_data, gaps = ld_cache.retrieve_partial(cache_key,start,end)
   except redis.ConnectionError:
     print("Warning: cache retrieval failed (redis was unable to connect)")
   except:
     print("Error: redis connected, but retrieving data failed")
     traceback.print_exc()
 
-  if cache_data is None:
-    # Need to compute. Either the range given is larger than we've previously computed,
-    # or redis is down.
-    print("Cache miss for {reference}__{refvariant} in {start}-{end} ({rlength:,.2f}kb), recalculating".format(
+  # Positions in LD with the reference variant: (position, variant, rsquare)
+  pairs = [(position,ld_pair["name2"],ld_pair["rsquare"]) for position, ld_pair in iteritems(cache_data)]
+
+  if len(gaps) > current_app.config.get("LD_MAX_GAPS",4):
+    # Cached data is too fragmented to be worth requesting piece by piece. The cached positions within the merged
+    # request will be computed again, so only keep those outside of it.
+    gaps = [(gaps[0][0],gaps[-1][1])]
+    pairs = [p for p in pairs if p[0] < gaps[0][0] or p[0] > gaps[0][1]]
+
+  if len(gaps) == 0:
+    print("Cache *match* for {reference}__{refvariant} in {start}-{end} ({rlength:,.2f}kb), using cached data".format(
       reference=reference,
       refvariant=refvariant,
       start=start,
       end=end,
       rlength=rlength/1000
     ))
+  else:
+    print("Cache miss for {reference}__{refvariant} in {start}-{end} ({rlength:,.2f}kb), calculating {gaps}".format(
+      reference=reference,
+      refvariant=refvariant,
+      start=start,
+      end=end,
+      rlength=rlength/1000,
+      gaps=", ".join("{}-{}".format(*gap) for gap in gaps)
+    ))
 
-    # Fire off the request to the LD server.
-    try:
-      resp = requests.get(final_url)
-    except Exception as e:
-      raise FlaskException("Failed retrieving data from LD server, error was {}".format(e.message),500)
-
-    # Did it come back OK?
-    if not resp.ok:
-      raise FlaskException("Failed retrieving data from LD server, error was {}".format(resp.reason),500)
-
-    # Get JSON
-    ld_json = resp.json()
+  computed = []
+  for gap_start, gap_end in gaps:
+    gap_params = ld_params.copy()
+    gap_params["startbp"] = gap_start
+    gap_params["endbp"] = gap_end
 
-    # Store in format needed for API response
-    for obj in ld_json["pairs"]:
-      data["chromosome2"].append(ld_json["chromosome"])
-      data["position2"].append(obj["position2"])
-      data["rsquare"].append(JSONFloat(obj["rsquare"]))
-      data["variant2"].append(obj["name2"])
+    # Fire off the request to the LD server for only the part of the region that isn't cached. Identical
+    # requests that miss the cache at the same time share a single call.
+    ld_json = ld_client.fetch_ld_coalesced((cache_key,chromosome,gap_start,gap_end),gap_params)
+    pairs.extend((obj["position2"],obj["name2"],obj["rsquare"]) for obj in ld_json["pairs"])
 
-    # Store data to cache
     keep = ("name2","rsquare")
     for_cache = dict(zip(
       (x["position2"] for x in ld_json["pairs"]),
       (dict((x,d[x]) for x in keep) for d in ld_json["pairs"])
     ))
 
-    if len(for_cache) > 0:
-      # If we actually received LD data for this variant, store it in the cache.
+    computed.append((gap_start,gap_end,for_cache))
+
+  # Store data to cache. If the LD server returned nothing at all for this variant (and nothing was cached)
+  # the variant is likely not in the reference panel, and that shouldn't be remembered.
+  admitted = False
+  if len(pairs) > 0 and len(computed) > 0:
+    try:
+      admitted = ld_cache.admit(cache_key,start,end)
+    except redis.ConnectionError:
+      print("Warning: cache storage failed (redis was unable to connect)")
+
+  if admitted:
+    for gap_start, gap_end, for_cache in computed:
       try:
-        ld_cache.store(cache_key,start,end,for_cache)
+        ld_cache.store(cache_key,gap_start,gap_end,for_cache)
       except redis.ConnectionError:
         print("Warning: cache storage failed (redis was unable to connect)")
+        break
       except:
         print("Error: storing data in cache failed, traceback was: ")
         traceback.print_exc()
+        break
 
-  else:
-    print("Cache *match* for {reference}__{refvariant} in {start}-{end} ({rlength:,.2f}kb), using cached data".format(
-      reference=reference,
-      refvariant=refvariant,
-      start=start,
-      end=end,
-      rlength=rlength/1000
-    ))
-
-    # We can just use the cache's data directly.
-    for position, ld_pair in iteritems(cache_data):
-      data["chromosome2"].append(chromosome)
-      data["position2"].append(position)
-      data["rsquare"].append(JSONFloat(ld_pair["rsquare"]))
-      data["variant2"].append(ld_pair["name2"])
+  # Store in format needed for API response
+  pairs.sort(key=lambda x: x[0])
+  for position, variant, rsquare in pairs:
+    data["chromosome2"].append(chromosome)
+    data["position2"].append(position)
+    data["rsquare"].append(JSONFloat(rsquare))
+    data["variant2"].append(variant)
 
   final_resp = jsonify(outer)
 
   return final_resp
 
+@bp.route(
+  "/statistic/pair/LD/cache/",
+  methods = ["GET"]
+)
+def ld_cache_status():
+  """
+  LD cache counters (hits, l1_hits, partial_hits, misses, rejected, evictions), summed over all API processes.
+  """
+
+  try:
+    stats = cache_stats(redis_client.get_client())
+  except redis.ConnectionError:
+    raise FlaskException("LD cache is not available",503)
+
+  for k in ("hits","l1_hits","partial_hits","misses","rejected","evictions"):
+    stats.setdefault(k,0)
+
+  return jsonify({"data": stats, "lastPage": None})
+
+GENE_SOURCES_SPEC = QuerySpec("rest.gene_master","id source version genome_build taxid organism".split())
+
 @bp.route(
   "/annotation/genes/sources/",
   methods = ["GET"]
 )
 def gene_sources():
-  db_table = "rest.gene_master"
-  db_cols = "id source version genome_build taxid organism".split()
-  return std_response(db_table,db_cols)
+  return std_response(GENE_SOURCES_SPEC)
 
 def fetch_distinct_builds(master_table, build_column="genome_build", schema="rest"):
   """
@@ -861,10 +1138,10 @@ def fetch_recommended_id(build, table):
   :return: ID for the recommended dataset
   """
   query = psycopg2.sql.SQL("SELECT * FROM rest.recommended WHERE db_table = %s AND genome_build = %s")
-  con = g.db.engine.raw_connection()
-  cur = con.cursor()
+  cur = g.db.connection.cursor()
   cur.execute(query, (table, build,))
   res = cur.fetchone()
+  cur.close()
   return res[0] if res is not None else None
 
 def get_metadata(dbid, table, schema="rest", rename=None):
@@ -908,12 +1185,23 @@ def get_metadata(dbid, table, schema="rest", rename=None):
 
   return final
 
+GENE_REGION = RegionTable(
+  "rest.gene_data",
+  "id gene_id gene_name chrom start end strand annotation".split(),
+  "rest.gene_master",
+  start_col = "start",
+  end_col = "end",
+  where = "feature_type = 'gene'"
+)
+
+GENE_INDEX = GeneIndex(GENE_REGION)
+
 @bp.route(
   "/annotation/genes/",
   methods = ["GET"]
 )
 def genes():
-  db_table = "rest.gene_data"
+  # Columns of rest.gene_data that can be filtered on
   db_cols = "id feature_type gene_id gene_name chrom start end strand transcript_id exon_id annotation".split()
 
   field_to_col = {
@@ -950,87 +1238,42 @@ def genes():
         if allowed_build != build:
           raise FlaskException(f"Invalid build {build} given for source ID {v}")
 
-  sql_compiler = SQLCompiler()
-
-  cols = "id gene_id gene_name chrom start end strand annotation".split()
-  sql_stmt, sql_params = sql_compiler.to_sql(orig_filter,db_table,db_cols,cols,None,field_to_col)
-  sql_stmt += " AND feature_type = 'gene'"
-
-  cur = g.db.execute(text(sql_stmt),sql_params)
-  dgenes = {}
-  genes_arr = []
-  for row in cur:
-    gene_data = dict(zip(cols,row))
-    annotation = gene_data.pop("annotation")
-    gene_data["gene_type"] = annotation["gene_type"]
-    gene = Gene(**gene_data)
-    dgenes[gene_data["gene_id"]] = gene
-    genes_arr.append(gene)
-
-  # Now retrieve transcripts/exons
-  # Only retrieve if there were genes found in the region
-  skip_transcripts = request.args.get("transcripts","").lower() in ("f","false","no")
-  if not skip_transcripts and len(genes_arr) > 0:
-    cols = "id feature_type gene_id chrom start end strand transcript_id exon_id".split()
-    trans_keys = "transcript_id chrom start end strand".split()
-    exon_keys = "exon_id chrom start end strand".split()
-    dtranscripts = {}
-
-    sql_stmt = (
-      "SELECT {} from {} "
-      "WHERE id in :p1 AND gene_id IN :p2 AND feature_type IN ('transcript','exon') "
-      "ORDER BY CASE feature_type WHEN 'transcript' THEN 1 WHEN 'exon' THEN 2 ELSE 3 END "
-    ).format(",".join(map(sql_compiler.quote_keywords,cols)),db_table)
-
-    sql_params = {
-      "p1": tuple(sources),
-      "p2": tuple(dgenes.keys()),
-    }
-
-    cur = g.db.execute(text(sql_stmt),sql_params)
-    for row in cur:
-      rowd = dict(zip(cols,row))
+  etag = conditional.dataset_etag("rest.gene_master",sources,orig_filter)
+  resp = cached_response(etag,"annotation")
+  if resp is not None:
+    return resp
 
-      if rowd["feature_type"] == "transcript":
-        tx_id = row["transcript_id"]
-        gene_id = row["gene_id"]
-        chrom = row["chrom"]
-
-        transcript = dtranscripts.get(tx_id,None)
-        if transcript is None:
-          transcript_data = {k: rowd[k] for k in trans_keys}
-          transcript = Transcript(**transcript_data)
-          dtranscripts[tx_id] = transcript
-          dgenes[gene_id].add_transcript(transcript)
-
-      elif rowd["feature_type"] == "exon":
-        gene_id = row["gene_id"]
-        tx_id = row["transcript_id"]
-        exon_id = row["exon_id"]
-        exon_data = {k: rowd[k] for k in exon_keys}
-        exon = Exon(**exon_data)
-
-        gene = dgenes.get(gene_id)
-        if gene is not None:
-          gene.add_exon(exon)
+  terms = parse_filter(orig_filter)
+  skip_transcripts = request.args.get("transcripts","").lower() in ("f","false","no")
 
-        transcript = dtranscripts.get(tx_id)
-        if transcript is not None:
-          transcript.add_exon(exon)
+  # Regions are answered from the index of pre-encoded genes when possible
+  pretty = current_app.config.get("JSONIFY_PRETTYPRINT_REGULAR") or current_app.debug
+  found = GENE_INDEX.genes(terms,field_to_col,not skip_transcripts) if not pretty else None
+  if found is not None:
+    metadata = get_metadata(sources, "gene_master", "rest")
+    resp = gene_index.json_response(found,{"datasets": metadata})
+    return conditional.add_headers(resp,etag,"annotation")
 
-  json_genes = [gene.to_dict() for gene in genes_arr]
+  # Genes matching the filter, along with their transcripts and exons, in one query
+  where, sql_params = SQLCompiler()._to_where(terms,db_cols,field_to_col,canonical=True)
+  sql_stmt = gene_index.features_sql(" ".join(where[1:]),not skip_transcripts)
+  genes_arr = gene_index.assemble_genes(execute_prepared(g.db,sql_stmt,sql_params))
 
   metadata = get_metadata(sources, "gene_master", "rest")
 
-  outer = {
-    "data": json_genes,
-    "meta": {
-      "datasets": metadata
-    },
-    "lastPage": None
-  }
+  if pretty:
+    outer = {
+      "data": [gene.to_dict() for gene in genes_arr],
+      "meta": {
+        "datasets": metadata
+      },
+      "lastPage": None
+    }
+
+    return conditional.add_headers(jsonify(outer),etag,"annotation")
 
-  return jsonify(outer)
+  resp = gene_index.json_response([gene.to_json().encode("utf-8") for gene in genes_arr],{"datasets": metadata})
+  return conditional.add_headers(resp,etag,"annotation")
 
 @bp.route(
   "/annotation/omnisearch/",
@@ -1076,8 +1319,8 @@ def omnisearch():
           "interval_end": "end"
         }
 
-        sql, params = sql_complier.to_sql(filter_str, db_table, ok_fields, db_cols, sort_fields, fields_to_col, None)
-        cur = g.db.execute(text(sql), params)
+        sql, params = sql_complier.to_sql(filter_str, db_table, ok_fields, db_cols, sort_fields, fields_to_col, None, canonical=True)
+        cur = execute_prepared(g.db, sql, params)
 
         results = cur.fetchmany(2)
         if len(results)==1:
@@ -1127,8 +1370,8 @@ def omnisearch():
         db_table = "rest.dbsnp_snps"
         sort_fields = ["chrom","pos"]
         db_cols = "id rsid chrom pos ref alt".split()
-        sql, params = sql_complier.to_sql(filter_str, db_table, db_cols, fields, sort_fields, None)
-        cur = g.db.execute(text(sql), params)
+        sql, params = sql_complier.to_sql(filter_str, db_table, db_cols, fields, sort_fields, None, canonical=True)
+        cur = execute_prepared(g.db, sql, params)
         results = cur.fetchmany(2)
         if len(results)==1:
             row = results[0]
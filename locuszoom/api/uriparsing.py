@@ -1,6 +1,17 @@
 #!/usr/bin/env python
-from pyparsing import Combine, Word, Literal, Optional, oneOf, Group, ZeroOrMore, Suppress, quotedString, removeQuotes, alphanums, nums, alphas, ParseResults, StringEnd
-from collections import namedtuple
+from pyparsing import Combine, Word, Literal, Optional, oneOf, Group, ZeroOrMore, Suppress, quotedString, removeQuotes, alphanums, nums, alphas, StringEnd, ParserElement
+from collections import namedtuple, OrderedDict
+from functools import lru_cache
+import string
+import re
+from six import iteritems
+
+# Memoize intermediate parse results. The filter grammar backtracks over the numeric
+# alternatives (sci | float | int) for every value on the right hand side.
+ParserElement.enablePackrat()
+
+# Number of distinct filter strings to keep parsed results for (per process)
+FILTER_CACHE_SIZE = 1024
 
 class InvalidFieldException(Exception):
   pass
@@ -11,54 +22,249 @@ class InvalidOperatorException(Exception):
 class InvalidValueException(Exception):
   pass
 
+# A single parsed statement from a filter string, e.g. "position ge 1000".
+# rhs is always a tuple, even if only one value was given.
+Term = namedtuple("Term","lhs comp rhs")
+
 def parse_add(*args, **kwargs):
     op = kwargs.get("op", "and")
-    x = args[0]
-    for y in args[1:]:
-        x = x + ParseResults(op) + y
-    return ParseResults(x)
+    x = ()
+    for y in args:
+        if len(y) == 0:
+            continue
+        x = x + (op,) + tuple(y) if len(x) > 0 else tuple(y)
+    return x
 
 def parse_join(x, op="and"):
+    if len(x) == 0:
+        return ()
     result = [op] * (len(x) * 2 - 1)
     result[0::2] = x
-    return ParseResults(result)
+    return tuple(result)
 
+def _grammar():
+  """
+  Pyparsing grammar to parse the filter string.
+  """
 
-class FilterParser(object):
-  def __init__(self):
-    self.__grammar()
+  float_ = Combine(Word(nums) + Literal(".") + Word(nums)).setParseAction(lambda x,y,z: float(z[0]))
+  sci = Combine(Word(nums) + Optional(".") + Optional(Word(nums)) + oneOf("e E") + Optional("-") + Word(nums)).setParseAction(lambda x,y,z: float(z[0]))
+  int_ = Word(nums).setParseAction(lambda x,y,z: int(z[0]))
 
-  def __grammar(self):
-    """
-    Pyparsing grammar to parse the filter string.
-    """
+  comp = oneOf("in eq gt lt ge le < > = like",caseless=True).setResultsName("comp")
+  op = oneOf("and or",caseless=True).setResultsName("op")
+
+  lhs = Word(alphanums+"_").setResultsName("lhs")
+  element = sci | float_ | int_ | quotedString.setParseAction(removeQuotes) | Word(alphanums)
+  rhs = (element + ZeroOrMore(Suppress(",") + element)).setResultsName("rhs")
+
+  stmt = Group(
+    lhs + comp + rhs
+  ).setResultsName("statement")
+
+  expr = stmt + ZeroOrMore(op + stmt) + StringEnd()
+
+  return expr
+
+# The grammar is stateless, so it is only built once per process.
+GRAMMAR = _grammar()
+
+_WHITESPACE = frozenset(" \t\r\n")
+_LHS_CHARS = frozenset(string.ascii_letters + string.digits + "_")
+_WORD_CHARS = frozenset(string.ascii_letters + string.digits)
+_ALPHA_CHARS = frozenset(string.ascii_letters)
+_WORD_COMPS = frozenset("in eq gt lt ge le like".split())
+_SYMBOL_COMPS = frozenset("<>=")
+_OPS = frozenset(["and","or"])
+
+# Same alternatives (and order) as sci | float_ | int_ in the grammar
+_NUMBER = re.compile(r"\d+(?:\.\d*)?[eE]-?\d+|\d+\.\d+|\d+")
+
+def fast_parse_filter(query):
+  """
+  Hand-written parser for the common subset of the filter grammar, e.g.
+
+    analysis in 3 and chromosome in '16' and position ge 100 and position le 200
+
+  This runs in linear time and avoids pyparsing entirely. It is deliberately strict: statements, values and
+  conjunctions must be separated in the usual way, and quoted strings must not contain escapes. Anything it does
+  not recognize returns None, so the caller can fall back to the full grammar (which also produces the error
+  message for invalid input.)
+
+  Args:
+    query: Filter string
+
+  Returns:
+    tuple: same structure as parse_filter(), or None if the string is outside the supported subset
+  """
+
+  if "\t" in query:
+    # pyparsing expands tabs to spaces before parsing, which changes the contents of quoted strings
+    return None
+
+  n = len(query)
+  i = 0
+  terms = []
+
+  def skip_ws(i):
+    while i < n and query[i] in _WHITESPACE:
+      i += 1
+    return i
+
+  def run(i, chars):
+    j = i
+    while j < n and query[j] in chars:
+      j += 1
+    return j
+
+  def delimited(i):
+    # Values must be followed by whitespace, a comma, or the end of the string
+    return i == n or query[i] in _WHITESPACE or query[i] == ","
+
+  while True:
+    # Left hand side (field name)
+    i = skip_ws(i)
+    j = run(i, _LHS_CHARS)
+    if j == i:
+      return None
+
+    lhs = query[i:j]
+
+    # Comparison operator
+    i = skip_ws(j)
+    if i < n and query[i] in _SYMBOL_COMPS:
+      comp = query[i]
+      i += 1
+    else:
+      j = run(i, _ALPHA_CHARS)
+      comp = query[i:j].lower()
+      if comp not in _WORD_COMPS or j == n or query[j] not in _WHITESPACE:
+        return None
+
+      i = j
+
+    # Right hand side, one or more comma separated values
+    rhs = []
+    while True:
+      i = skip_ws(i)
+      if i == n:
+        return None
+
+      c = query[i]
+      if c in "'\"":
+        j = i + 1
+        while j < n and query[j] != c:
+          if query[j] in "\\\r\n":
+            return None
+          j += 1
+
+        if j == n or (j + 1 < n and query[j + 1] == c):
+          # Unterminated, or a doubled quote (escape) that the full grammar handles
+          return None
+
+        value = query[i + 1:j]
+        j += 1
+      elif c in string.digits:
+        m = _NUMBER.match(query, i)
+        j = m.end()
+        text = m.group(0)
+        value = float(text) if ("." in text or "e" in text or "E" in text) else int(text)
+      elif c in _WORD_CHARS:
+        j = run(i, _WORD_CHARS)
+        value = query[i:j]
+      else:
+        return None
+
+      if not delimited(j):
+        return None
+
+      rhs.append(value)
+      i = skip_ws(j)
+      if i < n and query[i] == ",":
+        i += 1
+      else:
+        break
 
-    float_ = Combine(Word(nums) + Literal(".") + Word(nums)).setParseAction(lambda x,y,z: float(z[0]))
-    sci = Combine(Word(nums) + Optional(".") + Optional(Word(nums)) + oneOf("e E") + Optional("-") + Word(nums)).setParseAction(lambda x,y,z: float(z[0]))
-    int_ = Word(nums).setParseAction(lambda x,y,z: int(z[0]))
+    terms.append(Term(lhs, comp, tuple(rhs)))
 
-    comp = oneOf("in eq gt lt ge le < > = like",caseless=True).setResultsName("comp")
-    op = oneOf("and or",caseless=True).setResultsName("op")
+    # End of string, or a conjunction followed by another statement
+    if i == n:
+      return tuple(terms)
 
-    lhs = Word(alphanums+"_").setResultsName("lhs")
-    element = sci | float_ | int_ | quotedString.setParseAction(removeQuotes) | Word(alphanums)
-    rhs = (element + ZeroOrMore(Suppress(",") + element)).setResultsName("rhs")
+    j = run(i, _ALPHA_CHARS)
+    op = query[i:j].lower()
+    if op not in _OPS or j == n or query[j] not in _WHITESPACE:
+      return None
 
-    stmt = Group(
-      lhs + comp + rhs
-    ).setResultsName("statement")
+    terms.append(op)
+    i = j
 
-    expr = stmt + ZeroOrMore(op + stmt) + StringEnd()
+def pyparse_filter(query):
+  """
+  Parse a filter string using the full pyparsing grammar. See parse_filter().
+  """
 
-    self.grammar = expr
+  matches = GRAMMAR.parseString(query)
+  return tuple(m if isinstance(m,str) else Term(m.lhs,m.comp,tuple(m.rhs)) for m in matches)
+
+@lru_cache(maxsize=FILTER_CACHE_SIZE)
+def parse_filter(query):
+  """
+  Parse a filter string into a sequence of terms and conjunctions.
+
+  Typical filter strings are handled by fast_parse_filter(). Anything else is parsed with the full grammar.
+
+  Results are cached by filter string, so they are returned as immutable tuples and must not be modified.
+
+  Example:
+
+    In [1]: parse_filter("source in 1, 2 and gene_name like 'TCF*'")
+    Out[1]:
+    (Term(lhs='source', comp='in', rhs=(1, 2)),
+     'and',
+     Term(lhs='gene_name', comp='like', rhs=('TCF*',)))
+
+  Args:
+    query: Filter string
+
+  Returns:
+    tuple: Each element is either a Term, or a conjunction ("and", "or")
+
+  Raises:
+    ParseException: if the filter string is not valid
+  """
+
+  terms = fast_parse_filter(query)
+  if terms is None:
+    terms = pyparse_filter(query)
+
+  return terms
+
+# Filter strings representative of what we receive, used for tests and benchmarks
+EXAMPLE_FILTERS = [
+  "analysis in 3, 4 and chromosome eq 10 and start gt 10 and end lt 10000",
+  "analysis in 1 and chromosome in 20, 22 and start gt 1 and end le 20",
+  "analysis in 5, 6",
+  "some_field eq '20' and another_field eq 99",
+  "id gt 3 and pval lt 5.341e-14",
+  "analysis in 3 and chromosome in 'chrX','chrY' and start gt 5000",
+  "thresholds in 3.7, 4.6, 5.2 and chromsome eq 20",
+  "analysis in 3,4 and start > 42 and end < 800",
+  "reference eq 1 and chromosome2 eq '9'",
+  "reference eq 1 and chromosome2 eq '9' and position2 ge 16961 and position2 le 16967",
+  "reference eq 1 and chromosome2 eq '9' and position2 ge 16961 and position2 le 16967 and variant1 eq '9:16918_G/C'",
+  "source in 1 and gene_name like 'TCF*'"
+]
+
+class FilterParser(object):
+  def __init__(self):
+    self.grammar = GRAMMAR
 
   def StatementLiteral(self, lhs, comp, rhs):
-    return ParseResults(lhs, "lhs", False)  + \
-        ParseResults(comp, "comp", False) + \
-        ParseResults([rhs], "rhs", True)
+    return Term(lhs, comp, (rhs,))
 
   def parse(self,query):
-    matches = self.grammar.parseString(query)
+    matches = parse_filter(query)
     for match in matches:
       yield match
 
@@ -92,7 +298,7 @@ class FilterParser(object):
     """
 
     if query is not None:
-      matches = self.grammar.parseString(query)
+      matches = parse_filter(query)
     else:
       return
 
@@ -111,7 +317,7 @@ class FilterParser(object):
         if comp == "in":
           rhs = list(match.rhs)
         else:
-          rhs = list(match.rhs)[0]
+          rhs = match.rhs[0]
 
         params[lhs] = Statement(lhs,comp,rhs)
 
@@ -131,9 +337,9 @@ class FilterParser(object):
           continue
         else:
           raise Exception("Unable to handle '{}' conjunction".format(m))
-      field = m[0]
-      op = m[1]
-      val = m[2]
+      field = m.lhs
+      op = m.comp
+      val = m.rhs[0]
       if field == "chromosome":
         if op == "eq":
           chrom = val
@@ -160,7 +366,7 @@ class FilterParser(object):
     return resp, parse_join(uncaught)
 
   def left_middle_right(self, matches):
-    """return filters for left, middle and right of genomic range"""
+    """return filters for left, middle and right of genomic range (and "base", the filter without the range)"""
     genome_range, other_filter = self.find_genome_range(matches)
 
     chrom = self.StatementLiteral("chromosome", "eq", genome_range["chrom"])
@@ -174,27 +380,12 @@ class FilterParser(object):
     in_right = self.StatementLiteral("position", "lt", genome_range["right"])
     middle_filter = parse_add(parse_join([chrom, in_right, in_left]), other_filter)
     return {"left": left_filter, "right": right_filter, "middle": middle_filter, \
-      "range": genome_range}
+      "range": genome_range, "base": parse_add(parse_join([chrom]), other_filter)}
 
   @staticmethod
   def _tests():
-    grammar_tests = [
-      "analysis in 3, 4 and chromosome eq 10 and start gt 10 and end lt 10000",
-      "analysis in 1 and chromosome in 20, 22 and start gt 1 and end le 20",
-      "analysis in 5, 6",
-      "some_field eq '20' and another_field eq 99",
-      "id gt 3 and pval lt 5.341e-14",
-      "analysis in 3 and chromosome in 'chrX','chrY' and start gt 5000",
-      "thresholds in 3.7, 4.6, 5.2 and chromsome eq 20",
-      "analysis in 3,4 and start > 42 and end < 800",
-      "reference eq 1 and chromosome2 eq '9'",
-      "reference eq 1 and chromosome2 eq '9' and position2 ge 16961 and position2 le 16967",
-      "reference eq 1 and chromosome2 eq '9' and position2 ge 16961 and position2 le 16967 and variant1 eq '9:16918_G/C'",
-      "source in 1 and gene_name like 'TCF*'"
-    ]
-
     fp = FilterParser()
-    for t in grammar_tests:
+    for t in EXAMPLE_FILTERS:
       print(t)
       for m in fp.parse(t):
         if isinstance(m,str):
@@ -213,6 +404,24 @@ class LDAPITranslator(object):
     Convert a query string into a suitable URL for requesting refsnp LD from the API server
     running locally.
 
+    See to_refsnp_params() for the fields that can be used.
+
+    Args:
+      query: the filter string submitted via the API request
+
+    Returns:
+      string: URL constructed from the filter string
+      dict: field -> [(operator,value)]
+        List is necessary because a field can be specified multiple times, e.g. position2 le 10 and position2 ge 1
+    """
+
+    ld_params, parsed = self.to_refsnp_params(query)
+    return "&".join("{}={}".format(k,v) for k, v in iteritems(ld_params)), parsed
+
+  def to_refsnp_params(self,query):
+    """
+    Convert a query string into the parameters for requesting refsnp LD from the API server.
+
     This really only translates correctly for refsnp LD queries. If you give a generic query,
     it will likely error.
 
@@ -226,7 +435,7 @@ class LDAPITranslator(object):
       query: the filter string submitted via the API request
 
     Returns:
-      string: URL constructed from the filter string
+      OrderedDict: LD server parameter -> value
       dict: field -> [(operator,value)]
         List is necessary because a field can be specified multiple times, e.g. position2 le 10 and position2 ge 1
     """
@@ -265,11 +474,11 @@ class LDAPITranslator(object):
     ]
 
     if query is not None:
-      matches = self.filter_parser.grammar.parseString(query)
+      matches = parse_filter(query)
     else:
       matches = []
 
-    url = []
+    ld_params = OrderedDict()
     parsed = {}
     for match in matches:
       if isinstance(match,str):
@@ -321,9 +530,9 @@ class LDAPITranslator(object):
         elif v_lhs == "variant1":
           v_lhs = "variant"
 
-        url.append("{}={}".format(v_lhs,v_rhs))
+        ld_params[v_lhs] = v_rhs
 
-    return "&".join(url), parsed
+    return ld_params, parsed
 
 class SQLCompiler(object):
   def __init__(self):
@@ -352,7 +561,7 @@ class SQLCompiler(object):
     else:
       return x
 
-  def _to_where(self, terms, acceptable_fields, field_to_col=None):
+  def _to_where(self, terms, acceptable_fields, field_to_col=None, canonical=False):
     where = []
     params = {}
     pcount = 1
@@ -378,6 +587,11 @@ class SQLCompiler(object):
         sql_comp = self.ops.get(term.comp)
         if sql_comp is None:
           raise InvalidOperatorException("Invalid operator in query string: {}".format(term.comp))
+        if term.comp == "in" and canonical:
+          # col = ANY(array) has the same plan as col IN (...), but a single parameter regardless of
+          # how many values were given
+          sql_comp = "= ANY"
+
         where.append(sql_comp)
 
         if term.comp == "in":
@@ -389,7 +603,10 @@ class SQLCompiler(object):
           rhs = rhs.replace("*","%")
 
         mparam = "p{}".format(pcount)
-        if isinstance(rhs,list):
+        if isinstance(rhs,list) and canonical:
+          params[mparam] = rhs
+          where.append("(:{})".format(mparam))
+        elif isinstance(rhs,list):
           params[mparam] = tuple(rhs)
           where.append(":{}".format(mparam))
         else:
@@ -399,14 +616,16 @@ class SQLCompiler(object):
         pcount += 1
     return where, params
 
-  def to_sql(self, query, table, acceptable_fields, columns=None, sort_columns=None, field_to_col=None, limit=None):
+  def to_sql(self, query, table, acceptable_fields, columns=None, sort_columns=None, field_to_col=None, limit=None,
+             canonical=False):
     if query is not None:
-      terms = self.filter_parser.grammar.parseString(query)
+      terms = parse_filter(query)
     else:
       terms = []
-    return self.to_sql_parsed(terms, table, acceptable_fields, columns, sort_columns, field_to_col, limit)
+    return self.to_sql_parsed(terms, table, acceptable_fields, columns, sort_columns, field_to_col, limit, canonical)
 
-  def to_sql_parsed(self, terms, table, acceptable_fields, columns=None, sort_columns=None, field_to_col=None, limit=None):
+  def to_sql_parsed(self, terms, table, acceptable_fields, columns=None, sort_columns=None, field_to_col=None,
+                    limit=None, canonical=False):
     """
     Convert an API query string into a SQL statement.
 
@@ -428,6 +647,11 @@ class SQLCompiler(object):
         (or they should be validated beforehand, like columns.)
       field_to_col: if fields in filter string need to be converted to database column names, provide a
         dictionary mapping from field --> column
+      limit: maximum number of rows to return
+      canonical: if true, every value (including the limit) is passed as exactly one bind parameter, so the
+        SQL text only depends on the shape of the query and not on the values. Lists of values are passed as
+        arrays (col = ANY(:p1)) rather than expanded tuples (col IN :p1). Use this when the statement is to be
+        prepared (see db.execute_prepared.)
     Returns:
       string: prepared SQL statement
       dict: named parameters for SQL statement (sqlalchemy format). Don't put these directly into the
@@ -441,14 +665,18 @@ class SQLCompiler(object):
       )
     ]
 
-    where, params = self._to_where(terms, acceptable_fields, field_to_col)
+    where, params = self._to_where(terms, acceptable_fields, field_to_col, canonical)
     if len(where)>0:
       sql.extend(where)
 
     if sort_columns is not None:
       sql.append("ORDER BY {}".format(",".join(map(self.quote_keywords, sort_columns))))
 
-    if limit is not None:
+    if limit is not None and canonical:
+      mparam = "p{}".format(len(params) + 1)
+      params[mparam] = int(limit)
+      sql.append("LIMIT :{}".format(mparam))
+    elif limit is not None:
       sql.append("LIMIT {}".format(limit))
 
     return " ".join(sql), params
@@ -1,6 +1,36 @@
 import pytest
+from collections import namedtuple
 from flask import url_for
 from locuszoom.api import create_app
+from ld_server import StubLDServer
+
+Column = namedtuple("Column","name type_code")
+
+class FakeCursor(object):
+  """
+  Cursor over a list of rows, with a postgres style description.
+  """
+
+  def __init__(self,columns,rows):
+    """
+    Args:
+      columns: (name, postgres type OID) for each column
+      rows: tuples of values
+    """
+
+    self.description = [Column(*c) for c in columns]
+    self.names = [c[0] for c in columns]
+    self.rows = [dict(zip(self.names,r)) for r in rows]
+
+  def keys(self):
+    return self.names
+
+  def __iter__(self):
+    return iter(self.rows)
+
+  def fetchmany(self,size):
+    rows, self.rows = self.rows[:size], self.rows[size:]
+    return rows
 
 @pytest.fixture
 def app():
@@ -10,3 +40,10 @@ def app():
 def client(app):
   client = app.test_client()
   return client
+
+@pytest.fixture
+def ld_server(app):
+  server = StubLDServer().start()
+  app.config["LD_SERVER_URL"] = server.url
+  yield server
+  server.stop()
@@ -51,6 +51,9 @@ CREATE TABLE rest.recomb_results (
   pos_cm REAL
 );
 
+-- Recombination rate windows read the points in a range and the nearest point before it, in order of position
+CREATE INDEX recomb_results_id_chrom_pos ON rest.recomb_results (id, chromosome, position);
+
 CREATE TABLE rest.interval (
   id BIGINT PRIMARY KEY,
   study TEXT NOT NULL,
@@ -123,6 +126,9 @@ CREATE TABLE rest.gene_data (
   annotation JSONB
 );
 
+-- Transcripts and exons are read by joining on the genes of a region (see gene_index.features_sql)
+CREATE INDEX gene_data_id_gene_id ON rest.gene_data (id, gene_id);
+
 CREATE TABLE rest.gwascat_master (
   id BIGINT NOT NULL,
   name TEXT NOT NULL,
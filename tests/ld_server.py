@@ -0,0 +1,84 @@
+"""
+Stand-in for the LD server, used by tests so that the LD route can run without network access.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class StubLDServer(object):
+  """
+  Returns one variant every `spacing` bp within the requested window, with r2 decaying with distance from the
+  reference variant. Responses are deterministic, so the same variant always has the same r2 regardless of the
+  window it was requested in.
+
+  Each request's parameters are recorded in `requests`.
+  """
+
+  def __init__(self,delay=0,spacing=1000):
+    self.delay = delay
+    self.spacing = spacing
+    self.requests = []
+    self.lock = threading.Lock()
+    self.server = None
+
+  @property
+  def url(self):
+    return "http://127.0.0.1:{}/api_ld/ld".format(self.server.server_port)
+
+  def compute(self,chrom,variant,start,end):
+    refpos = int(variant.split("_")[0].split(":")[1])
+    first = -(-start // self.spacing) * self.spacing
+    pairs = []
+    for pos in range(first,end + 1,self.spacing):
+      pairs.append({
+        "name2": "{}:{}_A/G".format(chrom,pos),
+        "position2": pos,
+        "rsquare": round(1.0 / (1.0 + abs(pos - refpos) / 10000.0),4)
+      })
+
+    return {"chromosome": chrom, "variant": variant, "pairs": pairs}
+
+  def start(self):
+    stub = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        with stub.lock:
+          stub.requests.append(params)
+
+        if stub.delay:
+          time.sleep(stub.delay)
+
+        try:
+          body = stub.compute(params["chromosome"],params["variant"],int(params["startbp"]),int(params["endbp"]))
+        except (KeyError,ValueError):
+          self.send_error(400)
+          return
+
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+      def log_message(self,*args):
+        pass
+
+    self.server = ThreadingHTTPServer(("127.0.0.1",0),Handler)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
@@ -0,0 +1,52 @@
+import math
+import pytest
+from conftest import FakeCursor
+
+pa = pytest.importorskip("pyarrow")
+
+def read_stream(resp):
+  return pa.ipc.open_stream(resp.get_data()).read_all()
+
+def test_stream_arrow(app):
+  from locuszoom.api.routes import stream_arrow
+
+  columns = [("id",20),("chrom",25),("pos",20),("ref_freq",700),("log_pvalue",701),("annotation",3802)]
+  rows = [
+    (1,"16",100,0.25,float("inf"),{"b": 2, "a": 1}),
+    (1,"16",200,None,1.5,None),
+    (1,"16",300,0.5,-float("inf"),{"a": 3}),
+  ]
+
+  app.config["FETCH_BATCH_SIZE"] = 2
+  with app.test_request_context():
+    resp = stream_arrow(FakeCursor(columns,rows),["chrom","pos","ref_freq","log_pvalue","annotation"],{"chromosome": "chrom"})
+
+  assert resp.mimetype == "application/vnd.apache.arrow.stream"
+
+  # Kept as one chunk per record batch (plus schema and end of stream), not copied into a single buffer
+  assert len(resp.response) > 2
+  assert resp.content_length == len(resp.get_data())
+
+  table = read_stream(resp)
+  assert table.schema.names == ["chromosome","pos","ref_freq","log_pvalue","annotation"]
+  assert table.schema.field("ref_freq").type == pa.float32()
+  assert table.schema.field("log_pvalue").type == pa.float64()
+  assert table.schema.field("pos").type == pa.int64()
+
+  data = table.to_pydict()
+  assert data["chromosome"] == ["16","16","16"]
+  assert data["ref_freq"] == [0.25,None,0.5]
+  assert math.isinf(data["log_pvalue"][0]) and data["log_pvalue"][0] > 0
+  assert math.isinf(data["log_pvalue"][2]) and data["log_pvalue"][2] < 0
+  assert data["annotation"] == ['{"a":1,"b":2}',None,'{"a":3}']
+
+def test_stream_arrow_empty(app):
+  from locuszoom.api.routes import stream_arrow
+
+  with app.test_request_context():
+    resp = stream_arrow(FakeCursor([("id",20),("log_pvalue",701)],[]),["id","log_pvalue"],metadata={"build": ["GRCh37"]})
+
+  table = read_stream(resp)
+  assert table.num_rows == 0
+  assert table.schema.field("log_pvalue").type == pa.float64()
+  assert table.schema.metadata[b"build"] == b'["GRCh37"]'
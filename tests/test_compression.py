@@ -17,3 +17,103 @@ def test_compress(client):
   assert "Content-Encoding" not in resp_nocomp.headers
 
   assert int(resp_comp.headers["Content-Length"]) < int(resp_nocomp.headers["Content-Length"])
+
+def make_app():
+  from flask import jsonify
+  from locuszoom.api import compression
+
+  app = create_app()
+  app.config["CACHE_CONFIG"] = {"CACHE_TYPE": "simple"}
+  compression.cache.init_app(app,config=app.config["CACHE_CONFIG"])
+
+  body = {"data": {"position": list(range(20000)), "value": [i / 7 for i in range(20000)]}}
+
+  @app.route("/test/json")
+  def test_json():
+    return jsonify(body)
+
+  @app.route("/test/small")
+  def test_small():
+    return jsonify({"a": 1})
+
+  @app.route("/test/stream")
+  def test_stream():
+    chunks = [b'{"data":[', b",".join(str(i).encode() for i in range(200000)), b"]}"]
+    return app.response_class(iter(chunks),mimetype="application/json")
+
+  @app.route("/test/immutable")
+  def test_immutable():
+    resp = jsonify(body)
+    resp.set_etag("abc")
+    resp.cache_control.public = True
+    return resp
+
+  return app
+
+def decompress(resp):
+  encoding = resp.headers.get("Content-Encoding")
+  if encoding == "gzip":
+    import zlib
+    return zlib.decompress(resp.data,31)
+  elif encoding == "br":
+    import brotli
+    return brotli.decompress(resp.data)
+  elif encoding == "zstd":
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj().decompress(resp.data)
+  return resp.data
+
+@pytest.mark.parametrize("accept,expected", [
+  ("gzip", "gzip"),
+  ("gzip, br", "br"),
+  ("gzip, deflate, br, zstd", "zstd"),
+  ("zstd;q=0.5, gzip", "gzip"),
+  ("identity", None),
+  ("", None),
+])
+def test_negotiate(accept, expected):
+  pytest.importorskip("brotli")
+  pytest.importorskip("zstandard")
+  client = make_app().test_client()
+
+  resp = client.get("/test/json",headers={"Accept-Encoding": accept})
+  assert resp.headers.get("Content-Encoding") == expected
+  assert "Accept-Encoding" in resp.headers["Vary"]
+
+  plain = client.get("/test/json",headers={"Accept-Encoding": "identity"})
+  assert decompress(resp) == plain.data
+
+def test_min_size():
+  client = make_app().test_client()
+  resp = client.get("/test/small",headers={"Accept-Encoding": "gzip"})
+  assert "Content-Encoding" not in resp.headers
+
+def test_streamed():
+  client = make_app().test_client()
+  plain = client.get("/test/stream",headers={"Accept-Encoding": "identity"})
+  resp = client.get("/test/stream",headers={"Accept-Encoding": "gzip"})
+
+  assert resp.headers["Content-Encoding"] == "gzip"
+  assert "Content-Length" not in resp.headers
+  assert decompress(resp) == plain.data
+
+def test_precompressed():
+  from locuszoom.api import compression
+
+  app = make_app()
+  client = app.test_client()
+  resp = client.get("/test/immutable",headers={"Accept-Encoding": "gzip"})
+  assert resp.headers["Content-Encoding"] == "gzip"
+
+  # Each encoding has its own ETag
+  assert resp.headers["ETag"] == '"abc-gzip"'
+  assert client.get("/test/immutable",headers={"Accept-Encoding": "identity"}).headers["ETag"] == '"abc"'
+
+  # Later requests for the same entity can be answered with the stored bytes
+  with app.test_request_context("/test/immutable",headers={"Accept-Encoding": "gzip"}):
+    cached = compression.cached_response("abc")
+    assert cached.headers["Content-Encoding"] == "gzip"
+    assert cached.get_data() == resp.data
+
+  with app.test_request_context("/test/immutable",headers={"Accept-Encoding": "identity"}):
+    assert compression.cached_response("abc") is None
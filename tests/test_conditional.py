@@ -0,0 +1,63 @@
+import time
+from locuszoom.api.conditional import add_headers, dataset_etag, dataset_versions, is_fresh, matching_etag, \
+  normalize_filter
+
+def test_normalize_filter():
+  assert normalize_filter("analysis in 1 and chromosome eq '16' and position ge 5") == \
+    normalize_filter("position ge 5  AND chromosome = '16' and analysis in 1")
+
+  assert normalize_filter("chromosome eq '16'") != normalize_filter("chromosome eq 16")
+
+  # Order is kept when "or" is involved
+  assert normalize_filter("a eq 1 and b eq 2 or c eq 3") != normalize_filter("b eq 2 or c eq 3 and a eq 1")
+
+def etag_for(app,query_string,version="v1",path="/v1/statistic/single/results/"):
+  with app.test_request_context(path,query_string=query_string):
+    # Pretend the dataset version has already been looked up
+    dataset_versions("rest.assoc_master").versions[1] = (version,time.time() + 60)
+    return dataset_etag("rest.assoc_master",[1])
+
+def test_dataset_etag(app):
+  tag = etag_for(app,{"filter": "analysis in 1 and chromosome eq '16'","fields": "chromosome,position"})
+
+  assert tag == etag_for(app,{"filter": "chromosome eq '16' and analysis in 1","fields": "chromosome, position"})
+  assert tag != etag_for(app,{"filter": "analysis in 1 and chromosome eq '16'","fields": "chromosome,position",
+                              "format": "objects"})
+  assert tag != etag_for(app,{"filter": "analysis in 1 and chromosome eq '16'","fields": "chromosome,position"},
+                         version="v2")
+  assert tag != etag_for(app,{"filter": "analysis in 1 and chromosome eq '16'","fields": "chromosome,position"},
+                         path="/v1/statistic/phewas/")
+
+def test_dataset_etag_no_ids(app):
+  with app.test_request_context("/v1/statistic/single/results/"):
+    assert dataset_etag("rest.assoc_master",None) is None
+    assert dataset_etag("rest.assoc_master",["x"]) is None
+
+def test_is_fresh(app):
+  with app.test_request_context("/",headers={"If-None-Match": '"abc", W/"def"'}):
+    assert is_fresh("abc")
+    assert is_fresh("def")
+    assert not is_fresh("ghi")
+    assert not is_fresh(None)
+
+  # Compressed responses have the encoding appended to the tag
+  with app.test_request_context("/",headers={"If-None-Match": '"abc-gzip"'}):
+    assert is_fresh("abc")
+    assert matching_etag("abc") == "abc-gzip"
+    assert not is_fresh("ab")
+    assert not is_fresh("abc-gzip-br")
+
+def test_add_headers(app):
+  app.config.pop("CACHE_CONTROL",None)
+  with app.test_request_context("/"):
+    resp = add_headers(app.response_class("{}"),"abc","annotation")
+    assert resp.headers["ETag"] == '"abc"'
+    assert resp.headers["Cache-Control"] == "public, max-age=86400"
+
+    # No ETag, not cacheable
+    resp = add_headers(app.response_class("{}"),None,"annotation")
+    assert "Cache-Control" not in resp.headers
+
+    app.config["CACHE_CONTROL"] = {"annotation": "public, max-age=60"}
+    resp = add_headers(app.response_class("{}"),"abc","annotation")
+    assert resp.headers["Cache-Control"] == "public, max-age=60"
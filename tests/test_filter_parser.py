@@ -0,0 +1,125 @@
+import random
+import pytest
+from pyparsing import ParseException
+from locuszoom.api.uriparsing import EXAMPLE_FILTERS, SQLCompiler, fast_parse_filter, pyparse_filter, parse_filter
+
+# Filter strings as sent by LocusZoom and other clients. The fast parser should accept all of these.
+REAL_FILTERS = EXAMPLE_FILTERS + [
+  "analysis in 45 and chromosome in '2' and position ge 242023897 and position le 242025881",
+  "analysis in 3 and chromosome in '16' and position ge 0 and position le 200000000",
+  "chrom eq '16' and start le 57022881 and end ge 56985060",
+  "chromosome eq '21' and position lt 10890000 and position gt 10870000",
+  "id eq 1 and rsid eq 'rs7903146'",
+  "id in 2,3 and rsid eq 'rs7903146'",
+  "id in 15 and chromosome eq '21' and position lt 10906725 and position gt 10870000",
+  "id in 18 and chromosome eq '16' and start le 54119169 and end ge 53519169",
+  "reference eq 1 and chromosome2 eq '16' and position2 ge 56859412 and position2 le 57059412 and variant1 eq '16:56989590_C/T'",
+  "source in 2 and chrom eq '16' and start le 57022881 and end ge 56985060",
+  "variant eq '10:114758349_C/T'",
+  "gene_name eq 'TCF7L2' and source_id eq 1 and feature_type eq 'gene'",
+  "gene_id like 'ENSG00000148737%' and source_id eq 1 and feature_type eq 'gene'",
+  "id eq 16 and rsid eq 'rs7903146'",
+  "analysis in 1 and chromosome in \"X\" and position ge 1 and position le 2",
+  "Analysis IN 1 AND chromosome EQ '1' Or pvalue LT 1e-8",
+  "  analysis in 1 ,2 , 3  and chromosome eq 'chr1'  ",
+  "pvalue lt 5e-8 and pvalue gt 1.5E-10 and beta ge 0.25 and se le 3.e2",
+  "position < 500 and position > 100 and id = 3",
+  "gene_name eq ''",
+  "name eq \"rs7903146\" or name eq 'rs12255372'",
+]
+
+# Strings that the fast parser is allowed to hand off to the full grammar (valid or not).
+EDGE_FILTERS = [
+  "",
+  "   ",
+  "analysis",
+  "analysis in",
+  "analysis in 3,",
+  "analysis in 3 and",
+  "trait is 'BMI'",
+  "position<5",
+  "position<=5",
+  "analysis in3",
+  "analysis in'3'",
+  "x eq 16abc",
+  "x eq 3and y eq 4",
+  "x eq 'a'and y eq 4",
+  "x eq 1 andy eq 2",
+  "x eqq 5",
+  "x eq 'it''s'",
+  "x eq 'a\\'b'",
+  "x eq 'unterminated",
+  "x eq \"mixed'",
+  "x eq -5",
+  "x eq +5",
+  "x eq 1e+5",
+  "x eq 5.",
+  "x eq .5",
+  "x eq 1.2.3",
+  "x eq a_b",
+  "x eq 'café'",
+  "xé eq 1",
+  "x eq 1 xor y eq 2",
+  "x eq 1 and and y eq 2",
+  "x like 'TCF*' and y in 'a', \"b\", c, 4, 5.5, 6e7",
+  "x eq and",
+  "x in in",
+  "_x_ eq 1",
+]
+
+def pyparse_or_none(query):
+  try:
+    return pyparse_filter(query)
+  except ParseException:
+    return None
+
+@pytest.mark.parametrize("query", REAL_FILTERS)
+def test_fast_parser_accepts_real_filters(query):
+  fast = fast_parse_filter(query)
+  assert fast is not None
+  assert fast == pyparse_filter(query)
+
+@pytest.mark.parametrize("query", EDGE_FILTERS)
+def test_fast_parser_agrees_on_edge_cases(query):
+  fast = fast_parse_filter(query)
+  if fast is not None:
+    assert fast == pyparse_or_none(query)
+
+def test_fast_parser_value_types():
+  terms = fast_parse_filter("a eq 1 and b eq 1.5 and c eq 2e3 and d eq '4' and e eq x5")
+  values = [t.rhs[0] for t in terms if not isinstance(t, str)]
+  assert values == [1, 1.5, 2000.0, "4", "x5"]
+  assert [type(v) for v in values] == [int, float, float, str, str]
+
+def test_fuzz_agreement():
+  # Randomly assemble filter strings from fragments that exercise token boundaries.
+  rand = random.Random(1313)
+  fragments = [
+    "analysis", "chromosome", "position", "x_1", " ", "  ", ",", ", ", "'", "\"", "'16'", "\"X\"", "''",
+    "in", "eq", "ge", "le", "lt", "gt", "like", "IN", "Eq", "<", ">", "=",
+    "and", "or", "AND", "Or", "3", "42", "1.5", "2e5", "3.e-2", "abc", "a1", "-", ".", "_", "\t",
+  ]
+
+  for _ in range(20000):
+    query = "".join(rand.choice(fragments) for _ in range(rand.randint(1, 12)))
+    fast = fast_parse_filter(query)
+    if fast is not None:
+      assert fast == pyparse_or_none(query), query
+
+def test_invalid_filter_still_raises():
+  with pytest.raises(ParseException):
+    parse_filter("trait is 'BMI'")
+
+def test_canonical_sql():
+  compiler = SQLCompiler()
+  fields = "analysis chromosome position".split()
+  query = "analysis in {} and chromosome eq '{}' and position ge {}"
+
+  sql1, params1 = compiler.to_sql(query.format("1,2", "16", 100), "results", fields, limit=10, canonical=True)
+  sql2, params2 = compiler.to_sql(query.format("3,4,5", "X", 5), "results", fields, limit=20, canonical=True)
+
+  # The statement only depends on the shape of the query
+  assert sql1 == sql2
+  assert sql1 == "SELECT * FROM results WHERE analysis = ANY (:p1) AND chromosome = :p2 AND position >= :p3 LIMIT :p4"
+  assert params1 == {"p1": [1, 2], "p2": "16", "p3": 100, "p4": 10}
+  assert params2 == {"p1": [3, 4, 5], "p2": "X", "p3": 5, "p4": 20}
@@ -206,3 +206,35 @@ def test_skip_transcripts(client):
   for gene in resp.json["data"]:
     assert "transcripts" not in gene
     assert "exons" not in gene
+
+def normalize_genes(data):
+  # Features starting at the same position may come back in either order from the database
+  def by_start(items,key):
+    return sorted(items,key=lambda x: (x["start"],x[key]))
+
+  for gene in data:
+    gene["exons"] = by_start(gene.get("exons",[]),"exon_id")
+    gene["transcripts"] = by_start(gene.get("transcripts",[]),"transcript_id")
+    for tx in gene["transcripts"]:
+      tx["exons"] = by_start(tx["exons"],"exon_id")
+
+  return by_start(data,"gene_id")
+
+def test_index_matches_database(app, client):
+  for params in [
+    {"filter": "source in 2 and chrom eq '16' and start le 57022881 and end ge 56985060"},
+    {"filter": "source in 2 and chrom eq '16' and start le 79189937 and end ge 78189937"},
+    {"filter": "source in 2 and chrom eq '16' and start le 79189937 and end ge 78189937", "transcripts": "F"},
+    {"filter": "source in 2 and chrom eq '16' and start le 54265502 and end ge 54164840"},
+  ]:
+    app.config["GENE_INDEX"] = False
+    expected = client.get("/v1/annotation/genes/",query_string=params).json
+
+    app.config["GENE_INDEX"] = True
+    resp = client.get("/v1/annotation/genes/",query_string=params)
+    assert resp.status_code == 200
+    assert resp.json["meta"] == expected["meta"]
+    assert normalize_genes(resp.json["data"]) == normalize_genes(expected["data"])
+
+  stats = client.get("/v1/status").json["gene_index"]
+  assert stats["chromosomes"] > 0
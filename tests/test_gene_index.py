@@ -0,0 +1,134 @@
+from flask import jsonify
+from locuszoom.api import gene_index
+from locuszoom.api.gene_index import ChromosomeGenes, GeneIndex
+from locuszoom.api.models.gene import Gene, Transcript, Exon
+from locuszoom.api.uriparsing import parse_filter
+
+# (gene id, start, end, number of transcripts). ENSG2 is long, so genes after it may start before earlier genes end.
+GENES = [
+  ("ENSG1",100,600,1),
+  ("ENSG2",150,90000,2),
+  ("ENSG3",700,800,0),
+  ("ENSG4",1000,1000,1),
+  ("ENSG5",1000,5000,1),
+  ("ENSG6",20000,20500,0),
+  ("ENSG7",95000,99000,2),
+]
+
+def make_genes():
+  genes = []
+  for gene_id, start, end, ntx in GENES:
+    gene = Gene(gene_id=gene_id,gene_name=gene_id.replace("ENSG","G"),chrom="16",start=start,end=end,strand="+",gene_type="protein_coding")
+    for j in range(ntx):
+      tx = Transcript(transcript_id="{}_{}".format(gene_id.replace("ENSG","ENST"),j),chrom="16",start=start,end=end,strand="+")
+      gene.add_transcript(tx)
+      exon = Exon(exon_id=gene_id.replace("ENSG","ENSE"),chrom="16",start=start,end=start + 10,strand="+")
+      tx.add_exon(exon)
+      gene.add_exon(exon)
+
+    genes.append(gene)
+
+  return genes
+
+def test_overlapping():
+  genes = make_genes()
+  chrom_genes = ChromosomeGenes(genes)
+
+  for lower, upper in [(0,99), (0,100), (601,699), (650,750), (1000,1000), (5001,19999), (90001,94999), (0,10**6)]:
+    found = chrom_genes.overlapping(lower,upper,[("start",lambda a, v: a <= v,upper),("end",lambda a, v: a >= v,lower)])
+    expected = [i for i, gene in enumerate(genes) if gene.start <= upper and gene.end >= lower]
+    assert list(found) == expected, (lower, upper)
+
+  # Additional checks narrow down the genes found
+  found = chrom_genes.overlapping(0,10**6,[("start",lambda a, v: a >= v,1000)])
+  assert [genes[i].gene_id for i in found] == ["ENSG4","ENSG5","ENSG6","ENSG7"]
+
+def test_not_indexed(app):
+  from locuszoom.api.routes import GENE_INDEX
+
+  with app.test_request_context():
+    assert GENE_INDEX.genes(parse_filter("source in 2 and gene_name eq 'WWOX'"),{"source": "id"}) is None
+    assert GENE_INDEX.genes(parse_filter("source in 999 and chrom eq '16' and start le 10 and end ge 0"),{"source": "id"}) == []
+
+    app.config["GENE_INDEX"] = False
+    assert GENE_INDEX.genes(parse_filter("source in 2 and chrom eq '16' and start le 10 and end ge 0"),{"source": "id"}) is None
+
+def test_max_bytes(app):
+  from locuszoom.api.routes import GENE_REGION
+
+  terms16 = parse_filter("source in 2 and chrom eq '16' and start le 10 and end ge 0")
+  terms17 = parse_filter("source in 1 and chrom eq '17' and start le 10 and end ge 0")
+
+  with app.test_request_context():
+    sizes = GeneIndex(GENE_REGION)
+    sizes.genes(terms16,{"source": "id"})
+    size16 = sizes.nbytes
+    sizes.genes(terms17,{"source": "id"})
+    size17 = sizes.nbytes - size16
+
+    # Room for either chromosome, but not both
+    app.config["GENE_INDEX_MAX_BYTES"] = max(size16,size17) + 10
+    index = GeneIndex(GENE_REGION)
+    index.genes(terms16,{"source": "id"})
+    index.genes(terms17,{"source": "id"})
+
+    # Chromosome 16 was evicted to make room
+    assert [key[2] for key in index.chroms] == ["17"]
+    assert index.stats()["bytes"] == size17
+
+def test_json_response(app):
+  genes = make_genes()
+  meta = {"datasets": [{"id": 2, "source": "gencode"}]}
+
+  with app.test_request_context():
+    resp = gene_index.json_response([gene_index.encode(gene.to_dict()) for gene in genes],meta)
+    expected = jsonify({"data": [gene.to_dict() for gene in genes], "meta": meta, "lastPage": None})
+    assert resp.get_data() == expected.get_data()
+
+def feature_row(feature_type,gene_id,start,end,transcript_id=None,exon_id=None):
+  return {
+    "feature_type": feature_type,
+    "gene_id": gene_id,
+    "gene_name": gene_id.replace("ENSG","G"),
+    "chrom": "16",
+    "start": start,
+    "end": end,
+    "strand": "+",
+    "transcript_id": transcript_id,
+    "exon_id": exon_id,
+    "gene_type": "protein_coding" if feature_type == "gene" else None
+  }
+
+def test_assemble_genes():
+  # Ordered as features_sql() returns them
+  rows = [
+    feature_row("exon","ENSG0",5,6,"ENST0","ENSE0"),
+    feature_row("gene","ENSG1",10,100),
+    feature_row("exon","ENSG1",10,20,None,"ENSE9"),
+    feature_row("transcript","ENSG1",10,90,"ENST1"),
+    feature_row("exon","ENSG1",10,20,"ENST1","ENSE1"),
+    feature_row("exon","ENSG1",50,60,"ENST1","ENSE2"),
+    feature_row("transcript","ENSG1",40,100,"ENST2"),
+    feature_row("exon","ENSG1",50,60,"ENST2","ENSE2"),
+    feature_row("exon","ENSG1",80,100,"ENST3","ENSE3"),
+    feature_row("gene","ENSG2",30,40),
+  ]
+
+  genes = gene_index.assemble_genes(rows)
+  assert [gene.gene_id for gene in genes] == ["ENSG1","ENSG2"]
+
+  first = genes[0].to_dict()
+  assert first["gene_type"] == "protein_coding"
+  assert [e["exon_id"] for e in first["exons"]] == ["ENSE9","ENSE1","ENSE2","ENSE3"]
+  assert [(t["transcript_id"],[e["exon_id"] for e in t["exons"]]) for t in first["transcripts"]] == [
+    ("ENST1",["ENSE1","ENSE2"]),
+    ("ENST2",["ENSE2"])
+  ]
+
+  assert "transcripts" not in genes[1].to_dict()
+
+def test_features_sql():
+  sql = gene_index.features_sql("id = :p1 AND chrom = :p2")
+  assert "gene_id IN" not in sql
+  assert "('gene','transcript','exon')" in sql
+  assert "IN ('gene')" in gene_index.features_sql("id = :p1",transcripts=False)
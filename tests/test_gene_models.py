@@ -0,0 +1,61 @@
+import json
+import random
+from locuszoom.api.models.gene import Gene, Transcript, Exon
+
+def make_gene(seed=1):
+  rand = random.Random(seed)
+  gene = Gene(gene_id="ENSG1",gene_name="ABéC \"x\"",chrom="16",start=100,end=90000,strand="-",gene_type="protein_coding")
+
+  exons = [Exon(exon_id="ENSE{}".format(i),chrom="16",start=rand.randint(100,90000),end=None,strand="-") for i in range(30)]
+  for i in range(5):
+    tx = Transcript(transcript_id="ENST{}".format(i),chrom="16",start=rand.choice([100,200,300]),end=90000,strand="-")
+    gene.add_transcript(tx)
+    for exon in rand.sample(exons,10):
+      tx.add_exon(exon)
+      gene.add_exon(exon)
+
+  return gene
+
+def test_to_json():
+  for seed in range(20):
+    gene = make_gene(seed)
+    expected = json.dumps(gene.to_dict(),sort_keys=True,separators=(",",":"))
+    assert gene.to_json() == expected
+
+    short = json.dumps({k: getattr(gene,k) for k in Gene.cargs},sort_keys=True,separators=(",",":"))
+    assert gene.to_json(transcripts=False) == short
+
+  # No transcripts or exons
+  gene = Gene(gene_id="ENSG2",gene_name="X",chrom="1",start=1,end=2,strand="+")
+  assert gene.to_json() == json.dumps(gene.to_dict(),sort_keys=True,separators=(",",":"))
+  assert "transcripts" not in gene.to_dict()
+
+def test_order():
+  gene = make_gene()
+  d = gene.to_dict()
+
+  starts = [t["start"] for t in d["transcripts"]]
+  assert starts == sorted(starts)
+  assert [e["start"] for e in d["exons"]] == sorted(e["start"] for e in d["exons"])
+
+  # Ties keep the order they were added in (ENST0, ENST1, ...)
+  for a, b in zip(d["transcripts"],d["transcripts"][1:]):
+    if a["start"] == b["start"]:
+      assert a["transcript_id"] < b["transcript_id"]
+
+def test_unique():
+  gene = Gene(gene_id="ENSG1",chrom="X",start=1,end=100,strand="+")
+  tx = Transcript(transcript_id="ENST1",chrom="X",start=1,end=100,strand="+")
+  gene.add_transcript(tx)
+  gene.add_transcript(Transcript(transcript_id="ENST1",chrom="X",start=5,end=100,strand="+"))
+
+  gene.add_exon(Exon(exon_id="ENSE1",chrom="X",start=1,end=10,strand="+"))
+  gene.add_exon(Exon(exon_id="ENSE1",chrom="X",start=1,end=10,strand="+"))
+
+  # Features on different chromosomes (e.g. pseudoautosomal regions) can be mixed
+  gene.add_exon(Exon(exon_id="ENSE2",chrom="Y",start=0,end=10,strand="+"))
+
+  d = gene.to_dict()
+  assert [t["transcript_id"] for t in d["transcripts"]] == ["ENST1"]
+  assert d["transcripts"][0]["start"] == 1
+  assert [e["exon_id"] for e in d["exons"]] == ["ENSE2","ENSE1"]
@@ -54,3 +54,34 @@ def test_intervals(client):
 
   # Check that all vectors are same length
   assert len(set(map(len,data.values()))) == 1
+
+def test_cached_matches_database(app, client):
+  params = {
+    "filter": "id in 18 and chromosome eq '16' and start le 54119169 and end ge 53519169"
+  }
+
+  def fetch():
+    data = client.get("/v1/annotation/intervals/results/",query_string=params).json["data"]
+    return sorted(zip(data["public_id"],data["start"],data["end"]))
+
+  # Twice from the cache (the second time without querying the database), and once with the cache bypassed
+  cached = fetch()
+  assert fetch() == cached
+
+  app.config["REGION_CACHE_MAX_CHUNKS"] = 0
+  assert fetch() == cached
+
+def test_etag(client):
+  params = {
+    "filter": "id in 18 and chromosome eq '16' and start le 54119169 and end ge 53519169"
+  }
+  resp = client.get("/v1/annotation/intervals/results/",query_string=params)
+  assert resp.status_code == 200
+  etag = resp.headers["ETag"]
+
+  resp = client.get("/v1/annotation/intervals/results/",query_string=params,headers={"If-None-Match": etag})
+  assert resp.status_code == 304
+
+  params["filter"] = params["filter"].replace("54119169","54119170")
+  resp = client.get("/v1/annotation/intervals/results/",query_string=params,headers={"If-None-Match": etag})
+  assert resp.status_code == 200
@@ -0,0 +1,53 @@
+import json
+from flask import jsonify
+from conftest import FakeCursor
+from locuszoom.api.jsonutil import ColumnarJSONWriter, nonfinite_floats, sanitize_floats
+
+COLUMNS = [("id",20),("ref_freq",700),("log_pvalue",701)]
+ROWS = [
+  (1,0.5,float("inf")),
+  (2,None,-float("inf")),
+  (3,float("nan"),2.5),
+]
+
+def test_nonfinite_floats():
+  values = [1.0,None,float("inf"),-float("inf"),float("nan"),0.0]
+  assert nonfinite_floats(values) == [(2,"Infinity"),(3,"-Infinity"),(4,"NaN")]
+  assert nonfinite_floats([]) == []
+  assert sanitize_floats([1.5,None]) == [1.5,None]
+
+def test_rows_to_arrays(app):
+  from locuszoom.api.routes import rows_to_arrays
+
+  with app.test_request_context():
+    data = rows_to_arrays(FakeCursor(COLUMNS,ROWS),["id","ref_freq","log_pvalue"],{"ref_freq": "ref_allele_freq"})
+
+  assert data["ref_allele_freq"] == [0.5,None,"NaN"]
+  assert data["log_pvalue"] == ["Infinity","-Infinity",2.5]
+
+def test_rows_to_objects_renamed_float(app):
+  from locuszoom.api.routes import rows_to_objects
+
+  # Float columns are found by database column name, but must be fixed under their field name
+  with app.test_request_context():
+    data = rows_to_objects(FakeCursor(COLUMNS,ROWS),["id","ref_freq","log_pvalue"],{"ref_freq": "ref_allele_freq"})
+
+  assert [d["ref_allele_freq"] for d in data] == [0.5,None,"NaN"]
+  assert [d["log_pvalue"] for d in data] == ["Infinity","-Infinity",2.5]
+  json.dumps(data,allow_nan=False)
+
+def test_writer_matches_jsonify(app):
+  from locuszoom.api.routes import rows_to_arrays
+
+  fields = ["id","ref_freq","log_pvalue"]
+  cols_to_field = {"ref_freq": "ref_allele_freq"}
+  cur = FakeCursor(COLUMNS,ROWS)
+
+  writer = ColumnarJSONWriter(cur.keys(),fields,cols_to_field,["ref_freq","log_pvalue"])
+  writer.write(cur.rows[:2])
+  writer.write(cur.rows[2:])
+
+  with app.test_request_context():
+    expected = jsonify({"data": rows_to_arrays(cur,fields,cols_to_field),"lastPage": None}).get_data()
+
+  assert b"".join(writer.chunks()) == expected
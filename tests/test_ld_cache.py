@@ -0,0 +1,277 @@
+import random
+import threading
+import pytest
+import redis
+from locuszoom.api import cache as ld_cache
+from locuszoom.api.cache import (
+  RedisIntervalCache, RedisBlockCache, MemoryIntervalCache, TwoTierCache, cache_stats, count, merge_range,
+  find_disjoint, pack_ranges, unpack_ranges
+)
+
+@pytest.fixture
+def red(app):
+  client = redis.StrictRedis(
+    host = app.config["REDIS_HOST"],
+    port = app.config["REDIS_PORT"],
+    db = app.config["REDIS_DB"]
+  )
+
+  try:
+    client.ping()
+  except redis.ConnectionError:
+    pytest.skip("redis is not available")
+
+  return client
+
+def test_merge_range():
+  assert merge_range([],5,10) == [(5,10)]
+  assert merge_range([(1,3)],5,10) == [(1,3),(5,10)]
+  assert merge_range([(1,4)],5,10) == [(1,10)]
+  assert merge_range([(1,3),(12,15),(20,30)],4,11) == [(1,15),(20,30)]
+  assert merge_range([(1,3),(12,15)],6,6) == [(1,3),(6,6),(12,15)]
+  assert merge_range([(5,10)],1,20) == [(1,20)]
+  assert merge_range([(5,10)],6,7) == [(5,10)]
+
+def test_find_disjoint():
+  assert find_disjoint([],5,10) == [(5,10)]
+  assert find_disjoint([(1,20)],5,10) == []
+  assert find_disjoint([(1,6),(9,9)],5,10) == [(7,8),(10,10)]
+  assert find_disjoint([(1,3),(30,40)],5,10) == [(5,10)]
+  assert find_disjoint([(6,8)],5,10) == [(5,5),(9,10)]
+
+def test_pack_ranges():
+  ranges = [(1,3),(2**40,2**40 + 5)]
+  assert unpack_ranges(pack_ranges(ranges)) == ranges
+  assert unpack_ranges(None) == []
+
+def test_encode_block():
+  names = ["1:100_A/G","1:200_C/T","1:200_C/TT"]
+  block = RedisBlockCache.encode_block([100,200,200],[0.5,0.25,1.0],names)
+  positions, rsquare, offsets, table = RedisBlockCache.decode_block(block)
+  assert positions.tolist() == [100,200,200]
+  assert rsquare.tolist() == [0.5,0.25,1.0]
+  assert table[offsets[1]:offsets[3] - 1].decode("utf-8").split("\n") == names[1:]
+
+@pytest.mark.parametrize("cache_class", [RedisIntervalCache, RedisBlockCache])
+def test_store_retrieve(red, cache_class):
+  cache = cache_class(red)
+  key = "test__{}".format(random.randint(0,10**9))
+
+  def ld(start,end):
+    return {pos: {"name2": "1:{}_A/G".format(pos), "rsquare": (pos % 97) / 97.0} for pos in range(start,end + 1,250)}
+
+  try:
+    # Spans several blocks
+    cache.store(key,0,150000,ld(0,150000))
+    cache.store(key,140000,420000,ld(140000,420000))
+    assert cache.retrieve(key,1000,500000) is None
+
+    data = cache.retrieve(key,99000,301000)
+    expected = ld(99000,301000)
+    assert list(data.keys()) == sorted(expected.keys())
+    for pos, value in data.items():
+      assert value["name2"] == expected[pos]["name2"]
+      assert value["rsquare"] == pytest.approx(expected[pos]["rsquare"],rel=1e-6)
+
+    data, gaps = cache.retrieve_partial(key,400000,500000)
+    assert gaps == [(420001,500000)]
+    assert list(data.keys()) == sorted(ld(400000,420000).keys())
+  finally:
+    cache.delete(key)
+
+@pytest.mark.parametrize("cache_class", [RedisIntervalCache, RedisBlockCache])
+def test_concurrent_store(red, cache_class):
+  cache = cache_class(red)
+  key = "test__{}".format(random.randint(0,10**9))
+  rand = random.Random(42)
+
+  # Many overlapping and disjoint windows, stored from several threads at once
+  windows = []
+  for _ in range(400):
+    start = rand.randint(0,200000)
+    end = start + rand.randint(0,3000)
+    data = {pos: {"name2": "1:{}_A/G".format(pos), "rsquare": 0.5} for pos in range(start - start % 100 + 100,end + 1,100)}
+    windows.append((start,end,data))
+
+  def worker(chunk):
+    for start, end, data in chunk:
+      cache.store(key,start,end,data)
+
+  try:
+    threads = [threading.Thread(target=worker,args=(windows[i::8],)) for i in range(8)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+    expected = []
+    positions = set()
+    for start, end, data in windows:
+      expected = merge_range(expected,start,end)
+      positions.update(data)
+
+    # No store should have overwritten the coverage recorded by another
+    data, gaps = cache.retrieve_partial(key,0,210000)
+    assert gaps == find_disjoint(expected,0,210000)
+    assert set(data) == positions
+
+    for start, end in expected:
+      assert cache.retrieve(key,start,end) is not None
+  finally:
+    cache.delete(key)
+
+def test_orphaned_key(red):
+  cache = RedisIntervalCache(red)
+  key = "test__{}".format(random.randint(0,10**9))
+
+  try:
+    cache.store(key,100,200,{150: {"name2": "1:150_A/G", "rsquare": 0.5}})
+    assert len(cache.retrieve(key,100,200)) == 1
+
+    # Sorted set evicted, but the master key survived
+    red.delete(key + "__zset")
+    assert cache.retrieve(key,100,200) is None
+    assert not red.exists(key)
+  finally:
+    cache.delete(key)
+
+@pytest.mark.parametrize("cache_class", [RedisIntervalCache, RedisBlockCache])
+def test_ttl(red, cache_class):
+  cache = cache_class(red,ttl=100)
+  key = "test__{}".format(random.randint(0,10**9))
+  redis_key = getattr(cache,"PREFIX","") + key
+
+  try:
+    cache.store(key,100,200,{150: {"name2": "1:150_A/G", "rsquare": 0.5}})
+    assert 0 < red.ttl(redis_key) <= 100
+
+    # Refreshed on use
+    red.expire(redis_key,10)
+    cache.retrieve_partial(key,100,200)
+    assert red.ttl(redis_key) > 10
+  finally:
+    cache.delete(key)
+
+@pytest.mark.parametrize("cache_class", [RedisIntervalCache, RedisBlockCache])
+def test_panel_budget(red, cache_class):
+  panel = "testpanel{}".format(random.randint(0,10**9))
+  cache = cache_class(red)
+  keys = ["{}__1:{}_A/G".format(panel,i) for i in range(10)]
+
+  def ld(start):
+    return {pos: {"name2": "1:{}_A/G".format(pos), "rsquare": 0.5} for pos in range(start,start + 10000,25)}
+
+  try:
+    # Budget for about 4 keys
+    cache.store(keys[0],0,9999,ld(0))
+    key_size = int(red.hget("ldcache__sizes__{}".format(panel),getattr(cache,"PREFIX","") + keys[0]))
+    cache.panel_bytes = int(key_size * 4.5)
+
+    for i, key in enumerate(keys[1:],1):
+      cache.store(key,i * 10000,i * 10000 + 9999,ld(i * 10000))
+
+      # Keep the first key in use
+      cache.retrieve_partial(keys[0],0,9999)
+
+    assert int(red.get("ldcache__bytes__{}".format(panel))) <= cache.panel_bytes
+
+    # Least recently used keys are evicted first
+    assert len(cache.retrieve_partial(keys[-1],90000,99999)[1]) == 0
+    assert len(cache.retrieve_partial(keys[1],10000,19999)[1]) == 1
+    assert len(cache.retrieve_partial(keys[0],0,9999)[1]) == 0
+  finally:
+    for key in keys:
+      cache.delete(key)
+
+    red.delete(*["ldcache__{}__{}".format(x,panel) for x in ("index","sizes","bytes")])
+
+@pytest.mark.parametrize("cache_class", [RedisIntervalCache, RedisBlockCache])
+def test_stats_contended_store(red, cache_class, monkeypatch):
+  cache = cache_class(red)
+  key = "test__{}".format(random.randint(0,10**9))
+  redis_key = getattr(cache,"PREFIX","") + key
+
+  # Another process writes to the key while the first store attempt is in progress, so it is retried
+  contended = []
+  def merge_range_contended(ranges,start,end):
+    if not contended:
+      contended.append(True)
+      red.hset(redis_key,"other","1")
+    return merge_range(ranges,start,end)
+
+  monkeypatch.setattr(ld_cache,"merge_range",merge_range_contended)
+
+  try:
+    before = cache_stats(red).get("hits",0)
+    count("hits",3)
+    cache.store(key,100,200,{150: {"name2": "1:150_A/G", "rsquare": 0.5}})
+    assert contended
+
+    # Counters pending when the transaction was retried are not lost
+    assert cache_stats(red)["hits"] - before == 3
+  finally:
+    cache.delete(key)
+
+def test_admission(red):
+  cache = RedisIntervalCache(red,admit_size=1000)
+  key = "test__{}".format(random.randint(0,10**9))
+
+  try:
+    assert cache.admit(key,0,1000)
+    assert not cache.admit(key,0,5000)
+    assert cache.admit(key,0,5000)
+  finally:
+    red.delete("ldcache__seen__{}".format(key))
+
+def test_memory_cache():
+  cache = MemoryIntervalCache(max_bytes=10**6,ttl=60)
+  cache.store("k",100,200,{150: {"name2": "a", "rsquare": 0.1}, 190: {"name2": "b", "rsquare": 0.2}})
+  cache.store("k",201,300,{250: {"name2": "c", "rsquare": 0.3}})
+
+  assert list(cache.retrieve("k",100,300).keys()) == [150,190,250]
+  assert list(cache.retrieve("k",160,260).keys()) == [190,250]
+  assert cache.retrieve("k",50,300) is None
+  assert cache.retrieve_partial("k",50,400)[1] == [(50,99),(301,400)]
+  assert cache.retrieve("other",100,200) is None
+
+def test_memory_cache_limits():
+  cache = MemoryIntervalCache(max_bytes=MemoryIntervalCache.VALUE_OVERHEAD * 25,ttl=60)
+  for i in range(5):
+    cache.store(str(i),0,100,{p: {"rsquare": 0.5} for p in range(10)})
+    cache.retrieve("0",0,100)
+
+  # Least recently used keys are dropped to stay within the memory limit
+  assert cache.nbytes <= cache.max_bytes
+  assert cache.retrieve("0",0,100) is not None
+  assert cache.retrieve("3",0,100) is None
+  assert cache.retrieve("4",0,100) is not None
+
+  # Expired entries are dropped
+  cache.ttl = -1
+  cache.store("new",0,100,{1: {"rsquare": 0.5}})
+  assert cache.retrieve("new",0,100) is None
+
+def test_two_tier(red):
+  l1 = MemoryIntervalCache()
+  l2 = RedisIntervalCache(red)
+  cache = TwoTierCache(l1,l2)
+  key = "test__{}".format(random.randint(0,10**9))
+
+  try:
+    l2.store(key,100,200,{150: {"name2": "a", "rsquare": 0.5}})
+
+    # First lookup comes from redis, and fills the memory cache
+    data, gaps = cache.retrieve_partial(key,50,200)
+    assert list(data.keys()) == [150]
+    assert gaps == [(50,99)]
+    assert list(l1.retrieve(key,100,200).keys()) == [150]
+
+    cache.store(key,50,99,{60: {"name2": "b", "rsquare": 0.5}})
+    red.delete(key,key + "__zset")
+
+    # Now served from memory alone
+    data, gaps = cache.retrieve_partial(key,50,200)
+    assert list(data.keys()) == [60,150]
+    assert gaps == []
+  finally:
+    cache.delete(key)
@@ -0,0 +1,175 @@
+import random
+import threading
+import pytest
+import redis
+from locuszoom.api import redis_client, ld_client, cache
+from locuszoom.api.errors import FlaskException
+
+LD_URL = "/v1/statistic/pair/LD/results/"
+
+def ld_filter(refpos,start,end):
+  return (
+    "reference eq 1 and chromosome2 eq '16' and position2 ge {start} and position2 le {end} "
+    "and variant1 eq '16:{refpos}_C/T'".format(refpos=refpos,start=start,end=end)
+  )
+
+def test_ld_stub(client, ld_server):
+  # Use a new reference variant so the results can't come from the cache
+  refpos = random.randint(10000000,80000000)
+  resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos - 50000,refpos + 50000)})
+  assert resp.status_code == 200
+
+  expected = ld_server.compute("16","16:{}_C/T".format(refpos),refpos - 50000,refpos + 50000)
+  data = resp.json["data"]
+  assert data["position2"] == [p["position2"] for p in expected["pairs"]]
+  assert data["variant2"] == [p["name2"] for p in expected["pairs"]]
+  assert all(c == "16" for c in data["chromosome2"])
+
+def test_ld_coalesced(app, ld_server):
+  ld_server.delay = 0.5
+  refpos = random.randint(10000000,80000000)
+  params = {"filter": ld_filter(refpos,refpos - 50000,refpos + 50000)}
+
+  responses = []
+  def get():
+    resp = app.test_client().get(LD_URL,query_string=params)
+    responses.append((resp.status_code,resp.json))
+
+  threads = [threading.Thread(target=get) for _ in range(4)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+
+  # Concurrent identical requests should share one request to the LD server
+  assert len(ld_server.requests) == 1
+  assert all(code == 200 for code, _ in responses)
+  assert all(js == responses[0][1] for _, js in responses)
+
+def test_ld_server_error(client, ld_server):
+  ld_server.stop()
+  refpos = random.randint(10000000,80000000)
+  resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos - 50000,refpos + 50000)})
+  assert resp.status_code == 500
+  assert "LD server" in resp.json["message"]
+
+def test_ld_default_url(app, monkeypatch):
+  class Session(object):
+    def get(self,url,**kwargs):
+      raise IOError("Not connecting to " + url)
+
+  monkeypatch.setattr(ld_client,"get_session",lambda: Session())
+  app.config.pop("LD_SERVER_URL",None)
+
+  # Without LD_SERVER_URL configured, the default LD server is used
+  with app.app_context():
+    with pytest.raises(FlaskException) as e:
+      ld_client.fetch_ld({})
+
+  assert ld_client.DEFAULT_LD_SERVER_URL in e.value.message
+
+@pytest.mark.parametrize("backend", ["zset", "blocks"])
+def test_ld_partial(app, client, ld_server, backend):
+  app.config["LD_CACHE_BACKEND"] = backend
+  with app.app_context():
+    try:
+      redis_client.get_client().ping()
+    except redis.ConnectionError:
+      pytest.skip("redis is not available")
+
+  refpos = random.randint(10000000,80000000)
+  resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos - 50000,refpos + 50000)})
+  assert resp.status_code == 200
+
+  # Pan to the right, only the newly exposed part of the region should be computed
+  resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos,refpos + 100000)})
+  assert resp.status_code == 200
+  assert len(ld_server.requests) == 2
+  assert int(ld_server.requests[1]["startbp"]) == refpos + 50001
+  assert int(ld_server.requests[1]["endbp"]) == refpos + 100000
+
+  expected = ld_server.compute("16","16:{}_C/T".format(refpos),refpos,refpos + 100000)
+  data = resp.json["data"]
+  assert data["position2"] == [p["position2"] for p in expected["pairs"]]
+  assert data["variant2"] == [p["name2"] for p in expected["pairs"]]
+  assert data["rsquare"] == pytest.approx([p["rsquare"] for p in expected["pairs"]],abs=0.01)
+
+  # Zoom out, both sides should be computed
+  resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos - 80000,refpos + 120000)})
+  assert resp.status_code == 200
+  gaps = [(int(r["startbp"]),int(r["endbp"])) for r in ld_server.requests[2:]]
+  assert gaps == [(refpos - 80000,refpos - 50001),(refpos + 100001,refpos + 120000)]
+
+  # Entirely cached
+  resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos - 10000,refpos + 10000)})
+  assert resp.status_code == 200
+  assert len(ld_server.requests) == 4
+
+def test_ld_cache_defaults(app, client, ld_server):
+  with app.app_context():
+    try:
+      red = redis_client.get_client()
+      red.ping()
+    except redis.ConnectionError:
+      pytest.skip("redis is not available")
+
+  for k in ("LD_CACHE_TTL","LD_CACHE_PANEL_BYTES","LD_CACHE_ADMIT_SIZE"):
+    app.config.pop(k,None)
+
+  refpos = random.randint(10000000,80000000)
+  resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos - 50000,refpos + 50000)})
+  assert resp.status_code == 200
+
+  # Expiration and the per-panel budget are on without any configuration
+  key = "1__16:{}_C/T".format(refpos)
+  assert red.ttl(key) > 0
+  assert red.zscore("ldcache__index__1",key) is not None
+
+def test_ld_memory_cache_default(app, client, ld_server):
+  with app.app_context():
+    try:
+      redis_client.get_client().ping()
+    except redis.ConnectionError:
+      pytest.skip("redis is not available")
+
+  app.config.pop("LD_MEMORY_CACHE_BYTES",None)
+  refpos = random.randint(10000000,80000000)
+  resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos - 50000,refpos + 50000)})
+  assert resp.status_code == 200
+
+  # Results were also kept in this process
+  assert "1__16:{}_C/T".format(refpos) in cache.shared_memory_cache(64 * 1024**2,60).entries
+
+def test_ld_merged_gaps(app, client, ld_server):
+  with app.app_context():
+    try:
+      redis_client.get_client().ping()
+    except redis.ConnectionError:
+      pytest.skip("redis is not available")
+
+  app.config["LD_MAX_GAPS"] = 2
+  refpos = random.randint(10000000,80000000)
+  for start, end in [(-50000,-40000),(-20000,-10000),(10000,20000)]:
+    resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos + start,refpos + end)})
+    assert resp.status_code == 200
+
+  # Leaves 4 gaps, which are requested as one
+  resp = client.get(LD_URL,query_string={"filter": ld_filter(refpos,refpos - 60000,refpos + 30000)})
+  assert resp.status_code == 200
+  assert len(ld_server.requests) == 4
+  assert int(ld_server.requests[3]["startbp"]) == refpos - 60000
+  assert int(ld_server.requests[3]["endbp"]) == refpos + 30000
+
+  expected = ld_server.compute("16","16:{}_C/T".format(refpos),refpos - 60000,refpos + 30000)
+  positions = resp.json["data"]["position2"]
+  assert len(positions) == len(set(positions))
+  assert positions == [p["position2"] for p in expected["pairs"]]
+
+def test_ld_cache_stats(client):
+  resp = client.get("/v1/statistic/pair/LD/cache/")
+  if resp.status_code == 503:
+    pytest.skip("redis is not available")
+
+  assert resp.status_code == 200
+  for key in ("hits","partial_hits","misses","rejected","evictions"):
+    assert isinstance(resp.json["data"][key],int)
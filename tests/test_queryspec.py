@@ -0,0 +1,64 @@
+import pytest
+from locuszoom.api.queryspec import QuerySpec
+from locuszoom.api.uriparsing import SQLCompiler, parse_filter
+
+COLUMNS = "id variant_name chrom pos ref_allele ref_freq log_pvalue beta se score_stat".split()
+FIELD_TO_COL = dict(
+  analysis = "id",
+  variant = "variant_name",
+  chromosome = "chrom",
+  position = "pos",
+  score_test_stat = "score_stat",
+  ref_allele_freq = "ref_freq"
+)
+
+@pytest.fixture
+def spec():
+  return QuerySpec("rest.assoc_results",COLUMNS,FIELD_TO_COL)
+
+def test_fields(spec):
+  assert spec.fields(None) == COLUMNS
+  assert spec.fields("variant, position,log_pvalue") == ["variant_name","pos","log_pvalue"]
+
+  # Unknown fields are dropped
+  assert spec.fields("variant,drop table,pos") == ["variant_name","pos"]
+
+  # Memoized result can't be modified by the caller
+  spec.fields("chromosome").append("bogus")
+  assert spec.fields("chromosome") == ["chrom"]
+
+def test_sort(spec):
+  assert spec.sort(None) is None
+  assert spec.sort("position,log_pvalue") == ["pos","log_pvalue"]
+
+def test_memo_size(spec):
+  for i in range(spec.MEMO_SIZE * 2):
+    spec.fields("chrom,field{}".format(i))
+
+  assert len(spec._memo) == spec.MEMO_SIZE
+
+@pytest.mark.parametrize("filter_str,sort_str,limit", [
+  ("analysis in 45 and chromosome in '2' and position ge 242023897 and position le 242025881", None, None),
+  ("analysis in 45 and chromosome in '2' and position ge 242023897 and position le 242025881", "position", 10),
+  ("analysis in 1,2,3 and variant eq '10:114758349_C/T'", "log_pvalue,pos", None),
+  ("analysis eq 1 or log_pvalue gt 8", None, 100),
+])
+@pytest.mark.parametrize("canonical", [True, False])
+def test_matches_compiler(spec,filter_str,sort_str,limit,canonical):
+  terms = parse_filter(filter_str)
+  fields = spec.fields("variant,position,log_pvalue")
+  sort_fields = spec.sort(sort_str)
+
+  expected = SQLCompiler().to_sql_parsed(terms,"rest.assoc_results",COLUMNS,fields,sort_fields,FIELD_TO_COL,limit,canonical)
+
+  # Twice, to check the memoized statement
+  assert spec.to_sql(terms,fields,sort_fields,limit,canonical) == expected
+  assert spec.to_sql(terms,fields,sort_fields,limit,canonical) == expected
+
+def test_no_field_map():
+  spec = QuerySpec("rest.recomb",["id","name","build","version"])
+  assert spec.cols_to_field == {}
+  assert spec.fields("id,build") == ["id","build"]
+
+  terms = parse_filter("id eq 15")
+  assert spec.to_sql(terms,spec.fields(None)) == SQLCompiler().to_sql_parsed(terms,"rest.recomb",spec.columns,spec.columns)
@@ -149,3 +149,80 @@ def test_null_pos(client):
   }
   resp = client.get(recomb_result_url,query_string=params)
   assert resp.status_code == 400
+
+def test_prepared_matches_plain(app, client):
+  params = {
+    "filter": "id in 15 and chromosome eq '21' and position lt 10906725 and position gt 10870000"
+  }
+
+  app.config["PREPARED_STATEMENTS"] = False
+  plain = client.get("/v1/annotation/recomb/results/",query_string=params)
+
+  # The first request prepares the statements, the second executes the already prepared statements
+  app.config["PREPARED_STATEMENTS"] = True
+  for _ in range(2):
+    resp = client.get("/v1/annotation/recomb/results/",query_string=params)
+    assert resp.status_code == 200
+    assert resp.json == plain.json
+
+def test_window_ordered(client):
+  params = {
+    "filter": "id in 15 and chromosome eq '21' and position lt 10906920 and position gt 10906720"
+  }
+  resp = client.get("/v1/annotation/recomb/results/",query_string=params)
+  assert resp.status_code == 200
+
+  data = resp.json["data"]
+  assert data["position"][0] == 10906720
+  assert data["position"][-1] == 10906920
+  assert data["position"] == sorted(data["position"])
+
+  # Each edge has the rate of the nearest point before it
+  assert data["recomb_rate"][-1] == data["recomb_rate"][-2]
+
+  # Starting the window exactly on a point
+  params["filter"] = "id in 15 and chromosome eq '21' and position lt 10906920 and position ge {}".format(data["position"][1])
+  resp = client.get("/v1/annotation/recomb/results/",query_string=params)
+  assert resp.status_code == 200
+  assert resp.json["data"]["recomb_rate"][0] == data["recomb_rate"][1]
+
+def test_cached_middle(app, client):
+  # Without the in-memory maps, the middle of the window comes from the region cache and only the flanking point
+  # is queried. Compare against querying the whole window.
+  app.config["RECOMB_MAPS"] = False
+  windows = [(0,100), (10870000,10890000), (10870000,10906725), (10906720,10906920), (48097610,49000000)]
+
+  for start, end in windows:
+    params = {
+      "filter": "id in 15 and chromosome eq '21' and position lt {} and position ge {}".format(end,start)
+    }
+
+    app.config["REGION_CACHE_MAX_CHUNKS"] = 0
+    expected = client.get("/v1/annotation/recomb/results/",query_string=params)
+    assert expected.status_code == 200
+
+    app.config["REGION_CACHE_MAX_CHUNKS"] = 40
+    resp = client.get("/v1/annotation/recomb/results/",query_string=params)
+    assert resp.status_code == 200
+    assert resp.json == expected.json
+
+def test_maps_match_database(app, client):
+  windows = [(0,100), (10870000,10890000), (10870000,10906725), (10906720,10906920), (48097610,49000000)]
+
+  for start, end in windows:
+    params = {
+      "filter": "id in 15 and chromosome eq '21' and position lt {} and position ge {}".format(end,start)
+    }
+
+    app.config["RECOMB_MAPS"] = False
+    expected = client.get("/v1/annotation/recomb/results/",query_string=params).data
+
+    # Compared as bytes, so that e.g. 0 and 0.0 are told apart
+    app.config["RECOMB_MAPS"] = True
+    resp = client.get("/v1/annotation/recomb/results/",query_string=params)
+    assert resp.status_code == 200
+    assert resp.data == expected
+
+  stats = client.get("/v1/status").json["recomb_maps"]
+  assert stats["GRCh37"]["chromosomes"] > 0
+  assert stats["GRCh37"]["bytes"] > 0
@@ -0,0 +1,85 @@
+import time
+from flask import jsonify
+from locuszoom.api.conditional import dataset_versions
+from locuszoom.api.recomb_maps import RecombMap, RecombMaps
+from locuszoom.api.uriparsing import FilterParser
+
+COLUMNS = ["id","chromosome","position","recomb_rate","pos_cm"]
+
+# (position, recomb_rate, pos_cm) on chromosome 21 of dataset 15
+POINTS = [
+  (100,0.5,None),
+  (200,1.25,0.001),
+  (300,float("inf"),float("nan")),
+  (400,2.0,float("inf")),
+  (500,0.0,0.004),
+]
+
+def lrm_for(filter_str):
+  fp = FilterParser()
+  return fp.left_middle_right(fp.parse(filter_str))
+
+def load_maps():
+  # Pretend the dataset has already been looked up and loaded
+  dataset_versions("rest.recomb").versions[15] = ("v1",time.time() + 60)
+  maps = RecombMaps()
+  maps.datasets[15] = ("v1","GRCh37",{"21": RecombMap.from_rows(POINTS), "X": RecombMap.from_rows([])})
+  return maps
+
+def database_window(chrom,start,end):
+  # Rows as the database path of the endpoint builds them (routes.recomb_window_data)
+  from locuszoom.api.routes import rows_to_arrays
+
+  points = [dict(zip(COLUMNS,(15,chrom) + p)) for p in POINTS if chrom == "21"]
+  left = [p for p in points if p["position"] <= start][-1:]
+  if not left:
+    left = [{"id": "chrleft", "position": start, "chromosome": chrom, "recomb_rate": 0, "pos_cm": 0}]
+
+  middle = [p for p in points if start <= p["position"] < end]
+  left_end = dict(left[0], position=start)
+  right_end = dict(middle[-1] if middle else left[0], position=end)
+  return rows_to_arrays([left_end] + middle + [right_end],COLUMNS,{},["recomb_rate","pos_cm"])
+
+def test_parse_window():
+  assert RecombMaps.parse_window(lrm_for("id in 15 and chromosome eq '21' and position lt 200 and position gt 100")) == (15,"21",100,200)
+  assert RecombMaps.parse_window(lrm_for("chromosome eq '21' and position lt 200 and position ge 100 and id eq 15")) == (15,"21",100,200)
+
+  for query in [
+    "id in 15,16 and chromosome eq '21' and position lt 200 and position gt 100",
+    "chromosome eq '21' and position lt 200 and position gt 100",
+    "id in 15 and chromosome eq '21' and position lt 200 and position gt 100 and recomb_rate gt 1",
+    "id in 'x' and chromosome eq '21' and position lt 200 and position gt 100",
+  ]:
+    assert RecombMaps.parse_window(lrm_for(query)) is None, query
+
+def test_window_encoding(app):
+  maps = load_maps()
+
+  windows = [("21",0,50), ("21",0,150), ("21",100,100), ("21",150,450), ("21",250,1000), ("21",600,700), ("X",100,200)]
+  with app.test_request_context():
+    for chrom, start, end in windows:
+      lrm = lrm_for("id in 15 and chromosome eq '{}' and position lt {} and position ge {}".format(chrom,end,start))
+
+      # Same JSON as the database path, including integer placeholders and non-finite floats
+      expected = jsonify(database_window(chrom,start,end)).get_data()
+      assert jsonify(maps.window(lrm)).get_data() == expected, (chrom, start, end)
+
+def test_window_fallback(app):
+  maps = load_maps()
+
+  with app.test_request_context():
+    # A filter the maps can't answer goes to the database
+    assert maps.window(lrm_for("id in 15,16 and chromosome eq '21' and position lt 200 and position gt 100")) is None
+
+    app.config["RECOMB_MAPS"] = False
+    assert maps.window(lrm_for("id in 15 and chromosome eq '21' and position lt 200 and position gt 100")) is None
+
+def test_stats():
+  maps = RecombMaps()
+  rmap = RecombMap.from_rows(POINTS)
+  maps.datasets[15] = ("v1","GRCh37",{"21": rmap, "22": rmap})
+  maps.datasets[16] = ("v1","GRCh38",{})
+
+  stats = maps.stats()
+  assert stats["GRCh37"] == {"datasets": 1, "chromosomes": 2, "points": 10, "bytes": 2 * 5 * 25}
+  assert stats["GRCh38"]["bytes"] == 0
@@ -0,0 +1,91 @@
+import pytest
+from locuszoom.api import region_cache
+from locuszoom.api.region_cache import RegionTable
+from locuszoom.api.uriparsing import parse_filter
+
+INTERVALS_URL = "/v1/annotation/intervals/results/"
+
+def interval_filter(start,end):
+  return "id in 18 and chromosome eq '16' and start le {} and end ge {}".format(end,start)
+
+@pytest.fixture
+def queries(app, monkeypatch):
+  """
+  Queries made by the region cache, as (table, dataset id, chromosome, start, end). The cache starts out empty.
+  """
+
+  app.config["REGION_CACHE_CHUNK_SIZE"] = 100000
+  region_cache.cache.init_app(app,config={"CACHE_TYPE": "simple"})
+  with app.app_context():
+    region_cache.cache.clear()
+
+  found = []
+  fetch = RegionTable.fetch
+
+  def recorded_fetch(self,dbid,chrom,start,end):
+    found.append((self.table,dbid,chrom,start,end))
+    return fetch(self,dbid,chrom,start,end)
+
+  monkeypatch.setattr(RegionTable,"fetch",recorded_fetch)
+  return found
+
+def test_parse_region():
+  table = RegionTable(
+    "rest.interval_results",
+    "id public_id chrom start end strand annotation".split(),
+    "rest.interval",
+    start_col = "start",
+    end_col = "end"
+  )
+  f2c = {"chromosome": "chrom"}
+
+  ids, chrom, lower, upper, checks = table.parse_region(parse_filter(interval_filter(53519169,54119169)),f2c)
+  assert (ids, chrom, lower, upper) == ([18], "16", 53519169, 54119169)
+  assert len(checks) == 2
+
+  for query in [
+    "id in 18 and chromosome eq '16' and start le 10 or end ge 5",
+    "id in 18 and chromosome eq '16' and start le 10",
+    "id in 18 and chromosome eq 16 and start le 10 and end ge 5",
+    "id in 18 and chromosome eq '16' and start le 10 and end ge 5 and public_id eq 'x'",
+    "chromosome eq '16' and start le 10 and end ge 5",
+    "id in 18 and chromosome in '1','2' and start le 10 and end ge 5",
+  ]:
+    assert table.parse_region(parse_filter(query),f2c) is None
+
+def test_rows_match_database(app, client, queries):
+  def fetch(start,end):
+    resp = client.get(INTERVALS_URL,query_string={"filter": interval_filter(start,end)})
+    assert resp.status_code == 200
+    data = resp.json["data"]
+    return sorted(zip(*[data[k] for k in sorted(data)]),key=repr)
+
+  # Windows within one chunk, across chunk boundaries, on a single position, and without any intervals
+  windows = [(53519169,54119169), (53950000,53960000), (53999999,54000001), (53600000,53600000), (1,1000)]
+  for start, end in windows:
+    cached = fetch(start,end)
+
+    app.config["REGION_CACHE_MAX_CHUNKS"] = 0
+    assert fetch(start,end) == cached, (start, end)
+    app.config["REGION_CACHE_MAX_CHUNKS"] = 40
+
+  assert len(fetch(53519169,54119169)) > 0
+
+def test_chunks_reused(client, queries):
+  client.get(INTERVALS_URL,query_string={"filter": interval_filter(53519169,54119169)})
+  assert queries == [("rest.interval_results",18,"16",53500000,54199999)]
+
+  # Overlapping window only queries the chunks that weren't cached
+  client.get(INTERVALS_URL,query_string={"filter": interval_filter(54000000,54350000)})
+  assert queries[1:] == [("rest.interval_results",18,"16",54200000,54399999)]
+
+  # Fully cached
+  client.get(INTERVALS_URL,query_string={"filter": interval_filter(53700000,54300000)})
+  assert len(queries) == 2
+
+def test_too_many_chunks(app, client, queries):
+  app.config["REGION_CACHE_MAX_CHUNKS"] = 5
+
+  resp = client.get(INTERVALS_URL,query_string={"filter": interval_filter(53000000,53900000)})
+  assert resp.status_code == 200
+  assert queries == []
@@ -1,3 +1,5 @@
+import pytest
+
 def test_statistic_single_results(client):
   resp = client.get("/v1/statistic/single/")
   assert resp.status_code == 200
@@ -96,3 +98,91 @@ def test_record_hard_limit(app, client):
 
   assert results.status_code == 400
   assert "please reduce the range of your query" in results.json["message"]
+
+def test_record_hard_limit_table(app, client):
+  resp = client.get("/v1/statistic/single/")
+  assert resp.status_code == 200
+
+  test_id = resp.json["data"]["id"][0]
+  params = {
+    "filter": "analysis in {} and chromosome in '16' and position ge 0 and position le 200000000".format(test_id),
+    "sort": "position"
+  }
+
+  # The table format is streamed, but the limit must still be enforced before the response begins.
+  app.config["MAX_RECORDS"] = 1
+
+  results = client.get("/v1/statistic/single/results/",query_string=params)
+
+  assert results.status_code == 400
+  assert "please reduce the range of your query" in results.json["message"]
+
+def test_table_matches_objects(client):
+  resp = client.get("/v1/statistic/single/")
+  assert resp.status_code == 200
+
+  test_id = resp.json["data"]["id"][0]
+  params = {
+    "filter": "analysis in {} and chromosome in '16' and position ge 0 and position le 200000000".format(test_id),
+    "sort": "position"
+  }
+
+  table = client.get("/v1/statistic/single/results/",query_string=params)
+  assert table.status_code == 200
+  assert int(table.headers["Content-Length"]) == len(table.get_data())
+
+  params["format"] = "objects"
+  objects = client.get("/v1/statistic/single/results/",query_string=params)
+  assert objects.status_code == 200
+
+  table_data = table.json["data"]
+  objects_data = objects.json["data"]
+  assert table.json["lastPage"] is None
+  assert len(table_data["variant"]) == len(objects_data)
+
+  for i, obj in enumerate(objects_data):
+    for k, v in obj.items():
+      assert table_data[k][i] == v
+
+def test_not_modified(client):
+  test_id = client.get("/v1/statistic/single/").json["data"]["id"][0]
+  params = {
+    "filter": "analysis in {} and chromosome in '16' and position ge 0 and position le 200000000".format(test_id)
+  }
+  resp = client.get("/v1/statistic/single/results/",query_string=params)
+  assert resp.status_code == 200
+  assert "max-age" in resp.headers["Cache-Control"]
+  etag = resp.headers["ETag"]
+
+  resp = client.get("/v1/statistic/single/results/",query_string=params,headers={"If-None-Match": etag})
+  assert resp.status_code == 304
+  assert resp.headers["ETag"] == etag
+  assert len(resp.data) == 0
+
+  # The compressed response is a different representation, with its own ETag
+  resp = client.get("/v1/statistic/single/results/",query_string=params,headers={"Accept-Encoding": "gzip"})
+  assert resp.headers["Content-Encoding"] == "gzip"
+  gzip_etag = resp.headers["ETag"]
+  assert gzip_etag != etag
+
+  resp = client.get("/v1/statistic/single/results/",query_string=params,
+                    headers={"Accept-Encoding": "gzip","If-None-Match": gzip_etag})
+  assert resp.status_code == 304
+  assert resp.headers["ETag"] == gzip_etag
+
+def test_arrow_matches_table(client):
+  pa = pytest.importorskip("pyarrow")
+
+  test_id = client.get("/v1/statistic/single/").json["data"]["id"][0]
+  params = {
+    "filter": "analysis in {} and chromosome in '16' and position ge 0 and position le 200000000".format(test_id)
+  }
+  table = client.get("/v1/statistic/single/results/",query_string=params).json["data"]
+
+  params["format"] = "arrow"
+  resp = client.get("/v1/statistic/single/results/",query_string=params)
+  assert resp.status_code == 200
+  arrow = pa.ipc.open_stream(resp.data).read_all().to_pydict()
+
+  assert arrow["variant"] == table["variant"]
+  assert arrow["position"] == table["position"]
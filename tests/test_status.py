@@ -0,0 +1,28 @@
+def test_status(client):
+  resp = client.get("/v1/status")
+  assert resp.status_code == 200
+
+  js = resp.json
+  for key in ("branch","githash","uptime","redis_pool","db_pool"):
+    assert key in js
+
+  for key in ("size","in_use","max_in_use","checkouts","waits","timeouts"):
+    assert key in js["redis_pool"]
+
+def test_redis_not_used(client):
+  before = client.get("/v1/status").json["redis_pool"]["checkouts"]
+
+  # Requests that don't need redis should not borrow a connection
+  params = {
+    "filter": "source in 2 and chrom eq '16' and start le 57022881 and end ge 56985060"
+  }
+  client.get("/v1/annotation/genes/",query_string=params)
+
+  after = client.get("/v1/status").json["redis_pool"]["checkouts"]
+  assert after == before
+
+def test_status_no_db_checkout(client):
+  # Only requests that query the database should check out a connection
+  before = client.get("/v1/status").json["db_pool"]["checkouts"]
+  after = client.get("/v1/status").json["db_pool"]["checkouts"]
+  assert after == before
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import os
+import time
+import argparse
+import requests
+from locuszoom.api.compression import CODECS
+
+# Compare CPU time and compression ratio of the response codecs (gzip, brotli, zstd) at several levels, using
+# real API responses.
+#
+# Capture payloads first from a running API (saved uncompressed):
+#   ./compression.py --capture payloads/
+#
+# Then time compressing them:
+#   ./compression.py payloads/*.json
+
+# Typical requests made by LocusZoom for a ~500kb region
+CAPTURE_PATHS = {
+  "single_results": "/statistic/single/results/?filter=analysis in 45 and chromosome in '2' and position ge 242023897 and position le 242525881",
+  "gwascat": "/annotation/gwascatalog/results/?filter=id in 2 and chrom eq '16' and pos ge 53519169 and pos le 54119169",
+  "genes": "/annotation/genes/?filter=source in 2 and chrom eq '16' and start le 54119169 and end ge 53519169",
+  "recomb": "/annotation/recomb/results/?filter=id in 15 and chromosome eq '16' and position le 54119169 and position ge 53519169",
+  "intervals": "/annotation/intervals/results/?filter=id in 18 and chromosome eq '16' and start le 54119169 and end ge 53519169",
+}
+
+LEVELS = {
+  "gzip": [1, 6, 9],
+  "br": [1, 4, 6, 9],
+  "zstd": [1, 3, 6, 12],
+}
+
+def get_settings():
+  p = argparse.ArgumentParser()
+  p.add_argument("payloads", nargs="*", help="Files containing uncompressed response bodies")
+  p.add_argument("--capture", help="Download payloads from the API into this directory, then exit")
+  p.add_argument("--api-base", default="https://portaldev.sph.umich.edu/api/v1")
+  p.add_argument("--chunk-size", default=64 * 1024, type=int, help="Feed the compressor in chunks of this size, as when streaming")
+  p.add_argument("-n", "--number", default=3, type=int, help="Iterations per measurement")
+  return p.parse_args()
+
+def capture(api_base, outdir):
+  os.makedirs(outdir, exist_ok=True)
+  for name, path in CAPTURE_PATHS.items():
+    resp = requests.get(api_base + path, headers={"Accept-Encoding": "identity"})
+    resp.raise_for_status()
+
+    fpath = os.path.join(outdir, name + ".json")
+    with open(fpath, "wb") as fp:
+      fp.write(resp.content)
+
+    print("{} {:,} bytes".format(fpath, len(resp.content)))
+
+def compress(codec, level, data, chunk_size):
+  stream = CODECS[codec](level)
+  size = 0
+  for i in range(0, len(data), chunk_size):
+    size += len(stream.compress(data[i:i + chunk_size]))
+
+  return size + len(stream.finish())
+
+def main():
+  args = get_settings()
+  if args.capture:
+    capture(args.api_base, args.capture)
+    return
+
+  if not args.payloads:
+    raise ValueError("No payloads given, capture some first with --capture <dir>")
+
+  payloads = []
+  for fpath in args.payloads:
+    with open(fpath, "rb") as fp:
+      payloads.append(fp.read())
+
+  total_mb = sum(len(x) for x in payloads) / 1024.0**2
+  print("{} payloads, {:.2f} MB total".format(len(payloads), total_mb))
+  print()
+  print("{:>6} {:>6} {:>10} {:>14} {:>12}".format("codec", "level", "ratio", "cpu ms / MB", "MB / s"))
+
+  for codec in ("gzip", "br", "zstd"):
+    if codec not in CODECS:
+      print("{:>6} (module not installed)".format(codec))
+      continue
+
+    for level in LEVELS[codec]:
+      compressed = sum(compress(codec, level, data, args.chunk_size) for data in payloads)
+
+      start = time.process_time()
+      for _ in range(args.number):
+        for data in payloads:
+          compress(codec, level, data, args.chunk_size)
+      cpu = (time.process_time() - start) / args.number
+
+      print("{:>6} {:>6} {:>10.2f} {:>14.1f} {:>12.1f}".format(
+        codec, level, total_mb * 1024**2 / compressed, cpu * 1000 / total_mb, total_mb / cpu if cpu > 0 else float("inf")
+      ))
+
+if __name__ == "__main__":
+  main()
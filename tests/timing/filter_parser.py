@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import argparse
+import timeit
+from locuszoom.api.uriparsing import EXAMPLE_FILTERS, FilterParser, SQLCompiler, parse_filter, fast_parse_filter, pyparse_filter, _grammar
+
+# Microbenchmark for filter string parsing.
+#   build:    constructing the pyparsing grammar (previously done for every FilterParser)
+#   parse:    parsing a filter string with the precompiled grammar
+#   fast:     parsing a filter string with the hand-written parser (cache miss)
+#   cached:   parse_filter() on a filter string that has been seen before (cache hit)
+#   request:  what a typical request does, construct parser/compiler objects and parse the filter twice
+
+def get_settings():
+  p = argparse.ArgumentParser()
+  p.add_argument("-n", "--number", default=2000, type=int, help="Iterations per measurement")
+  return p.parse_args()
+
+def per_call_us(func, number):
+  return timeit.timeit(func, number=number) / number * 1E6
+
+def request_like(filter_str, fields):
+  fp = FilterParser()
+  fp.statements(filter_str)
+  SQLCompiler().to_sql(filter_str, "table", fields)
+
+def main():
+  args = get_settings()
+
+  print("grammar build: {:.1f} us".format(per_call_us(_grammar, max(args.number // 10, 1))))
+  print()
+  print("{:>10} {:>10} {:>10} {:>10}  filter".format("parse", "fast", "cached", "request"))
+
+  for f in EXAMPLE_FILTERS:
+    parse_us = per_call_us(lambda: pyparse_filter(f), args.number)
+    fast_us = per_call_us(lambda: fast_parse_filter(f), args.number)
+
+    parse_filter(f)
+    cached_us = per_call_us(lambda: parse_filter(f), args.number)
+
+    fields = [t.lhs for t in parse_filter(f) if not isinstance(t, str)]
+    request_us = per_call_us(lambda: request_like(f, fields), args.number)
+
+    print("{:>10.1f} {:>10.1f} {:>10.2f} {:>10.1f}  {}".format(parse_us, fast_us, cached_us, request_us, f))
+
+  print()
+  print(parse_filter.cache_info())
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import json
+import time
+import argparse
+from locuszoom.api.gene_index import assemble_genes
+
+# Time building and serializing gene models for a chromosome-wide load of genes, using the rest.gene_data test
+# fixture. The fixture only covers a few regions of chr16, so it is repeated (shifted along the chromosome, with
+# new ids) to reach a realistic number of genes.
+#   assemble:  building Gene/Transcript/Exon objects from rows (ordered as returned by gene_index.features_sql())
+#   to_dict:   gene.to_dict() followed by json.dumps(), as jsonify() would do
+#   to_json:   gene.to_json(), writing JSON directly
+#
+#   ./genes.py --copies 50
+
+FIXTURE = os.path.join(os.path.dirname(__file__), "../data/table_gene_data.gz")
+COLUMNS = "id feature_type chrom start end strand gene_id gene_name transcript_id exon_id annotation".split()
+
+def get_settings():
+  p = argparse.ArgumentParser()
+  p.add_argument("--fixture", default=FIXTURE, help="rest.gene_data rows, in postgres COPY format")
+  p.add_argument("--copies", default=50, type=int, help="Number of times to repeat the fixture")
+  p.add_argument("-n", "--number", default=5, type=int, help="Iterations per measurement")
+  return p.parse_args()
+
+def read_rows(fpath):
+  rows = []
+  with gzip.open(fpath, "rt") as fp:
+    for line in fp:
+      values = [None if v == "\\N" else v for v in line.rstrip("\n").split("\t")]
+      row = dict(zip(COLUMNS, values))
+      row["start"] = int(row["start"])
+      row["end"] = int(row["end"])
+      row["annotation"] = json.loads(row["annotation"]) if row["annotation"] is not None else {}
+      rows.append(row)
+
+  return rows
+
+def replicate(rows, copies):
+  span = max(r["end"] for r in rows)
+  out = []
+  for i in range(copies):
+    for r in rows:
+      r = dict(r, start=r["start"] + i * span, end=r["end"] + i * span)
+      for k in ("gene_id", "transcript_id", "exon_id"):
+        if r[k] is not None:
+          r[k] = "{}_{}".format(r[k], i)
+
+      out.append(r)
+
+  return out
+
+def ordered_rows(rows):
+  # Same order as gene_index.features_sql(): by gene, then each transcript followed by its exons
+  rank = {"gene": 0, "transcript": 1, "exon": 2}
+  genes = {r["gene_id"]: r for r in rows if r["feature_type"] == "gene"}
+  tx_start = {(r["gene_id"], r["transcript_id"]): r["start"] for r in rows if r["feature_type"] == "transcript"}
+
+  def key(r):
+    gene = genes[r["gene_id"]]
+    tx = tx_start.get((r["gene_id"], r["transcript_id"]))
+    return (gene["start"], gene["gene_id"], tx is not None, tx or 0, r["transcript_id"] or "", rank[r["feature_type"]], r["start"])
+
+  selected = [dict(r, gene_type=genes[r["gene_id"]]["annotation"].get("gene_type")) for r in rows
+    if r["feature_type"] in rank and r["gene_id"] in genes]
+  return sorted(selected, key=key)
+
+def best_of(func, number, setup=None):
+  best = None
+  for _ in range(number):
+    if setup is not None:
+      setup()
+
+    start = time.process_time()
+    result = func()
+    elapsed = time.process_time() - start
+    best = elapsed if best is None else min(best, elapsed)
+
+  return best, result
+
+def main():
+  args = get_settings()
+  rows = replicate(read_rows(args.fixture), args.copies)
+
+  rows = ordered_rows(rows)
+
+  print("{:,} genes, {:,} gene/transcript/exon rows".format(sum(r["feature_type"] == "gene" for r in rows), len(rows)))
+  print()
+
+  assemble_time, genes = best_of(lambda: assemble_genes(rows), args.number)
+  print("{:>10} {:>10.1f} ms".format("assemble", assemble_time * 1000))
+
+  # Sort children once up front, so both serializers are timed on the same work
+  for gene in genes:
+    gene.sort()
+
+  dict_time, via_dict = best_of(
+    lambda: [json.dumps(gene.to_dict(), sort_keys=True, separators=(",", ":")) for gene in genes], args.number
+  )
+  print("{:>10} {:>10.1f} ms".format("to_dict", dict_time * 1000))
+
+  def forget_exons():
+    # Exons remember their JSON once written, start from scratch each time
+    for gene in genes:
+      for exon in gene.exons:
+        exon.json = None
+
+  json_time, direct = best_of(lambda: [gene.to_json() for gene in genes], args.number, forget_exons)
+  print("{:>10} {:>10.1f} ms".format("to_json", json_time * 1000))
+
+  assert via_dict == direct, "Serializers disagree"
+  print()
+  print("{:,} bytes of JSON, to_json {:.1f}x faster than to_dict + dumps".format(
+    sum(len(x) for x in direct), dict_time / json_time if json_time > 0 else float("inf")
+  ))
+
+if __name__ == "__main__":
+  main()
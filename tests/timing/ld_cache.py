@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import argparse
+import random
+import timeit
+import redis
+from locuszoom.api.cache import RedisIntervalCache, RedisBlockCache
+
+# Compare LD cache layouts in redis.
+#   zset:    one sorted set member (msgpack'd dict) per variant
+#   blocks:  binary blocks of variants bucketed by position
+#
+# Reports memory used in redis for one cached window, the time to store it, and the time to retrieve
+# the whole window and a smaller sub-window.
+
+def get_settings():
+  p = argparse.ArgumentParser()
+  p.add_argument("--host", default="localhost")
+  p.add_argument("--port", default=6379, type=int)
+  p.add_argument("--db", default=3, type=int)
+  p.add_argument("--window", default=500000, type=int, help="Size of the LD window in bp")
+  p.add_argument("--spacing", default=30, type=int, help="Average distance between variants in bp")
+  p.add_argument("-n", "--number", default=20, type=int, help="Iterations per measurement")
+  return p.parse_args()
+
+def make_ld(start, end, spacing, seed=1):
+  rand = random.Random(seed)
+  data = {}
+  pos = start
+  while pos <= end:
+    data[pos] = {"name2": "16:{}_{}/{}".format(pos, rand.choice("ACGT"), rand.choice("ACGT")), "rsquare": rand.random()}
+    pos += rand.randint(1, 2 * spacing)
+
+  return data
+
+def memory_usage(red, keys):
+  total = 0
+  for key in keys:
+    try:
+      used = red.execute_command("MEMORY", "USAGE", key)
+    except redis.ResponseError:
+      # MEMORY USAGE requires redis 4. Size of the serialized value is a reasonable stand in.
+      dumped = red.dump(key)
+      used = len(dumped) if dumped is not None else 0
+
+    total += used or 0
+
+  return total
+
+def main():
+  args = get_settings()
+  red = redis.StrictRedis(host=args.host, port=args.port, db=args.db)
+
+  start = 50000000
+  end = start + args.window
+  data = make_ld(start, end, args.spacing)
+  sub_start = start + args.window // 2
+  sub_end = sub_start + min(100000, args.window // 4)
+
+  print("{:,} variants in a {:,} bp window".format(len(data), args.window))
+  print()
+  print("{:>8} {:>12} {:>12} {:>14} {:>14}".format("layout", "memory (kb)", "store (ms)", "retrieve (ms)", "sub-window (ms)"))
+
+  for name, cache_class in (("zset", RedisIntervalCache), ("blocks", RedisBlockCache)):
+    cache = cache_class(red)
+    key = "timing__16:{}_A/G".format(start)
+    cache.delete(key)
+
+    store_ms = timeit.timeit(lambda: cache.store(key, start, end, data), number=1) * 1000
+
+    if name == "zset":
+      keys = [key, key + "__zset"]
+    else:
+      keys = [cache.PREFIX + key]
+
+    memory_kb = memory_usage(red, keys) / 1024.0
+
+    assert len(cache.retrieve(key, start, end)) == len(data)
+    retrieve_ms = timeit.timeit(lambda: cache.retrieve(key, start, end), number=args.number) / args.number * 1000
+    sub_ms = timeit.timeit(lambda: cache.retrieve(key, sub_start, sub_end), number=args.number) / args.number * 1000
+
+    print("{:>8} {:>12.1f} {:>12.1f} {:>14.2f} {:>14.2f}".format(name, memory_kb, store_ms, retrieve_ms, sub_ms))
+    cache.delete(key)
+
+if __name__ == "__main__":
+  main()